@@ -860,7 +860,7 @@ class ElectrumWindow(QMainWindow):
         grid.setSpacing(8)
         grid.setColumnMinimumWidth(3,300)
         grid.setColumnStretch(5,1)
-        grid.setRowStretch(8, 1)
+        grid.setRowStretch(9, 1)
 
         from paytoedit import PayToEdit
         self.amount_e = BTCAmountEdit(self.get_decimal_point)
@@ -911,12 +911,32 @@ class ElectrumWindow(QMainWindow):
         self.fee_e_help = HelpButton(msg)
         grid.addWidget(self.fee_e_help, 5, 3)
         self.update_fee_edit()
+
+        self.choosers = [('oldest', _('Oldest first')), ('largest', _('Largest first')), ('bnb', _('Avoid change')), ('consolidate', _('Consolidate small coins'))]
+        self.chooser_combo = QComboBox()
+        self.chooser_combo.addItems([x[1] for x in self.choosers])
+        names = [x[0] for x in self.choosers]
+        chooser = self.config.get('coin_chooser', 'oldest')
+        self.chooser_combo.setCurrentIndex(names.index(chooser) if chooser in names else 0)
+        grid.addWidget(QLabel(_('Coins')), 6, 0)
+        grid.addWidget(self.chooser_combo, 6, 1, 1, 2)
+        msg = _('How the coins spent by this transaction are selected.') + '\n\n'\
+              + _('Oldest first: spend coins in the order they were received.') + '\n'\
+              + _('Largest first: use as few coins as possible.') + '\n'\
+              + _('Avoid change: look for coins that add up to the amount and fee, so that no change output is needed.') + '\n'\
+              + _('Consolidate small coins: spend many small coins at once, merging them into the change.')
+        grid.addWidget(HelpButton(msg), 6, 3)
+        def on_chooser(i):
+            self.config.set_key('coin_chooser', self.choosers[i][0], True)
+            text_edited(False)
+        self.chooser_combo.currentIndexChanged.connect(on_chooser)
+
         self.send_button = EnterButton(_("Send"), self.do_send)
-        grid.addWidget(self.send_button, 6, 1)
+        grid.addWidget(self.send_button, 7, 1)
         b = EnterButton(_("Clear"), self.do_clear)
-        grid.addWidget(b, 6, 2)
+        grid.addWidget(b, 7, 2)
         self.payto_sig = QLabel('')
-        grid.addWidget(self.payto_sig, 7, 0, 1, 4)
+        grid.addWidget(self.payto_sig, 8, 0, 1, 4)
         w.setLayout(grid)
 
         def on_shortcut():
@@ -944,7 +964,7 @@ class ElectrumWindow(QMainWindow):
                 if not outputs:
                     addr = self.payto_e.payto_address if self.payto_e.payto_address else self.dummy_address
                     outputs = [('address', addr, amount)]
-                tx = self.wallet.make_unsigned_transaction(outputs, fee, coins = self.get_coins())
+                tx = self.wallet.make_unsigned_transaction(outputs, fee, coins = self.get_coins(), chooser = self.get_coin_chooser())
                 self.not_enough_funds = (tx is None)
                 if not is_fee:
                     fee = self.wallet.get_tx_fee(tx) if tx else None
@@ -1079,7 +1099,7 @@ class ElectrumWindow(QMainWindow):
         outputs, fee, label, coins = r
 
         try:
-            tx = self.wallet.make_unsigned_transaction(outputs, fee, None, coins = coins)
+            tx = self.wallet.make_unsigned_transaction(outputs, fee, None, coins = coins, chooser = self.get_coin_chooser())
             tx.error = None
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
@@ -1478,6 +1498,9 @@ class ElectrumWindow(QMainWindow):
         return sum(map(lambda x:x['value'], self.get_coins()))
 
 
+    def get_coin_chooser(self):
+        return self.choosers[self.chooser_combo.currentIndex()][0]
+
     def get_coins(self):
         if self.pay_from:
             return self.pay_from
@@ -2290,12 +2313,13 @@ class ElectrumWindow(QMainWindow):
         addresses = self.wallet.addresses(True)
         done = False
         def privkeys_thread():
-            for addr in addresses:
-                time.sleep(0.1)
-                if done: 
-                    break
-                private_keys[addr] = "\n".join(self.wallet.get_private_key(addr, password))
-                d.emit(SIGNAL('computing_privkeys'))
+            with self.wallet.unlocked(password):
+                for addr in addresses:
+                    time.sleep(0.1)
+                    if done: 
+                        break
+                    private_keys[addr] = "\n".join(self.wallet.get_private_key(addr, password))
+                    d.emit(SIGNAL('computing_privkeys'))
             d.emit(SIGNAL('show_privkeys'))
 
         def show_privkeys():
@@ -17,6 +17,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import bitcoin
+import ecc
 from bitcoin import *
 from i18n import _
 from transaction import Transaction, is_extended_pubkey
@@ -52,16 +53,24 @@ class Account(object):
     def derive_pubkeys(self, for_change, n):
         pass
 
+    def derive_range(self, for_change, start, count):
+        return [self.derive_pubkeys(for_change, n) for n in range(start, start + count)]
+
     def create_new_address(self, for_change):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
         pubkeys_list = self.change_pubkeys if for_change else self.receiving_pubkeys
         addr_list = self.change_addresses if for_change else self.receiving_addresses
         n = len(pubkeys_list)
-        pubkeys = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(pubkeys)
-        pubkeys_list.append(pubkeys)
-        addr_list.append(address)
-        print_msg(address)
-        return address
+        addresses = []
+        for pubkeys in self.derive_range(for_change, n, count):
+            address = self.pubkeys_to_address(pubkeys)
+            pubkeys_list.append(pubkeys)
+            addr_list.append(address)
+            print_msg(address)
+            addresses.append(address)
+        return addresses
 
     def pubkeys_to_address(self, pubkey):
         return public_key_to_bc_address(pubkey.decode('hex'))
@@ -79,14 +88,16 @@ class Account(object):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             addresses = self.get_addresses(for_change)
-            if len(addresses) < limit:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
-                continue
-            if map( lambda a: wallet.address_is_old(a), addresses[-limit:] ) == limit*[False]:
+            # number of unused addresses at the end of the sequence
+            unused = 0
+            for address in reversed(addresses[-limit:]):
+                if wallet.address_is_old(address):
+                    break
+                unused += 1
+            if unused >= limit:
                 break
-            else:
-                address = self.create_new_address(for_change)
+            # derive the missing addresses together
+            for address in self.create_new_addresses(for_change, limit - unused):
                 wallet.add_address(address)
 
     def synchronize(self, wallet):
@@ -139,14 +150,18 @@ class ImportedAccount(Account):
         return self.get_pubkeys(for_change, n)
 
     def get_private_key(self, sequence, wallet, password):
-        from wallet import pw_decode
         for_change, i = sequence
         assert for_change == 0
         address = self.get_addresses(0)[i]
+        pk = wallet.get_unlocked(password, ('imported', address), lambda: self.decrypt_key(address, password))
+        return [pk]
+
+    def decrypt_key(self, address, password):
+        from wallet import pw_decode
         pk = pw_decode(self.keypairs[address][1], password)
         # this checks the password
         assert address == address_from_private_key(pk)
-        return [pk]
+        return pk
 
     def has_change(self):
         return False
@@ -184,10 +199,8 @@ class OldAccount(Account):
 
     @classmethod
     def mpk_from_seed(klass, seed):
-        curve = SECP256k1
         secexp = klass.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string().encode('hex')
+        master_public_key = ecc.encode_point(ecc.mul_G(secexp), False)[1:].encode('hex')
         return master_public_key
 
     @classmethod
@@ -208,12 +221,10 @@ class OldAccount(Account):
 
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
-        curve = SECP256k1
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string( mpk, curve = SECP256k1 )
-        pubkey_point = master_public_key.pubkey.point + z*curve.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
-        return '04' + public_key2.to_string().encode('hex')
+        master_public_key = ecc.decode_point('\x04' + mpk)
+        pubkey_point = ecc.add(master_public_key, ecc.mul_G(z))
+        return ecc.encode_point(pubkey_point, False).encode('hex')
 
     def derive_pubkeys(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
@@ -227,23 +238,26 @@ class OldAccount(Account):
         
 
     def get_private_key(self, sequence, wallet, password):
-        seed = wallet.get_seed(password)
-        self.check_seed(seed)
+        secexp = wallet.get_unlocked(password, ('stretched', self.mpk), lambda: self.get_stretched_exponent(wallet, password))
         for_change, n = sequence
-        secexp = self.stretch_key(seed)
         pk = self.get_private_key_from_stretched_exponent(for_change, n, secexp)
         return [pk]
 
+    def get_stretched_exponent(self, wallet, password):
+        seed = wallet.get_seed(password)
+        secexp = self.stretch_key(seed)
+        self.check_stretched_exponent(secexp)
+        return secexp
 
     def check_seed(self, seed):
-        curve = SECP256k1
-        secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        self.check_stretched_exponent(self.stretch_key(seed))
+        return True
+
+    def check_stretched_exponent(self, secexp):
+        master_public_key = ecc.encode_point(ecc.mul_G(secexp), False)[1:]
         if master_public_key != self.mpk:
             print_error('invalid password (mpk)', self.mpk.encode('hex'), master_public_key.encode('hex'))
             raise Exception('Invalid password')
-        return True
 
     def get_master_pubkeys(self):
         return [self.mpk.encode('hex')]
@@ -272,6 +286,12 @@ class OldAccount(Account):
         return mpk, s
 
 
+# decoded branch nodes, by (xpub, for_change); cleared when full, like
+# the address caches of bitcoin.py
+branch_nodes = {}
+branch_nodes_size = 256
+
+
 class BIP32_Account(Account):
     gap_limit = 20
     gap_limit_for_change = 3
@@ -279,8 +299,6 @@ class BIP32_Account(Account):
     def __init__(self, v):
         Account.__init__(self, v)
         self.xpub = v['xpub']
-        self.xpub_receive = None
-        self.xpub_change = None
 
     def dump(self):
         d = Account.dump(self)
@@ -295,12 +313,25 @@ class BIP32_Account(Account):
     def get_master_pubkeys(self):
         return [self.xpub]
 
+    @classmethod
+    def get_branch_node(self, xpub, for_change):
+        key = (xpub, for_change)
+        node = branch_nodes.get(key)
+        if node is None:
+            node = PublicNode.from_xpub(xpub).child(for_change)
+            if len(branch_nodes) >= branch_nodes_size:
+                branch_nodes.clear()
+            branch_nodes[key] = node
+        return node
+
     @classmethod
     def derive_pubkey_from_xpub(self, xpub, for_change, n):
-        _, _, _, c, cK = deserialize_xkey(xpub)
-        for i in [for_change, n]:
-            cK, c = CKD_pub(cK, c, i)
-        return cK.encode('hex')
+        return self.derive_range_from_xpub(xpub, for_change, n, 1)[0]
+
+    @classmethod
+    def derive_range_from_xpub(self, xpub, for_change, start, count):
+        node = self.get_branch_node(xpub, for_change)
+        return [cK.encode('hex') for cK in node.derive_range(start, count)]
 
     def get_pubkey_from_xpub(self, xpub, for_change, n):
         xpubs = self.get_master_pubkeys()
@@ -309,32 +340,33 @@ class BIP32_Account(Account):
         return pubkeys[i]
 
     def derive_pubkeys(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        _, _, _, c, cK = deserialize_xkey(xpub)
-        cK, c = CKD_pub(cK, c, n)
-        result = cK.encode('hex')
-        return result
+        return self.derive_range(for_change, n, 1)[0]
+
+    def derive_range(self, for_change, start, count):
+        return self.derive_range_from_xpub(self.xpub, for_change, start, count)
 
 
     def get_private_key(self, sequence, wallet, password):
         out = []
         xpubs = self.get_master_pubkeys()
         roots = [k for k, v in wallet.master_public_keys.iteritems() if v in xpubs]
+        for_change, n = sequence
         for root in roots:
-            xpriv = wallet.get_master_private_key(root, password)
-            if not xpriv:
+            node = wallet.get_unlocked(password, ('branch', root, for_change), lambda: self.get_branch_private_node(wallet, root, for_change, password))
+            if node is None:
                 continue
-            _, _, _, c, k = deserialize_xkey(xpriv)
-            pk = bip32_private_key( sequence, k, c )
+            k, c = node
+            pk = bip32_private_key( [n], k, c )
             out.append(pk)
         return out
 
+    def get_branch_private_node(self, wallet, root, for_change, password):
+        xpriv = wallet.get_master_private_key(root, password)
+        if not xpriv:
+            return
+        _, _, _, c, k = deserialize_xkey(xpriv)
+        return CKD_priv(k, c, for_change)
+
     def get_type(self):
         return _('Standard 1 of 1')
 
@@ -379,8 +411,9 @@ class BIP32_Account_2of2(BIP32_Account):
     def get_pubkeys(self, for_change, n):
         return self.get_pubkey(for_change, n)
 
-    def derive_pubkeys(self, for_change, n):
-        return map(lambda x: self.derive_pubkey_from_xpub(x, for_change, n), self.get_master_pubkeys())
+    def derive_range(self, for_change, start, count):
+        columns = [self.derive_range_from_xpub(x, for_change, start, count) for x in self.get_master_pubkeys()]
+        return map(list, zip(*columns))
 
     def redeem_script(self, for_change, n):
         pubkeys = self.get_pubkeys(for_change, n)
@@ -19,11 +19,14 @@
 
 import hashlib
 import base64
+import os
 import re
 import sys
 import hmac
 
 import version
+import ecc
+import cipher
 from util import print_error
 
 try:
@@ -43,9 +46,15 @@ MIN_RELAY_TX_FEE = 1000
 RECOMMENDED_FEE = 50000
 COINBASE_MATURITY = 100
 
-# AES encryption
-EncodeAES = lambda secret, s: base64.b64encode(aes.encryptData(secret,s))
-DecodeAES = lambda secret, e: aes.decryptData(secret, base64.b64decode(e))
+# AES encryption, in the format of slowaes' encryptData: the iv is
+# prepended to the ciphertext
+def EncodeAES(secret, s):
+    iv = os.urandom(16)
+    return base64.b64encode(iv + cipher.encrypt(secret, iv, aes.append_PKCS7_padding(s)))
+
+def DecodeAES(secret, e):
+    data = base64.b64decode(e)
+    return aes.strip_PKCS7_padding(cipher.decrypt(secret, data[:16], data[16:]))
 
 def strip_PKCS7_padding(s):
     """return s stripped of PKCS7 padding"""
@@ -60,25 +69,15 @@ def strip_PKCS7_padding(s):
 
 
 def aes_encrypt_with_iv(key, iv, data):
-    mode = aes.AESModeOfOperation.modeOfOperation["CBC"]
-    key = map(ord, key)
-    iv = map(ord, iv)
-    data = aes.append_PKCS7_padding(data)
     keysize = len(key)
     assert keysize in aes.AES.keySize.values(), 'invalid key size: %s' % keysize
-    moo = aes.AESModeOfOperation()
-    (mode, length, ciph) = moo.encrypt(data, mode, key, keysize, iv)
-    return ''.join(map(chr, ciph))
+    data = aes.append_PKCS7_padding(data)
+    return cipher.encrypt(key, iv, data)
 
 def aes_decrypt_with_iv(key, iv, data):
-    mode = aes.AESModeOfOperation.modeOfOperation["CBC"]
-    key = map(ord, key)
-    iv = map(ord, iv)
     keysize = len(key)
     assert keysize in aes.AES.keySize.values(), 'invalid key size: %s' % keysize
-    data = map(ord, data)
-    moo = aes.AESModeOfOperation()
-    decr = moo.decrypt(data, None, mode, key, keysize, iv)
+    decr = cipher.decrypt(key, iv, data)
     decr = strip_PKCS7_padding(decr)
     return decr
 
@@ -175,53 +174,6 @@ def is_old_seed(seed):
     return is_hex or (uses_electrum_words and len(words) == 12)
 
 
-# pywallet openssl private key implementation
-
-def i2d_ECPrivateKey(pkey, compressed=False):
-    if compressed:
-        key = '3081d30201010420' + \
-              '%064x' % pkey.secret + \
-              'a081a53081a2020101302c06072a8648ce3d0101022100' + \
-              '%064x' % _p + \
-              '3006040100040107042102' + \
-              '%064x' % _Gx + \
-              '022100' + \
-              '%064x' % _r + \
-              '020101a124032200'
-    else:
-        key = '308201130201010420' + \
-              '%064x' % pkey.secret + \
-              'a081a53081a2020101302c06072a8648ce3d0101022100' + \
-              '%064x' % _p + \
-              '3006040100040107044104' + \
-              '%064x' % _Gx + \
-              '%064x' % _Gy + \
-              '022100' + \
-              '%064x' % _r + \
-              '020101a144034200'
-
-    return key.decode('hex') + i2o_ECPublicKey(pkey.pubkey, compressed)
-
-def i2o_ECPublicKey(pubkey, compressed=False):
-    # public keys are 65 bytes long (520 bits)
-    # 0x04 + 32-byte X-coordinate + 32-byte Y-coordinate
-    # 0x00 = point at infinity, 0x02 and 0x03 = compressed, 0x04 = uncompressed
-    # compressed keys: <sign> <x> where <sign> is 0x02 if y is even and 0x03 if y is odd
-    if compressed:
-        if pubkey.point.y() & 1:
-            key = '03' + '%064x' % pubkey.point.x()
-        else:
-            key = '02' + '%064x' % pubkey.point.x()
-    else:
-        key = '04' + \
-              '%064x' % pubkey.point.x() + \
-              '%064x' % pubkey.point.y()
-
-    return key.decode('hex')
-
-# end pywallet openssl private key implementation
-
-
 
 ############ functions from pywallet #####################
 
@@ -240,62 +192,89 @@ def public_key_to_bc_address(public_key):
     h160 = hash_160(public_key)
     return hash_160_to_bc_address(h160)
 
+# addresses recently encoded or validated, in both directions.
+# Both dicts are cleared when they are full.
+_address_cache = {}   # (addrtype, h160) -> address
+_h160_cache = {}      # address -> (addrtype, h160)
+_address_cache_size = 8192
+
+def _cache_address(addrtype, h160, addr):
+    if len(_address_cache) >= _address_cache_size:
+        _address_cache.clear()
+        _h160_cache.clear()
+    _address_cache[(addrtype, h160)] = addr
+    _h160_cache[addr] = (addrtype, h160)
+
+
 def hash_160_to_bc_address(h160, addrtype = 50):
-    vh160 = chr(addrtype) + h160
-    h = Hash(vh160)
-    addr = vh160 + h[0:4]
-    return b58encode(addr)
+    addr = _address_cache.get((addrtype, h160))
+    if addr is None:
+        vh160 = chr(addrtype) + h160
+        h = Hash(vh160)
+        addr = b58encode(vh160 + h[0:4])
+        _cache_address(addrtype, h160, addr)
+    return addr
 
 def bc_address_to_hash_160(addr):
+    cached = _h160_cache.get(addr)
+    if cached is not None:
+        return cached
     bytes = b58decode(addr, 25)
     return ord(bytes[0]), bytes[1:21]
 
 
 __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 __b58base = len(__b58chars)
+__b58values = dict((c, i) for i, c in enumerate(__b58chars))
+__b58pairs = [a + b for a in __b58chars for b in __b58chars]
+__b58pairbase = len(__b58pairs)
+
+# digits are produced and consumed 10 at a time, so that the bignum is
+# divided or multiplied once per 10 digits
+__b58chunk = __b58base**10
 
 
 def b58encode(v):
     """ encode v, which is a string of bytes, to base58."""
+    long_value = long(v.encode('hex') or '0', 16)
 
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-
-    result = ''
-    while long_value >= __b58base:
-        div, mod = divmod(long_value, __b58base)
-        result = __b58chars[mod] + result
-        long_value = div
-    result = __b58chars[long_value] + result
+    pairs = []
+    while long_value:
+        long_value, chunk = divmod(long_value, __b58chunk)
+        for i in range(5):
+            chunk, mod = divmod(chunk, __b58pairbase)
+            pairs.append(__b58pairs[mod])
+    # the last chunk is padded with zeros
+    result = ''.join(reversed(pairs)).lstrip(__b58chars[0])
 
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
+    nPad = len(v) - len(v.lstrip('\0'))
 
     return (__b58chars[0]*nPad) + result
 
 
 def b58decode(v, length):
-    """ decode v into a string of len bytes."""
+    """ decode v into a string of len bytes. Returns None if v is not
+    base58 or does not have the expected length """
+    values = __b58values
+    base = __b58base
+    # the first chunk is the shortest
+    bounds = [0] + range(len(v) % 10, len(v) + 1, 10)
     long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += __b58chars.find(c) * (__b58base**i)
+    try:
+        for i, j in zip(bounds, bounds[1:]):
+            chunk = 0
+            for c in v[i:j]:
+                chunk = chunk*base + values[c]
+            long_value = long_value*__b58chunk + chunk
+    except KeyError:
+        return None
 
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
+    result = '%x'%long_value if long_value else ''
+    result = ('0'*(len(result) & 1) + result).decode('hex')
 
-    nPad = 0
-    for c in v:
-        if c == __b58chars[0]: nPad += 1
-        else: break
+    nPad = len(v) - len(v.lstrip(__b58chars[0]))
 
     result = chr(0)*nPad + result
     if length is not None and len(result) != length:
@@ -311,6 +290,8 @@ def EncodeBase58Check(vchIn):
 
 def DecodeBase58Check(psz):
     vchRet = b58decode(psz, None)
+    if vchRet is None:
+        return None
     key = vchRet[0:-4]
     csum = vchRet[-4:]
     hash = Hash(key)
@@ -345,14 +326,6 @@ def regenerate_key(sec):
     return EC_KEY(b)
 
 
-def GetPubKey(pubkey, compressed=False):
-    return i2o_ECPublicKey(pubkey, compressed)
-
-
-def GetPrivKey(pkey, compressed=False):
-    return i2d_ECPrivateKey(pkey, compressed)
-
-
 def GetSecret(pkey):
     return ('%064x' % pkey.secret).decode('hex')
 
@@ -367,8 +340,7 @@ def public_key_from_private_key(sec):
     pkey = regenerate_key(sec)
     assert pkey
     compressed = is_compressed(sec)
-    public_key = GetPubKey(pkey.pubkey, compressed)
-    return public_key.encode('hex')
+    return pkey.get_public_key(compressed)
 
 
 def address_from_private_key(sec):
@@ -381,8 +353,11 @@ def is_valid(addr):
     return is_address(addr)
 
 
+ADDRESS_RE = re.compile('[1-9A-HJ-NP-Za-km-z]{26,}\\Z')
+
 def is_address(addr):
-    ADDRESS_RE = re.compile('[1-9A-HJ-NP-Za-km-z]{26,}\\Z')
+    if addr in _h160_cache:
+        return True
     if not ADDRESS_RE.match(addr): return False
     try:
         addrtype, h = bc_address_to_hash_160(addr)
@@ -471,50 +446,42 @@ def ser_to_point(Aser):
     return Point( curve, Mx, ECC_YfromX(Mx, curve, Aser[0]=='\x03')[0], _r )
 
 
-
-class MyVerifyingKey(ecdsa.VerifyingKey):
-    @classmethod
-    def from_signature(klass, sig, recid, h, curve):
-        """ See http://www.secg.org/download/aid-780/sec1-v2.pdf, chapter 4.1.6 """
-        from ecdsa import util, numbertheory
-        import msqr
-        curveFp = curve.curve
-        G = curve.generator
-        order = G.order()
-        # extract r,s from signature
-        r, s = util.sigdecode_string(sig, order)
-        # 1.1
-        x = r + (recid/2) * order
-        # 1.3
-        alpha = ( x * x * x  + curveFp.a() * x + curveFp.b() ) % curveFp.p()
-        beta = msqr.modular_sqrt(alpha, curveFp.p())
-        y = beta if (beta - recid) % 2 == 0 else curveFp.p() - beta
-        # 1.4 the constructor checks that nR is at infinity
-        R = Point(curveFp, x, y, order)
-        # 1.5 compute e from message:
-        e = string_to_number(h)
-        minus_e = -e % order
-        # 1.6 compute Q = r^-1 (sR - eG)
-        inv_r = numbertheory.inverse_mod(r,order)
-        Q = inv_r * ( s * R + minus_e * G )
-        return klass.from_public_point( Q, curve )
-
-
 class EC_KEY(object):
     def __init__( self, k ):
-        secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
-        self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
-        self.secret = secret
+        self.secret = string_to_number(k)
+        self._point = None
+        self._pubkey = None
+        self._privkey = None
+
+    @property
+    def point(self):
+        if self._point is None:
+            self._point = ecc.mul_G(self.secret)
+        return self._point
+
+    # ecdsa objects, for callers that expect them. Public_key checks
+    # its point with a scalar multiplication, so they are built once
+    @property
+    def pubkey(self):
+        if self._pubkey is None:
+            x, y = self.point
+            self._pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, Point(curve_secp256k1, x, y, generator_secp256k1.order()) )
+        return self._pubkey
+
+    @property
+    def privkey(self):
+        if self._privkey is None:
+            self._privkey = ecdsa.ecdsa.Private_key( self.pubkey, self.secret )
+        return self._privkey
 
     def get_public_key(self, compressed=True):
-        return point_to_ser(self.pubkey.point, compressed).encode('hex')
+        return ecc.encode_point(self.point, compressed).encode('hex')
 
     def sign_message(self, message, compressed, address):
-        private_key = ecdsa.SigningKey.from_secret_exponent( self.secret, curve = SECP256k1 )
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic( Hash( msg_magic(message) ), hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string )
-        assert public_key.verify_digest( signature, Hash( msg_magic(message) ), sigdecode = ecdsa.util.sigdecode_string)
+        h = Hash( msg_magic(message) )
+        r, s = ecc.sign(self.secret, h)
+        assert ecc.verify(self.point, h, r, s)
+        signature = ecdsa.util.sigencode_string(r, s, ecc.N)
         for i in range(4):
             sig = base64.b64encode( chr(27 + i + (4 if compressed else 0)) + signature )
             try:
@@ -542,13 +509,15 @@ class EC_KEY(object):
 
         recid = nV - 27
         h = Hash( msg_magic(message) )
-        public_key = MyVerifyingKey.from_signature( sig[1:], recid, h, curve = SECP256k1 )
+        r, s = ecdsa.util.sigdecode_string(sig[1:], ecc.N)
+        public_key = ecc.recover(h, r, s, recid)
 
         # check public key
-        public_key.verify_digest( sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
+        if public_key is None or not ecc.verify(public_key, h, r, s):
+            raise Exception("Bad signature")
 
         # check that we get the original signing address
-        addr = public_key_to_bc_address( point_to_ser(public_key.pubkey.point, compressed) )
+        addr = public_key_to_bc_address( ecc.encode_point(public_key, compressed) )
         if address != addr:
             raise Exception("Bad signature")
 
@@ -558,13 +527,14 @@ class EC_KEY(object):
     @classmethod
     def encrypt_message(self, message, pubkey):
 
-        pk = ser_to_point(pubkey)
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, pk.x(), pk.y()):
+        try:
+            pk = ecc.decode_point(pubkey)
+        except ValueError:
             raise Exception('invalid pubkey')
 
         ephemeral_exponent = number_to_string(ecdsa.util.randrange(pow(2,256)), generator_secp256k1.order())
         ephemeral = EC_KEY(ephemeral_exponent)
-        ecdh_key = point_to_ser(pk * ephemeral.privkey.secret_multiplier)
+        ecdh_key = ecc.encode_point(ecc.mul(pk, ephemeral.secret))
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         ciphertext = aes_encrypt_with_iv(key_e, iv, message)
@@ -591,14 +561,11 @@ class EC_KEY(object):
             raise Exception('invalid ciphertext: invalid magic bytes')
 
         try:
-            ephemeral_pubkey = ser_to_point(ephemeral_pubkey)
-        except AssertionError, e:
-            raise Exception('invalid ciphertext: invalid ephemeral pubkey')
-
-        if not ecdsa.ecdsa.point_is_valid(generator_secp256k1, ephemeral_pubkey.x(), ephemeral_pubkey.y()):
+            ephemeral_pubkey = ecc.decode_point(ephemeral_pubkey)
+        except ValueError:
             raise Exception('invalid ciphertext: invalid ephemeral pubkey')
 
-        ecdh_key = point_to_ser(ephemeral_pubkey * self.privkey.secret_multiplier)
+        ecdh_key = ecc.encode_point(ecc.mul(ephemeral_pubkey, self.secret))
         key = hashlib.sha512(ecdh_key).digest()
         iv, key_e, key_m = key[0:16], key[16:32], key[32:]
         if mac != hmac.new(key_m, encrypted[:-32], hashlib.sha256).digest():
@@ -615,10 +582,9 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    point = ecc.mul_G(string_to_number(secret))
+    K = ecc.encode_point(point, False)[1:]
+    K_compressed = ecc.encode_point(point, True)
     return K, K_compressed
 
 
@@ -639,7 +605,7 @@ def _CKD_priv(k, c, s, is_prime):
     from ecdsa.util import string_to_number, number_to_string
     order = generator_secp256k1.order()
     keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
+    cK = keypair.get_public_key(True).decode('hex')
     data = chr(0) + k + s if is_prime else cK + s
     I = hmac.new(c, data, hashlib.sha512).digest()
     k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
@@ -662,14 +628,42 @@ def _CKD_pub(cK, c, s):
     from ecdsa.util import string_to_number, number_to_string
     order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    pubkey_point = ecc.add(ecc.mul_G(string_to_number(I[0:32])), ecc.decode_point(cK))
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
+    cK_n = ecc.encode_point(pubkey_point, True)
     return cK_n, c_n
 
 
+class PublicNode(object):
+    """ BIP32 public key and chain code, with the key decoded once.
+    Children are derived like CKD_pub, without decoding the parent again """
+
+    def __init__(self, cK, c, point=None):
+        self.cK = cK
+        self.c = c
+        self.point = point if point is not None else ecc.decode_point(cK)
+
+    @classmethod
+    def from_xpub(klass, xpub):
+        _, _, _, c, cK = deserialize_xkey(xpub)
+        return klass(cK, c)
+
+    def tweak(self, n):
+        if n & BIP32_PRIME: raise BaseException("cannot derive a hardened key from a public key")
+        I = hmac.new(self.c, self.cK + rev_hex(int_to_hex(n,4)).decode('hex'), hashlib.sha512).digest()
+        return string_to_number(I[0:32]), I[32:]
+
+    def child(self, n):
+        k, c = self.tweak(n)
+        point = ecc.add(ecc.mul_G(k), self.point)
+        return PublicNode(ecc.encode_point(point, True), c, point)
+
+    def derive_range(self, start, count):
+        """ compressed public keys of children start to start + count - 1 """
+        tweaks = [self.tweak(n)[0] for n in range(start, start + count)]
+        return [ecc.encode_point(point, True) for point in ecc.mul_G_add(tweaks, self.point)]
+
+
 BITCOIN_HEADER_PRIV = "0488ade4"
 BITCOIN_HEADER_PUB = "0488b21e"
 
@@ -17,9 +17,342 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading, time, Queue, os, sys, shutil
+import threading, time, Queue, os, sys, shutil, mmap, multiprocessing, json, hashlib
+from collections import OrderedDict, deque
 from util import user_dir, appdata_dir, print_error
 from bitcoin import *
+from checkpoints import load_checkpoints
+
+
+def hash_raw_headers(data):
+    """ double SHA-256 of consecutive 80 byte headers. This runs in
+    worker processes when parallel verification is enabled. """
+    return [Hash(data[k:k+80]) for k in range(0, len(data), 80)]
+
+
+class HeaderStore(object):
+    """ Memory-mapped view of the blockchain_headers file.
+
+    Raw headers are read from a read-only mmap of the file, which is
+    remapped when the file grows. Decoded headers are kept in a bounded
+    LRU cache; callers must treat them as read-only. All writes go
+    through the store, so that the cache and the mapping stay coherent.
+
+    The store also maintains a sidecar index of block hashes: 32 bytes
+    per height, in internal byte order. It is written after the headers
+    it indexes, and repaired from them by recover(). Reverse lookups go
+    through a dict from hash prefix to height, built from the sidecar
+    on the first lookup and kept up to date by writes and truncation.
+    """
+
+    def __init__(self, path, deserialize, cache_size=4096):
+        self.path = path
+        self.deserialize = deserialize
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.cache = OrderedDict()
+        self.map = None
+        self.size = 0
+        self.hash_map = None
+        self.hash_size = 0
+        self.hash_index = None
+
+    def hashes_path(self):
+        return self.path + '.hashes'
+
+    def _unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.size = 0
+        if self.hash_map is not None:
+            self.hash_map.close()
+            self.hash_map = None
+        self.hash_size = 0
+
+    def _map_file(self, path):
+        if not os.path.exists(path):
+            return None, 0
+        size = os.path.getsize(path)
+        if size == 0:
+            return None, 0
+        # mmap keeps its own handle on the file
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), size
+
+    def _remap(self):
+        self._unmap()
+        self.map, self.size = self._map_file(self.path)
+        self.hash_map, self.hash_size = self._map_file(self.hashes_path())
+
+    def close(self):
+        with self.lock:
+            self._unmap()
+            self.cache.clear()
+            self.hash_index = None
+
+    def read_raw(self, height):
+        if height < 0:
+            return
+        start = height*80
+        with self.lock:
+            if start + 80 > self.size:
+                # the file may have grown since it was mapped
+                self._remap()
+                if start + 80 > self.size:
+                    return
+            return self.map[start:start+80]
+
+    def read(self, height):
+        with self.lock:
+            header = self.cache.pop(height, None)
+            if header is None:
+                raw = self.read_raw(height)
+                if raw is None:
+                    return
+                header = self.deserialize(raw)
+            self.cache[height] = header
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return header
+
+    def read_hash(self, height):
+        """ raw hash of the header at height, or None if not indexed """
+        if height < 0:
+            return
+        start = height*32
+        with self.lock:
+            if start + 32 > self.hash_size:
+                self._remap()
+                if start + 32 > self.hash_size:
+                    return
+            return self.hash_map[start:start+32]
+
+    def find_hash(self, digest):
+        """ height of the header with raw hash digest, or None """
+        with self.lock:
+            if self.hash_index is None:
+                self._remap()
+                self.hash_index = {}
+                for start in xrange(0, self.hash_size, 32):
+                    self.hash_index[self.hash_map[start:start+8]] = start/32
+            height = self.hash_index.get(digest[:8])
+            if height is None:
+                return
+            if self.read_hash(height) == digest:
+                return height
+            # two hashes share a prefix
+            return self.scan_hash(digest)
+
+    def scan_hash(self, digest):
+        """ find_hash by a search of the whole index, from the tip """
+        with self.lock:
+            if self.hash_map is None:
+                self._remap()
+                if self.hash_map is None:
+                    return
+            end = self.hash_size
+            while True:
+                pos = self.hash_map.rfind(digest, 0, end)
+                if pos < 0:
+                    return
+                if pos % 32 == 0:
+                    return pos/32
+                # match across two entries
+                end = pos + 31
+
+    def write_hashes(self, height, data, digests=None, sync=False):
+        path = self.hashes_path()
+        indexed = os.path.getsize(path)/32 if os.path.exists(path) else 0
+        if height > indexed:
+            # the index has a gap; rebuild_hashes will fill it
+            return
+        if digests is None:
+            digests = hash_raw_headers(data)
+        if self.hash_index is not None:
+            self.forget_hashes(height, min(indexed, height + len(digests)))
+            for i, digest in enumerate(digests):
+                self.hash_index[digest[:8]] = height + i
+        with open(path, 'rb+' if os.path.exists(path) else 'wb') as f:
+            f.seek(height*32)
+            f.write(''.join(digests))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def forget_hashes(self, start, end):
+        """ drop the index entries of heights start to end - 1 """
+        if end <= start:
+            return
+        with open(self.hashes_path(), 'rb') as f:
+            f.seek(start*32)
+            data = f.read((end - start)*32)
+        for i in range(len(data)/32):
+            prefix = data[i*32:i*32+8]
+            if self.hash_index.get(prefix) == start + i:
+                del self.hash_index[prefix]
+
+    def write(self, height, data, digests=None):
+        assert len(data) % 80 == 0
+        with self.lock:
+            with open(self.path, 'rb+') as f:
+                f.seek(height*80)
+                f.write(data)
+            self.write_hashes(height, data, digests)
+            for h in range(height, height + len(data)/80):
+                self.cache.pop(h, None)
+            self._remap()
+
+    def journal_path(self):
+        return self.path + '.pending'
+
+    def commit(self, height, data, digests=None):
+        """ write several headers in one go. The range is recorded in a
+        journal first, so that a write interrupted by a crash can be
+        detected and discarded by recover() """
+        with self.lock:
+            with open(self.journal_path(), 'wb') as f:
+                f.write("%d %d"%(height, len(data)/80))
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.path, 'rb+') as f:
+                f.seek(height*80)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.write_hashes(height, data, digests, sync=True)
+            os.remove(self.journal_path())
+            for h in range(height, height + len(data)/80):
+                self.cache.pop(h, None)
+            self._remap()
+
+    def recover(self):
+        """ truncate a partially written commit, or a partial header, and
+        bring the hash index in line with the headers """
+        with self.lock:
+            size = os.path.getsize(self.path)
+            height = size/80
+            if os.path.exists(self.journal_path()):
+                with open(self.journal_path(), 'rb') as f:
+                    try:
+                        height = min(height, int(f.read().split()[0]))
+                    except (ValueError, IndexError):
+                        pass
+                print_error("discarding interrupted header write at height", height)
+            if height*80 != size:
+                self.truncate(height)
+            if os.path.exists(self.journal_path()):
+                os.remove(self.journal_path())
+            self.rebuild_hashes()
+
+    def rebuild_hashes(self):
+        """ truncate the hash index to the headers, and hash the headers
+        it is missing. The last entry is always recomputed, because a
+        single header write does not go through the journal """
+        with self.lock:
+            num = os.path.getsize(self.path)/80
+            if os.path.exists(self.hashes_path()):
+                indexed = min(os.path.getsize(self.hashes_path())/32, num)
+            else:
+                indexed = 0
+            start = max(indexed - 1, 0)
+            # built again on the next lookup
+            self.hash_index = None
+            self._unmap()
+            with open(self.hashes_path(), 'rb+' if indexed else 'wb') as f:
+                f.seek(start*32)
+                f.truncate()
+            if num - start > 1:
+                print_error("indexing block hashes from height", start)
+            with open(self.path, 'rb') as f:
+                f.seek(start*80)
+                height = start
+                while height < num:
+                    # a chunk at a time, to bound memory use
+                    data = f.read(min(2016, num - height)*80)
+                    self.write_hashes(height, data)
+                    height += len(data)/80
+            self._remap()
+
+    def truncate(self, height):
+        with self.lock:
+            # a mapped file cannot be truncated on some platforms
+            self._unmap()
+            with open(self.path, 'rb+') as f:
+                f.seek(height*80)
+                f.truncate()
+            if os.path.exists(self.hashes_path()):
+                if self.hash_index is not None:
+                    self.forget_hashes(height, os.path.getsize(self.hashes_path())/32)
+                with open(self.hashes_path(), 'rb+') as f:
+                    f.seek(height*32)
+                    f.truncate()
+            for h in [h for h in self.cache.keys() if h >= height]:
+                self.cache.pop(h)
+            self._remap()
+
+
+class DGW3Window(object):
+    """ Sliding window of (timestamp, target) for the last 24 blocks.
+
+    Computes DarkGravityWave v3 targets for consecutive heights without
+    reading or decoding past headers again. Results are identical to
+    Blockchain.get_target_dgw3.
+    """
+    past_blocks = 24
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.blocks = deque(maxlen=self.past_blocks)
+        self.next_height = None
+
+    def push(self, height, header):
+        if height != self.next_height:
+            self.blocks.clear()
+        target = self.blockchain.bits_to_target(header.get('bits'))
+        self.blocks.append((header.get('timestamp'), target))
+        self.next_height = height + 1
+
+    def prime(self, height, chain):
+        self.blocks.clear()
+        self.next_height = None
+        for h in range(height - self.past_blocks, height):
+            header = self.blockchain.header_at(h, chain)
+            if header is None:
+                self.blocks.clear()
+                return
+            self.push(h, header)
+
+    def get_target(self, block_height, chain=None):
+        if chain is None:
+            chain = {}
+        if block_height - 1 < self.past_blocks:
+            return self.blockchain.get_target_dgw3(block_height, chain)
+        if block_height != self.next_height or len(self.blocks) < self.past_blocks:
+            self.prime(block_height, chain)
+            if not self.blocks:
+                return self.blockchain.get_target_dgw3(block_height, chain)
+
+        max_target = 0x00000FFFF0000000000000000000000000000000000000000000000000000000
+        # same rounding as get_target_dgw3, newest block first
+        PastDifficultyAverage = 0
+        CountBlocks = 0
+        for timestamp, target in reversed(self.blocks):
+            CountBlocks += 1
+            if CountBlocks == 1:
+                PastDifficultyAverage = target
+            else:
+                PastDifficultyAverage = ((PastDifficultyAverage * CountBlocks) + target) / (CountBlocks + 1)
+
+        nActualTimespan = self.blocks[-1][0] - self.blocks[0][0]
+        nTargetTimespan = CountBlocks * 120
+        nActualTimespan = max(nActualTimespan, nTargetTimespan/3)
+        nActualTimespan = min(nActualTimespan, nTargetTimespan*3)
+
+        bnNew = PastDifficultyAverage * nActualTimespan
+        bnNew /= nTargetTimespan
+        bnNew = min(bnNew, max_target)
+        return self.blockchain.target_to_bits(bnNew), bnNew
 
 
 class Blockchain(threading.Thread):
@@ -34,9 +367,24 @@ class Blockchain(threading.Thread):
         self.running = False
         # TODO Change for tate
         self.headers_url = ''#'http://headers.electrum.org/blockchain_headers'
+        self.store = HeaderStore(self.path(), self.header_from_string)
         self.set_local_height()
         self.queue = Queue.Queue()
         self.chunk_size = 2016 # number of headers in a chunk
+        self.max_pending_chunks = config.get('max_pending_chunks', 4)
+        self.pool = None
+        try:
+            self.checkpoints = load_checkpoints(config.get('checkpoints_file'))
+        except (IOError, ValueError, TypeError) as e:
+            print_error("cannot load checkpoints:", e)
+            self.checkpoints = load_checkpoints()
+        self.use_checkpoints = not config.get('full_verification', False)
+        self.chunk_timeout = 30
+        # how far back get_chain looks for a fork point
+        self.max_reorg_depth = config.get('max_reorg_depth', self.chunk_size)
+        self.header_batch_size = 16
+        # (bits, target) of pre-DGW heights, indexed by retarget interval
+        self.v1_targets = {}
 
     
     def height(self):
@@ -45,6 +393,10 @@ class Blockchain(threading.Thread):
 
     def stop(self):
         with self.lock: self.running = False
+        self.store.close()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
 
 
     def is_running(self):
@@ -82,18 +434,21 @@ class Blockchain(threading.Thread):
 
             if height > self.local_height:
                 # get missing parts from interface (until it connects to my chain)
+                local_height = self.local_height
                 chain = self.get_chain( i, header )
 
                 # skip that server if the result is not consistent
                 if not chain: 
                     print_error('e')
+                    if self.local_height < local_height:
+                        # rolled back below a deep fork: sync by chunks
+                        self.queue.put((i, header))
                     continue
                 
                 # verify the chain
                 if self.verify_chain( chain ):
                     print_error("height:", height, i.server)
-                    for header in chain:
-                        self.save_header(header)
+                    self.save_chain(chain)
                 else:
                     print_error("error", i.server)
                     # todo: dismiss that server
@@ -108,23 +463,29 @@ class Blockchain(threading.Thread):
     def verify_chain(self, chain):
 
         first_header = chain[0]
-        prev_header = self.read_header(first_header.get('block_height') -1)
-        
+        prev_hash = self.get_block_hash(first_header.get('block_height') -1)
+        if first_header.get('block_height') <= self.local_height:
+            # headers are about to be replaced
+            self.forget_targets(first_header.get('block_height'))
+        pending = dict((header.get('block_height'), header) for header in chain)
+        window = DGW3Window(self)
+
         for header in chain:
 
             height = header.get('block_height')
 
-            prev_hash = self.hash_header(prev_header)
-            bits, target = self.get_target(height, chain)
+            bits, target = self.get_target(height, pending, window)
             _hash = self.hash_header(header)
             try:
                 assert prev_hash == header.get('prev_block_hash')
                 assert bits == header.get('bits')
                 assert int('0x'+_hash,16) < target
             except Exception:
+                self.forget_targets(first_header.get('block_height'))
                 return False
 
-            prev_header = header
+            prev_hash = _hash
+            window.push(height, header)
 
         return True
 
@@ -134,35 +495,88 @@ class Blockchain(threading.Thread):
         data = hexdata.decode('hex')
         height = index*self.chunk_size
         num = len(data)/80
+        # verified headers are kept in memory and committed in one write
+        pending = {}
+        window = DGW3Window(self)
 
         if index == 0:  
             previous_hash = ("0"*64)
         else:
-            prev_header = self.read_header(index*self.chunk_size-1)
-            if prev_header is None: raise
-            previous_hash = self.hash_header(prev_header)
+            previous_hash = self.get_block_hash(index*self.chunk_size-1)
+            if previous_hash is None: raise
+        previous_digest = hash_decode(previous_hash)
+
+        if height <= self.local_height:
+            # headers are about to be replaced
+            self.forget_targets(height)
 
-#        bits, target = self.get_target(index)
+        # proof of work is checked on the raw headers
+        digests = self.hash_headers(data[:num*80])
+
+        checkpoint = self.get_checkpoint(index, num)
+        if checkpoint is not None:
+            self.verify_chunk_linkage(index, data, digests, previous_digest, checkpoint)
+            return
 
         for i in range(num):
             height = index*self.chunk_size + i
-            bits, target = self.get_target(height)
+            bits, target = self.get_target(height, pending, window)
             raw_header = data[i*80:(i+1)*80]
             header = self.header_from_string(raw_header)
-            _hash = self.hash_header(header)
-            assert previous_hash == header.get('prev_block_hash')
-            assert bits == header.get('bits')
-            assert int('0x'+_hash,16) < target
+            try:
+                assert previous_digest == raw_header[4:36]
+                assert bits == header.get('bits')
+                assert int(hash_encode(digests[i]), 16) < target
+            except AssertionError:
+                self.forget_targets(index*self.chunk_size)
+                raise
 
-            self.save_header(header, height)
-            previous_header = header
-            previous_hash = _hash 
+            pending[height] = header
+            window.push(height, header)
+            previous_digest = digests[i]
 
-#        self.save_chunk(index, data)
+        self.save_chunk(index, data[:num*80], digests)
         print_error("validated chunk %d"%height)
 
         
 
+    def get_checkpoint(self, index, num):
+        """ checkpoint that closes a complete chunk, if it can be used """
+        if not self.use_checkpoints or num != self.chunk_size:
+            return
+        return self.checkpoints.get((index + 1)*self.chunk_size - 1)
+
+    def verify_chunk_linkage(self, index, data, digests, previous_digest, checkpoint):
+        """ fast sync: check hash linkage up to a checkpoint """
+        num = len(digests)
+        for i in range(num):
+            assert previous_digest == data[i*80+4:i*80+36]
+            previous_digest = digests[i]
+        _hash, bits = checkpoint
+        last_header = self.header_from_string(data[(num-1)*80:num*80])
+        assert hash_encode(previous_digest) == _hash
+        assert last_header.get('bits') == bits
+        self.save_chunk(index, data[:num*80], digests)
+        print_error("validated chunk %d against checkpoint"%((index + 1)*self.chunk_size - 1))
+
+    def get_pool(self):
+        """ process pool used to hash chunks, if parallel verification
+        is enabled and there is more than one core """
+        if self.pool is None and self.config.get('parallel_verification', False):
+            if multiprocessing.cpu_count() > 1:
+                self.pool = multiprocessing.Pool()
+        return self.pool
+
+    def hash_headers(self, data):
+        pool = self.get_pool()
+        if pool is None or not data:
+            return hash_raw_headers(data)
+        num = len(data)/80
+        n = multiprocessing.cpu_count()
+        size = max(80*((num + n - 1)/n), 80)
+        slices = [data[k:k+size] for k in range(0, len(data), size)]
+        return sum(pool.map(hash_raw_headers, slices), [])
+
     def header_to_string(self, res):
         s = int_to_hex(res.get('version'),4) \
             + rev_hex(res.get('prev_block_hash')) \
@@ -193,8 +607,9 @@ class Blockchain(threading.Thread):
     def init_headers_file(self):
         filename = self.path()
         if os.path.exists(filename):
+            self.store.recover()
             return
-        
+
         try:
             import urllib, socket
             socket.setdefaulttimeout(30)
@@ -205,26 +620,106 @@ class Blockchain(threading.Thread):
             print_error( "download failed. creating file", filename )
             open(filename,'wb+').close()
 
-    def save_chunk(self, index, chunk):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*self.chunk_size*80)
-        h = f.write(chunk)
-        f.close()
+    def export_snapshot(self, dirname):
+        """ copy the verified headers to dirname, with a manifest. The
+        headers file is only read, so that a running daemon can go on
+        writing it: only whole headers are copied, and none from a
+        commit in progress """
+        num = os.path.getsize(self.path())/80
+        journal = self.store.journal_path()
+        if os.path.exists(journal):
+            try:
+                with open(journal, 'rb') as f:
+                    num = min(num, int(f.read().split()[0]))
+            except (IOError, ValueError, IndexError):
+                pass
+        filename = os.path.join(dirname, 'blockchain_headers')
+        sha = hashlib.sha256()
+        hashes = []
+        height = -1
+        with open(self.path(), 'rb') as f, open(filename, 'wb') as out:
+            for index in range((num + self.chunk_size - 1)/self.chunk_size):
+                data = f.read(min(self.chunk_size, num - index*self.chunk_size)*80)
+                # the file may be truncated by a reorg while it is read
+                data = data[:len(data) - len(data)%80]
+                if not data:
+                    break
+                out.write(data)
+                sha.update(data)
+                height = len(data)/80 - 1 + index*self.chunk_size
+                hashes.append((height, self.hash_header(self.header_from_string(data[-80:]))))
+                if len(data) < self.chunk_size*80:
+                    break
+        manifest = {'height': height, 'sha256': sha.hexdigest(), 'hashes': hashes}
+        with open(filename + '.manifest', 'w') as f:
+            f.write(json.dumps(manifest, indent=4))
+        return manifest
+
+    def import_snapshot(self, dirname):
+        """ import headers exported by export_snapshot. Hash linkage is
+        checked in bulk first, then chunks are fully verified one at a
+        time while they are written """
+        filename = os.path.join(dirname, 'blockchain_headers')
+        with open(filename + '.manifest', 'r') as f:
+            manifest = json.loads(f.read())
+        num = manifest['height'] + 1
+        if os.path.getsize(filename) != num*80:
+            raise BaseException("snapshot size does not match manifest")
+        expected = dict(manifest['hashes'])
+
+        sha = hashlib.sha256()
+        previous_digest = hash_decode("0"*64)
+        with open(filename, 'rb') as f:
+            for index in range((num + self.chunk_size - 1)/self.chunk_size):
+                data = f.read(self.chunk_size*80)
+                sha.update(data)
+                digests = hash_raw_headers(data)
+                for i, digest in enumerate(digests):
+                    if data[i*80+4:i*80+36] != previous_digest:
+                        raise BaseException("broken hash linkage at height %d"%(index*self.chunk_size + i))
+                    previous_digest = digest
+                    height = index*self.chunk_size + i
+                    if height in expected and hash_encode(digest) != expected[height]:
+                        raise BaseException("hash mismatch with manifest at height %d"%height)
+        if sha.hexdigest() != manifest['sha256']:
+            raise BaseException("snapshot checksum does not match manifest")
+
+        self.init_headers_file()
+        self.set_local_height()
+        if num - 1 <= self.local_height:
+            return self.local_height
+        with open(filename, 'rb') as f:
+            for index in range((num + self.chunk_size - 1)/self.chunk_size):
+                data = f.read(self.chunk_size*80)
+                self.verify_chunk(index, data.encode('hex'))
+        return self.local_height
+
+    def save_chunk(self, index, chunk, digests=None):
+        self.store.commit(index*self.chunk_size, chunk, digests)
         self.set_local_height()
 
     def save_header(self, header, height=None):
         data = self.header_to_string(header).decode('hex')
         assert len(data) == 80
         if height is None: height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
+        self.store.write(height, data)
         self.set_local_height()
 
 
+    def save_chain(self, chain):
+        """ write verified headers. A divergent local branch above the
+        first header is replaced in a single commit """
+        height = chain[0].get('block_height')
+        reorg = height <= self.local_height
+        data = ''.join(self.header_to_string(header).decode('hex') for header in chain)
+        self.store.commit(height, data)
+        self.set_local_height()
+        if reorg:
+            print_error("replaced headers from height", height)
+            self.forget_targets(height)
+            if self.network is not None:
+                self.network.blockchain_reorg(height)
+
     def set_local_height(self):
         name = self.path()
         if os.path.exists(name):
@@ -235,22 +730,42 @@ class Blockchain(threading.Thread):
     def roll_back_to_last_chunk(self):
         name = self.path()
         if os.path.exists(name):
-            f = open(name,'rb+')
-            f.seek((self.local_height*80) - 8000)
-            f.truncate()
-            f.close()
+            height = max(self.local_height - 100, 0)
+            self.store.truncate(height)
+            self.forget_targets(height)
         self.set_local_height()
 
+    def roll_back_to_chunk(self, height):
+        """ truncate the local chain to the start of the chunk that
+        contains height """
+        height = height - height % self.chunk_size
+        if height <= self.local_height:
+            print_error("rolling back to height", height)
+            self.store.truncate(height)
+            self.forget_targets(height)
+        self.set_local_height()
+
+    def forget_targets(self, height):
+        """ drop cached targets that depend on headers from height on """
+        for h in [h for h in self.v1_targets.keys() if h >= height]:
+            self.v1_targets.pop(h)
+
     def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h 
+        return self.store.read(block_height)
+
+    def get_block_hash(self, block_height):
+        """ hash of the local header at block_height, or None """
+        digest = self.store.read_hash(block_height)
+        if digest is not None:
+            return hash_encode(digest)
+        # the index may lag behind the headers until recover() runs
+        header = self.read_header(block_height)
+        if header is not None:
+            return self.hash_header(header)
+
+    def get_block_height(self, block_hash):
+        """ height of the local header with hash block_hash, or None """
+        return self.store.find_hash(hash_decode(block_hash))
 
     def bits_to_target(self, bits):
         MM = 256*256*256
@@ -277,6 +792,13 @@ class Blockchain(threading.Thread):
         return new_bits
 
 
+    def header_at(self, height, chain):
+        # headers being verified take precedence over the headers file
+        header = chain.get(height)
+        if header is None:
+            header = self.read_header(height)
+        return header
+
     def get_target_v1(self, block_height, chain=None):
         # params
         nTargetTimespan = 8 * 60
@@ -291,7 +813,7 @@ class Blockchain(threading.Thread):
 
 
         if chain is None:
-            chain = []  # Do not use mutables as default values!
+            chain = {}  # Do not use mutables as default values!
 
 # btc        max_target = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
         max_target = 0x00000FFFF0000000000000000000000000000000000000000000000000000000
@@ -301,24 +823,18 @@ class Blockchain(threading.Thread):
         start_target = 0x00000003FFFF0000000000000000000000000000000000000000000000000000
         if block_height < nAveragingInterval: return 0x1d03ffff, start_target
 
-        last = self.read_header(block_height-1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == block_height-1:
-                    last = h
-
-
         # Only change on each interval
         if not block_height % interval == 0:
-            return self.get_target_v1(block_height-1, chain)
+            return self.get_target_v1(block_height - block_height % interval, chain)
+
+        if block_height in self.v1_targets:
+            return self.v1_targets[block_height]
+
+        last = self.header_at(block_height-1, chain)
 
 
         # first = go back by averagingInterval
-        first = self.read_header((block_height-1)-(nAveragingInterval-1))
-        if first is None:
-            for fh in chain:
-                if fh.get('block_height') == (block_height-1)-(nAveragingInterval-1):
-                    first = fh
+        first = self.header_at((block_height-1)-(nAveragingInterval-1), chain)
 
   
         nActualTimespan = last.get('timestamp') - first.get('timestamp')
@@ -349,17 +865,14 @@ class Blockchain(threading.Thread):
             i += 1
 
         new_bits = c + MM * i
+        self.v1_targets[block_height] = new_bits, new_target
         return new_bits, new_target
 
     def get_target_dgw3(self, block_height, chain=None):
         if chain is None:
-            chain = []
+            chain = {}
 
-        last = self.read_header(block_height-1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == block_height-1:
-                    last = h
+        last = self.header_at(block_height-1, chain)
 
         # params
         BlockLastSolved = last
@@ -394,11 +907,7 @@ class Blockchain(threading.Thread):
                 nActualTimespan += Diff
             LastBlockTime = BlockReading.get('timestamp')
 
-            BlockReading = self.read_header((block_height-1) - CountBlocks)
-            if BlockReading is None:
-                for br in chain:
-                    if br.get('block_height') == (block_height-1) - CountBlocks:
-                        BlockReading = br
+            BlockReading = self.header_at((block_height-1) - CountBlocks, chain)
 
         bnNew = PastDifficultyAverage
         nTargetTimespan = CountBlocks * 120
@@ -415,15 +924,20 @@ class Blockchain(threading.Thread):
         new_bits = self.target_to_bits(bnNew)
         return new_bits, bnNew
 
-    def get_target(self, block_height, chain=None):
+    def get_target(self, block_height, chain=None, window=None):
+        # chain maps heights to headers that are not saved yet.
+        # window is an optional DGW3Window, for sequential verification
         if chain is None:
-            chain = []  # Do not use mutables as default values!
+            chain = {}  # Do not use mutables as default values!
 
         DiffMode = 1
         if block_height >= 100000: DiffMode = 2
 
         if DiffMode == 1: return self.get_target_v1(block_height, chain)
-        elif DiffMode == 2: return self.get_target_dgw3(block_height, chain)
+        elif DiffMode == 2:
+            if window is not None:
+                return window.get_target(block_height, chain)
+            return self.get_target_dgw3(block_height, chain)
         
         return self.get_target_dgw3(block_height, chain)
 
@@ -443,41 +957,100 @@ class Blockchain(threading.Thread):
             result = r['result']
             return result
 
-    def get_chain(self, interface, final_header):
+    def request_headers(self, i, heights, queue):
+        """ request several headers at once. Returns them indexed by
+        height, or None if the server did not send all of them """
+        for h in heights:
+            self.request_header(i, h, queue)
+        headers = {}
+        while len(headers) < len(heights):
+            if not self.is_running(): return
+            header = self.retrieve_request(queue)
+            if not header: return
+            headers[header.get('block_height')] = header
+        if sorted(headers.keys()) != sorted(heights):
+            return
+        return headers
 
-        header = final_header
-        chain = [ final_header ]
-        requested_header = False
+    def get_chain(self, interface, final_header):
+        """ headers of the server's branch, from its fork point with the
+        local chain up to final_header. Missing headers are requested in
+        batches. If the branch does not connect to the local tip, it is
+        walked back against the local hash index until a common block is
+        found; only the headers above that block are returned. Returns
+        None if the server is inconsistent or the fork is too deep. In
+        the latter case the local chain is rolled back to a chunk
+        boundary below the search, to be synchronized again by chunks """
+
+        final_height = final_header.get('block_height')
+        height = final_height
+        chain = { height: final_header }
+        hashes = { height: self.hash_header(final_header) }
+        batch = self.header_batch_size
         queue = Queue.Queue()
 
         while self.is_running():
 
-            if requested_header:
-                header = self.retrieve_request(queue)
-                if not header: return
-                chain = [ header ] + chain
-                requested_header = False
-
-            height = header.get('block_height')
-            previous_header = self.read_header(height -1)
-            if not previous_header:
-                self.request_header(interface, height - 1, queue)
-                requested_header = True
-                continue
-
-            # verify that it connects to my chain
-            prev_hash = self.hash_header(previous_header)
-            if prev_hash != header.get('prev_block_hash'):
-                print_error("reorg")
-                self.roll_back_to_last_chunk()
-#                self.request_header(interface, height - 1, queue)
-#                requested_header = True
-                return None
+            prev_hash = self.get_block_hash(height - 1)
+            if prev_hash == chain[height].get('prev_block_hash'):
+                # the chain is complete
+                return [chain[h] for h in range(height, final_height + 1)]
 
+            if height - 1 > self.local_height:
+                # headers are missing between my tip and the server's
+                low = self.local_height + 1
             else:
-                # the chain is complete
-                return chain
+                print_error("looking for a fork point below height", height, interface.server)
+                low = height - batch
+                batch *= 2
+            low = max(low, final_height - self.max_reorg_depth, 0)
+            if low >= height:
+                print_error("fork point is too deep", interface.server)
+                self.roll_back_to_chunk(max(final_height - self.max_reorg_depth, 0))
+                return
+
+            headers = self.request_headers(interface, range(low, height), queue)
+            if headers is None:
+                return
+            for h in range(height - 1, low - 1, -1):
+                _hash = self.hash_header(headers[h])
+                if _hash != chain[h+1].get('prev_block_hash'):
+                    print_error("inconsistent headers from", interface.server)
+                    return
+                chain[h] = headers[h]
+                hashes[h] = _hash
+
+            # the branch starts above the highest block we have in common
+            for h in range(height - 1, low - 1, -1):
+                if hashes[h] == self.get_block_hash(h):
+                    height = h + 1
+                    break
+            else:
+                height = low
+
 
+    def get_chunk_interfaces(self, i, index):
+        """ connected interfaces that should be able to serve a chunk """
+        interfaces = [i]
+        if self.network is not None:
+            for x in self.network.interfaces.values():
+                if x == i or not x.is_connected:
+                    continue
+                if self.network.heights.get(x.server, 0) >= index*self.chunk_size:
+                    interfaces.append(x)
+        return interfaces
+
+    def request_chunk(self, i, index, exclude, queue):
+        interfaces = self.get_chunk_interfaces(i, index)
+        candidates = filter(lambda x: x.server not in exclude, interfaces)
+        if not candidates:
+            # every server failed once, give them another chance
+            candidates = interfaces
+        # spread consecutive chunks over the available servers
+        interface = candidates[index % len(candidates)]
+        print_error("requesting chunk %d from %s"%(index, interface.server))
+        interface.send_request({'method':'blockchain.block.get_chunk', 'params':[index]}, queue)
+        return interface
 
     def get_and_verify_chunks(self, i, header, height):
 
@@ -485,18 +1058,60 @@ class Blockchain(threading.Thread):
         min_index = (self.local_height + 1)/self.chunk_size
         max_index = (height + 1)/self.chunk_size
         n = min_index
+        requested = {}  # chunk index -> (interface, time of request)
+        received = {}   # chunk index -> (interface, hex data)
+        failed = {}     # chunk index -> servers that did not deliver it
         while n < max_index + 1:
-            print_error( "Requesting chunk:", n )
-            i.send_request({'method':'blockchain.block.get_chunk', 'params':[n]}, queue)
-            r = self.retrieve_request(queue)
+            if not self.is_running():
+                return False
+
+            # keep up to max_pending_chunks requests in flight
+            for k in range(n, min(n + self.max_pending_chunks, max_index + 1)):
+                if k not in requested and k not in received:
+                    interface = self.request_chunk(i, k, failed.get(k, set()), queue)
+                    requested[k] = interface, time.time()
+
+            # chunks are verified strictly in order
+            if n in received:
+                interface, data = received.pop(n)
+                try:
+                    self.verify_chunk(n, data)
+                    failed.pop(n, None)
+                    n = n + 1
+                except Exception:
+                    print_error('Verify chunk failed!', n, interface.server)
+                    failed.setdefault(n, set()).add(interface.server)
+                    servers = set(x.server for x in self.get_chunk_interfaces(i, n))
+                    if servers <= failed[n]:
+                        # no server has a chunk that connects to ours: go back one chunk
+                        failed.pop(n)
+                        n = n - 1
+                        if n < 0:
+                            return False
+                        received.pop(n, None)
+                continue
+
             try:
-                self.verify_chunk(n, r)
-                n = n + 1
-            except Exception:
-                print_error('Verify chunk failed!')
-                n = n - 1
-                if n < 0:
-                    return False
+                interface, r = queue.get(timeout=1)
+            except Queue.Empty:
+                interface, r = None, None
+
+            if r is not None:
+                k = r.get('params')[0]
+                if requested.get(k, (None,))[0] == interface:
+                    requested.pop(k)
+                if r.get('error') or not r.get('result'):
+                    print_error('chunk request failed', k, interface.server, r.get('error'))
+                    failed.setdefault(k, set()).add(interface.server)
+                elif k >= n and k not in received:
+                    received[k] = interface, r.get('result')
+
+            # re-request chunks from servers that are gone or too slow
+            now = time.time()
+            for k, (interface, t) in requested.items():
+                if not interface.is_connected or now - t > self.chunk_timeout:
+                    print_error('chunk request timeout', k, interface.server)
+                    requested.pop(k)
+                    failed.setdefault(k, set()).add(interface.server)
 
         return True
-
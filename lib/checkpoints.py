@@ -0,0 +1,41 @@
+# Checkpoints used to speed up the initial header sync.
+#
+# Each entry is (height, block hash, bits) of the last header of a chunk,
+# that is height = 2016*k + 2015. A chunk that ends on a checkpoint is only
+# checked for hash linkage, and its last header must match the checkpoint;
+# retargeting and proof of work are not verified. Chunks without a
+# checkpoint, and everything above the last one, are fully verified.
+#
+# Entries must come from a fully verified headers file; they can be
+# generated with scripts/make_checkpoints. Set the config key
+# full_verification to ignore them.
+#
+# The table ships empty until it is generated from a verified Mazacoin
+# headers file; until then, every chunk is fully verified. Further entries
+# can be loaded from the JSON file named by the config key checkpoints_file,
+# as written by scripts/make_checkpoints --json.
+
+import json
+
+CHECKPOINTS = [
+]
+
+CHUNK_SIZE = 2016
+
+
+def load_checkpoints(path=None):
+    """ checkpoints by height, as (block hash, bits): the table above,
+    and the entries of the JSON file at path, if one is given """
+    table = list(CHECKPOINTS)
+    if path:
+        with open(path, 'rb') as f:
+            table += json.loads(f.read())
+    checkpoints = {}
+    for height, _hash, bits in table:
+        if height < 0 or (height + 1) % CHUNK_SIZE:
+            raise ValueError("checkpoint height %d does not end a chunk"%height)
+        if len(_hash) != 64:
+            raise ValueError("invalid checkpoint hash at height %d"%height)
+        int(_hash, 16)
+        checkpoints[height] = (str(_hash), int(bits))
+    return checkpoints
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Tate - lightweight Mazacoin client
+# Copyright (C) 2014 thomasv@gitorious
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+# AES in CBC mode, on data already padded to whole blocks.
+#
+# The C implementation of PyCrypto or PyCryptodome is used when one of
+# them is installed, else the pure python slowaes. Both produce the same
+# bytes, so wallets encrypted with one are decrypted with the other.
+
+import aes
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+CBC = aes.AESModeOfOperation.modeOfOperation["CBC"]
+
+
+class SlowAES(object):
+    name = 'slowaes'
+
+    def encrypt(self, key, iv, data):
+        moo = aes.AESModeOfOperation()
+        mode, length, ciph = moo.encrypt(data, CBC, map(ord, key), len(key), map(ord, iv))
+        return ''.join(map(chr, ciph))
+
+    def decrypt(self, key, iv, data):
+        if len(data) % 16:
+            raise ValueError("data is not a whole number of blocks")
+        moo = aes.AESModeOfOperation()
+        return moo.decrypt(map(ord, data), None, CBC, map(ord, key), len(key), map(ord, iv))
+
+
+class NativeAES(object):
+    name = 'native'
+
+    def encrypt(self, key, iv, data):
+        return AES.new(key, AES.MODE_CBC, iv).encrypt(data)
+
+    def decrypt(self, key, iv, data):
+        return AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+
+
+ciphers = {'slowaes': SlowAES}
+if AES is not None:
+    ciphers['native'] = NativeAES
+
+def get_cipher(name=None):
+    if name is None:
+        name = 'native' if 'native' in ciphers else 'slowaes'
+    if name not in ciphers:
+        raise BaseException("AES implementation not available: %s"%name)
+    return ciphers[name]()
+
+cipher = get_cipher()
+
+def set_cipher(name):
+    global cipher
+    cipher = get_cipher(name)
+
+def encrypt(key, iv, data):
+    return cipher.encrypt(key, iv, data)
+
+def decrypt(key, iv, data):
+    return cipher.decrypt(key, iv, data)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#
+# Tate - lightweight Mazacoin client
+# Copyright (C) 2014 thomasv@gitorious
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bisect
+import threading
+
+
+def age_key(coin):
+    # oldest first; unconfirmed coins (height 0) come last
+    height = coin['height']
+    return (height == 0, height, coin['prevout_hash'], coin['prevout_n'])
+
+def value_key(coin):
+    return (coin['value'], coin['prevout_hash'], coin['prevout_n'])
+
+def coin_key(coin):
+    return coin['prevout_hash'] + ':%d'%coin['prevout_n']
+
+
+class UTXOPool(object):
+    """ unspent outputs of a wallet, kept sorted by age and by value.
+    The wallet refreshes one address at a time when its history or one
+    of its transactions changes, so coins are never collected from the
+    whole history when a transaction is made. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.coins = {}          # 'hash:n' -> coin
+        self.addresses = {}      # address -> set of 'hash:n'
+        self.incomplete = set()  # addresses with transactions not yet received
+        self.by_age = []         # sorted (age_key, 'hash:n')
+        self.by_value = []       # sorted (value_key, 'hash:n')
+
+    def __len__(self):
+        return len(self.coins)
+
+    def __contains__(self, key):
+        return key in self.coins
+
+    def _insert(self, key, coin):
+        self.coins[key] = coin
+        self.addresses.setdefault(coin['address'], set()).add(key)
+        bisect.insort(self.by_age, (age_key(coin), key))
+        bisect.insort(self.by_value, (value_key(coin), key))
+
+    def _delete(self, key):
+        coin = self.coins.pop(key)
+        keys = self.addresses[coin['address']]
+        keys.discard(key)
+        if not keys:
+            self.addresses.pop(coin['address'])
+        for l, item in [(self.by_age, (age_key(coin), key)), (self.by_value, (value_key(coin), key))]:
+            i = bisect.bisect_left(l, item)
+            assert l[i] == item
+            del l[i]
+
+    def add(self, coin):
+        key = coin_key(coin)
+        with self.lock:
+            if key in self.coins:
+                self._delete(key)
+            self._insert(key, coin)
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.coins:
+                self._delete(key)
+
+    def set_address(self, address, coins, complete=True):
+        """ replace the coins of an address """
+        with self.lock:
+            old = self.addresses.get(address, set())
+            new = dict((coin_key(coin), coin) for coin in coins)
+            for key in old - set(new.keys()):
+                self._delete(key)
+            for key, coin in new.items():
+                if key in self.coins:
+                    if self.coins[key] == coin:
+                        continue
+                    self._delete(key)
+                self._insert(key, coin)
+            if complete:
+                self.incomplete.discard(address)
+            else:
+                self.incomplete.add(address)
+
+    def is_complete(self, domain=None):
+        with self.lock:
+            if domain is None:
+                return not self.incomplete
+            return self.incomplete.isdisjoint(domain)
+
+    def get_coins(self, domain=None, order='age'):
+        """ coins of domain, sorted by age or by increasing value """
+        with self.lock:
+            l = self.by_age if order == 'age' else self.by_value
+            if domain is None:
+                return [self.coins[key] for _, key in l]
+            domain = set(domain)
+            return [self.coins[key] for _, key in l if self.coins[key]['address'] in domain]
+
+
+class CoinChooser(object):
+    """ Selects the inputs of a transaction.
+
+    choose() is given coins in the order named by self.order, the amount
+    of the outputs, a SizeEstimator loaded with the outputs, a function
+    returning the fee of a transaction of a given size, and the largest
+    change that will be given up to the fee rather than kept.
+    It returns the selected coins, adding them to the size estimator,
+    or None if the coins are not enough.
+
+    The base strategy spends coins in the order given, that is the
+    oldest first. """
+
+    name = 'oldest'
+    order = 'age'
+
+    def sort(self, coins):
+        return sorted(coins, key=age_key if self.order == 'age' else value_key)
+
+    def choose(self, coins, amount, size, fee, dust):
+        return self.fill([], coins, amount, size, fee)
+
+    def fill(self, selected, coins, amount, size, fee):
+        # add coins in order until amount and fee are covered
+        total = sum(coin['value'] for coin in selected)
+        if selected and total >= amount + fee(size.size()):
+            return selected
+        for coin in coins:
+            selected.append(coin)
+            size.add_input(coin)
+            total += coin['value']
+            if total >= amount + fee(size.size()):
+                return selected
+
+
+class OldestFirst(CoinChooser):
+    """ spend the oldest coins first """
+    name = 'oldest'
+
+
+class LargestFirst(CoinChooser):
+    """ spend the largest coins first; this minimizes the number of inputs """
+    name = 'largest'
+    order = 'value'
+
+    def choose(self, coins, amount, size, fee, dust):
+        return self.fill([], reversed(coins), amount, size, fee)
+
+
+class BranchAndBound(CoinChooser):
+    """ look for a set of coins that pays amount and fee without change.
+    Coins are tried by decreasing effective value (value minus the fee
+    they add); the search gives up after max_tries steps and falls back
+    to oldest first. """
+    name = 'bnb'
+    order = 'value'
+    max_tries = 100000
+
+    def choose(self, coins, amount, size, fee, dust):
+        # fee added per byte, measured well above the relay minimum
+        rate = (fee(200000) - fee(100000))/100000.
+        candidates = []
+        for coin in coins:
+            s = size.input_size(coin)
+            v = coin['value'] - rate*s
+            # coins that do not pay for themselves never help
+            if v > 0:
+                candidates.append((v, s, coin))
+        candidates.sort(key=lambda x: -x[0])
+        result = self.search(candidates, amount, size.size(), fee, dust)
+        if result is None:
+            return OldestFirst().choose(sorted(coins, key=age_key), amount, size, fee, dust)
+        selected = [candidates[i][2] for i in result]
+        for coin in selected:
+            size.add_input(coin)
+        return selected
+
+    def search(self, candidates, amount, base, fee, dust):
+        # iterative depth first search over include/exclude decisions;
+        # returns the indices of the included candidates
+        n = len(candidates)
+        remaining = [0]*(n+1)
+        for i in range(n-1, -1, -1):
+            remaining[i] = remaining[i+1] + candidates[i][2]['value']
+        selected = []
+        total = 0
+        s = base
+        i = 0
+        for tries in xrange(self.max_tries):
+            needed = amount + fee(s)
+            if total >= needed:
+                # adding coins would only increase the excess
+                if total <= needed + dust:
+                    return selected
+                backtrack = True
+            else:
+                # the fee never decreases as inputs are added
+                backtrack = total + remaining[i] < needed
+            if not backtrack:
+                # include candidate i
+                selected.append(i)
+                total += candidates[i][2]['value']
+                s += candidates[i][1]
+                i += 1
+                continue
+            # remove the last included candidate and exclude it
+            if not selected:
+                return
+            j = selected.pop()
+            total -= candidates[j][2]['value']
+            s -= candidates[j][1]
+            i = j + 1
+
+
+class Consolidation(CoinChooser):
+    """ spend small coins, up to max_inputs of them, so that they are
+    merged into the change output. Coins worth less than the fee they
+    add are left alone. Larger coins are added if the small ones do not
+    cover the amount. """
+    name = 'consolidate'
+    order = 'value'
+    max_inputs = 50
+
+    def choose(self, coins, amount, size, fee, dust):
+        selected = []
+        for coin in coins:
+            if len(selected) >= self.max_inputs:
+                break
+            s = size.size()
+            size.add_input(coin)
+            if coin['value'] <= fee(size.size()) - fee(s):
+                size.remove_input(coin)
+                continue
+            selected.append(coin)
+        chosen = set(map(coin_key, selected))
+        rest = [coin for coin in reversed(coins) if coin_key(coin) not in chosen]
+        return self.fill(selected, rest, amount, size, fee)
+
+
+choosers = dict((c.name, c) for c in [OldestFirst, LargestFirst, BranchAndBound, Consolidation])
+
+def get_chooser(name):
+    if name is None:
+        name = 'oldest'
+    if name not in choosers:
+        raise BaseException("Unknown coin chooser: %s"%name)
+    return choosers[name]()
@@ -24,6 +24,7 @@ from bitcoin import is_valid, hash_160_to_bc_address, hash_160
 from decimal import Decimal
 import bitcoin
 from transaction import Transaction
+from coinchooser import choosers
 
 
 class Command:
@@ -49,7 +50,7 @@ def register_command(*args):
 
 
 
-payto_options = ' --fee, -f: set transaction fee\n --fromaddr, -F: send from address -\n --changeaddr, -c: send change to address'
+payto_options = ' --fee, -f: set transaction fee\n --fromaddr, -F: send from address -\n --changeaddr, -c: send change to address\n --coins: coin selection (oldest, largest, bnb or consolidate)'
 listaddr_options = " -a: show all addresses, including change addresses\n -l: include labels in results"
 restore_options = " accepts a seed or master public key."
 mksendmany_syntax = 'mksendmanytx <recipient> <amount> [<recipient> <amount> ...]'
@@ -88,10 +89,10 @@ register_command('importprivkey',        1, 1, False, True,  True,  'Import a pr
 register_command('listaddresses',        2, 2, False, True,  False, 'Returns your list of addresses.', '', listaddr_options)
 register_command('listunspent',          0, 0, True,  True,  False, 'Returns the list of unspent inputs in your wallet.')
 register_command('getaddressunspent',    1, 1, True,  False, False, 'Returns the list of unspent inputs for an address.')
-register_command('mktx',                 5, 5, False, True,  True,  'Create a signed transaction', 'mktx <recipient> <amount> [label]', payto_options)
-register_command('mksendmanytx',         4, 4, False, True,  True,  'Create a signed transaction', mksendmany_syntax, payto_options)
-register_command('payto',                5, 5, True,  True,  True,  'Create and broadcast a transaction.', payto_syntax, payto_options)
-register_command('paytomany',            4, 4, True,  True,  True,  'Create and broadcast a transaction.', paytomany_syntax, payto_options)
+register_command('mktx',                 6, 6, False, True,  True,  'Create a signed transaction', 'mktx <recipient> <amount> [label]', payto_options)
+register_command('mksendmanytx',         5, 5, False, True,  True,  'Create a signed transaction', mksendmany_syntax, payto_options)
+register_command('payto',                6, 6, True,  True,  True,  'Create and broadcast a transaction.', payto_syntax, payto_options)
+register_command('paytomany',            5, 5, True,  True,  True,  'Create and broadcast a transaction.', paytomany_syntax, payto_options)
 register_command('password',             0, 0, False, True,  True,  'Change your password')
 register_command('restore',              0, 0, True,  True,  False, 'Restore a wallet', '', restore_options)
 register_command('setconfig',            2, 2, False, False, False, 'Set a configuration variable', 'setconfig <name> <value>')
@@ -108,6 +109,8 @@ register_command('decrypt',              2,-1, False, True, True,   'decrypt a m
 register_command('getproof',             1, 1, True, False, False, 'get merkle proof', 'getproof <address>')
 register_command('getutxoaddress',       2, 2, True, False, False, 'get the address of an unspent transaction output','getutxoaddress <txid> <pos>')
 register_command('sweep',                2, 3, True, False, False, 'Sweep a private key.', 'sweep privkey addr [fee]')
+register_command('exportheaders',        1, 1, False, False, False, 'Export the verified block headers, with a manifest, to a directory.', 'exportheaders <directory>')
+register_command('importheaders',        1, 1, False, False, False, 'Verify and import block headers exported with exportheaders. Stop the daemon first.', 'importheaders <directory>')
 register_command('make_seed',            3, 3, False, False, False, 'Create a seed.','options: --nbits --entropy --lang')
 register_command('check_seed',           1,-1, False, False, False, 'Check that a seed was generated with external entropy. Option: --entropy --lang')
 
@@ -171,7 +174,7 @@ class Commands:
 
     def decoderawtransaction(self, raw):
         tx = Transaction.deserialize(raw)
-        return {'inputs':tx.inputs, 'outputs':tx.outputs}
+        return {'inputs':map(dict, tx.inputs), 'outputs':map(tuple, tx.outputs)}
 
     def sendrawtransaction(self, raw):
         tx = Transaction.deserialize(raw)
@@ -195,7 +198,7 @@ class Commands:
     def dumpprivkeys(self, addresses = None):
         if addresses is None:
             addresses = self.wallet.addresses(True)
-        return [self.wallet.get_private_key(address, self.password) for address in addresses]
+        return self.wallet.get_private_keys(addresses, self.password)
 
     def validateaddress(self, addr):
         isvalid = is_valid(addr)
@@ -266,7 +269,7 @@ class Commands:
     def verifymessage(self, address, signature, message):
         return bitcoin.verify_message(address, signature, message)
 
-    def _mktx(self, outputs, fee = None, change_addr = None, domain = None):
+    def _mktx(self, outputs, fee = None, change_addr = None, domain = None, chooser = None):
         for to_address, amount in outputs:
             if not is_valid(to_address):
                 raise Exception("Invalid Bitcoin address", to_address)
@@ -283,6 +286,9 @@ class Commands:
                 if not self.wallet.is_mine(addr):
                     raise Exception("address not in wallet", addr)
 
+        if chooser is not None and chooser not in choosers:
+            raise Exception("Unknown coin chooser", chooser)
+
         for k, v in self.wallet.labels.items():
             if change_addr and v == change_addr:
                 change_addr = k
@@ -299,23 +305,23 @@ class Commands:
             final_outputs.append(('address', to_address, amount))
 
         if fee: fee = int(100000000*fee)
-        return self.wallet.mktx(final_outputs, self.password, fee , change_addr, domain)
+        return self.wallet.mktx(final_outputs, self.password, fee , change_addr, domain, chooser = chooser)
 
-    def mktx(self, to_address, amount, fee = None, change_addr = None, domain = None):
-        tx = self._mktx([(to_address, amount)], fee, change_addr, domain)
+    def mktx(self, to_address, amount, fee = None, change_addr = None, domain = None, chooser = None):
+        tx = self._mktx([(to_address, amount)], fee, change_addr, domain, chooser)
         return tx
 
-    def mksendmanytx(self, outputs, fee = None, change_addr = None, domain = None):
-        tx = self._mktx(outputs, fee, change_addr, domain)
+    def mksendmanytx(self, outputs, fee = None, change_addr = None, domain = None, chooser = None):
+        tx = self._mktx(outputs, fee, change_addr, domain, chooser)
         return tx
 
-    def payto(self, to_address, amount, fee = None, change_addr = None, domain = None):
-        tx = self._mktx([(to_address, amount)], fee, change_addr, domain)
+    def payto(self, to_address, amount, fee = None, change_addr = None, domain = None, chooser = None):
+        tx = self._mktx([(to_address, amount)], fee, change_addr, domain, chooser)
         r, h = self.wallet.sendtx( tx )
         return h
 
-    def paytomany(self, outputs, fee = None, change_addr = None, domain = None):
-        tx = self._mktx(outputs, fee, change_addr, domain)
+    def paytomany(self, outputs, fee = None, change_addr = None, domain = None, chooser = None):
+        tx = self._mktx(outputs, fee, change_addr, domain, chooser)
         r, h = self.wallet.sendtx( tx )
         return h
 
@@ -380,6 +386,19 @@ class Commands:
         else:
             return "unknown transaction"
 
+    def exportheaders(self, dirname):
+        from blockchain import Blockchain
+        from simple_config import get_config
+        blockchain = Blockchain(get_config(), None)
+        manifest = blockchain.export_snapshot(dirname)
+        return {'height':manifest['height'], 'sha256':manifest['sha256']}
+
+    def importheaders(self, dirname):
+        from blockchain import Blockchain
+        from simple_config import get_config
+        blockchain = Blockchain(get_config(), None)
+        return {'height':blockchain.import_snapshot(dirname)}
+
     def encrypt(self, pubkey, message):
         return bitcoin.encrypt_message(message, pubkey)
 
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#
+# Tate - lightweight Mazacoin client
+# Copyright (C) 2014 thomasv@gitorious
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+# secp256k1 arithmetic used for keys and signatures.
+#
+# Points are affine (x, y) tuples of longs, and None is the point at
+# infinity. Internally, sums are computed in Jacobian coordinates (X, Y, Z),
+# with x = X/Z^2 and y = Y/Z^3, so that no modular inverse is needed
+# until the result is converted back.
+#
+# Multiples of the generator are read from a table built once per process,
+# on first use: the scalar is split in 8-bit windows, and window j selects
+# one of the multiples d * 256^j * G, so k*G costs at most 32 additions and
+# no doubling. Other points are multiplied with a width-5 NAF.
+
+import hashlib
+import hmac
+
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+B = 7
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+WINDOW = 8
+WNAF_WIDTH = 5
+
+
+def inverse(a, n=P):
+    return pow(a, n - 2, n)
+
+
+def is_on_curve(point):
+    if point is None:
+        return False
+    x, y = point
+    return 0 <= x < P and 0 <= y < P and (y*y - x*x*x - B) % P == 0
+
+
+# Jacobian coordinates. Z == 0 is the point at infinity.
+
+INFINITY = (0, 1, 0)
+
+def _double(p):
+    X1, Y1, Z1 = p
+    if not Z1 or not Y1:
+        return INFINITY
+    YY = Y1*Y1 % P
+    S = 4*X1*YY % P
+    M = 3*X1*X1 % P
+    X3 = (M*M - 2*S) % P
+    Y3 = (M*(S - X3) - 8*YY*YY) % P
+    Z3 = 2*Y1*Z1 % P
+    return (X3, Y3, Z3)
+
+
+def _add_affine(p, q):
+    """ p + q, where q is affine and not infinity """
+    X1, Y1, Z1 = p
+    x2, y2 = q
+    if not Z1:
+        return (x2, y2, 1)
+    Z1Z1 = Z1*Z1 % P
+    H = (x2*Z1Z1 - X1) % P
+    R = (y2*Z1*Z1Z1 - Y1) % P
+    if not H:
+        return _double(p) if not R else INFINITY
+    HH = H*H % P
+    HHH = H*HH % P
+    V = X1*HH % P
+    X3 = (R*R - HHH - 2*V) % P
+    Y3 = (R*(V - X3) - Y1*HHH) % P
+    Z3 = Z1*H % P
+    return (X3, Y3, Z3)
+
+
+def _to_affine(p):
+    X, Y, Z = p
+    if not Z:
+        return None
+    zi = inverse(Z)
+    zi2 = zi*zi % P
+    return (X*zi2 % P, Y*zi2*zi % P)
+
+
+def _batch_to_affine(points):
+    """ convert Jacobian points to affine with a single inverse """
+    prods = []
+    acc = 1
+    for X, Y, Z in points:
+        prods.append(acc)
+        acc = acc*Z % P
+    acc = inverse(acc)
+    result = [None]*len(points)
+    for i in range(len(points)-1, -1, -1):
+        X, Y, Z = points[i]
+        zi = acc*prods[i] % P
+        acc = acc*Z % P
+        zi2 = zi*zi % P
+        result[i] = (X*zi2 % P, Y*zi2*zi % P)
+    return result
+
+
+_g_table = None
+
+def _get_g_table():
+    global _g_table
+    if _g_table is None:
+        table = []
+        base = G
+        for j in range((256 + WINDOW - 1)/WINDOW):
+            row = [(base[0], base[1], 1)]
+            for d in range(2, 1 << WINDOW):
+                row.append(_add_affine(row[-1], base))
+            row = _batch_to_affine(row)
+            table.append(row)
+            # 2^WINDOW * base is the last multiple plus base
+            base = _to_affine(_add_affine((row[-1][0], row[-1][1], 1), base))
+        _g_table = table
+    return _g_table
+
+
+def _mul_G(k):
+    table = _get_g_table()
+    mask = (1 << WINDOW) - 1
+    r = INFINITY
+    j = 0
+    while k:
+        d = k & mask
+        if d:
+            r = _add_affine(r, table[j][d-1])
+        k >>= WINDOW
+        j += 1
+    return r
+
+
+def _wnaf(k, w=WNAF_WIDTH):
+    """ width-w NAF digits of k, least significant first """
+    digits = []
+    half = 1 << (w - 1)
+    full = 1 << w
+    while k:
+        if k & 1:
+            d = k & (full - 1)
+            if d >= half:
+                d -= full
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+
+def _mul(point, k):
+    # odd multiples point, 3*point, ..., (2^(w-1)-1)*point
+    p = (point[0], point[1], 1)
+    twice = _to_affine(_double(p))
+    if twice is None:
+        odd = [point]
+    else:
+        odd = [p]
+        for i in range((1 << (WNAF_WIDTH - 2)) - 1):
+            odd.append(_add_affine(odd[-1], twice))
+        if any(not Z for X, Y, Z in odd):
+            # only possible if point does not have order N
+            raise ValueError("point is not in the group")
+        odd = _batch_to_affine(odd)
+    r = INFINITY
+    for d in reversed(_wnaf(k)):
+        r = _double(r)
+        if d > 0:
+            r = _add_affine(r, odd[d >> 1])
+        elif d < 0:
+            x, y = odd[(-d) >> 1]
+            r = _add_affine(r, (x, P - y))
+    return r
+
+
+def mul_G(k):
+    """ k * G """
+    k %= N
+    return _to_affine(_mul_G(k))
+
+
+def mul(point, k):
+    """ k * point """
+    k %= N
+    if point is None or not k:
+        return None
+    return _to_affine(_mul(point, k))
+
+
+def add(p, q):
+    if p is None:
+        return q
+    if q is None:
+        return p
+    return _to_affine(_add_affine((p[0], p[1], 1), q))
+
+
+def mul_add(k1, k2, point):
+    """ k1 * G + k2 * point """
+    r = _mul_G(k1 % N)
+    k2 %= N
+    if point is None or not k2:
+        return _to_affine(r)
+    q = _to_affine(_mul(point, k2))
+    if q is None:
+        return _to_affine(r)
+    return _to_affine(_add_affine(r, q))
+
+
+def mul_G_add(scalars, point):
+    """ k * G + point for each k of scalars. The sums are converted to
+    affine coordinates together, with a single inverse """
+    sums = [_add_affine(_mul_G(k % N), point) for k in scalars]
+    finite = [i for i, p in enumerate(sums) if p[2]]
+    result = [None]*len(sums)
+    if finite:
+        for i, p in zip(finite, _batch_to_affine([sums[i] for i in finite])):
+            result[i] = p
+    return result
+
+
+def y_from_x(x, odd):
+    y2 = (x*x*x + B) % P
+    y = pow(y2, (P + 1)/4, P)
+    if y*y % P != y2:
+        raise ValueError("no point with x = %x"%x)
+    return y if bool(y & 1) == odd else P - y
+
+
+def encode_point(point, compressed=True):
+    """ SEC serialization of a point, as bytes """
+    x, y = point
+    if compressed:
+        return chr(2 + (y & 1)) + ('%064x'%x).decode('hex')
+    return '\x04' + ('%064x'%x).decode('hex') + ('%064x'%y).decode('hex')
+
+
+def decode_point(ser):
+    """ point of a SEC serialization. Raises ValueError if it is not a
+    point of the curve """
+    if len(ser) == 33 and ser[0] in '\x02\x03':
+        x = long(ser[1:].encode('hex'), 16)
+        if x >= P:
+            raise ValueError("invalid point")
+        point = (x, y_from_x(x, ser[0] == '\x03'))
+    elif len(ser) == 65 and ser[0] == '\x04':
+        point = (long(ser[1:33].encode('hex'), 16), long(ser[33:].encode('hex'), 16))
+    else:
+        raise ValueError("invalid point encoding")
+    if not is_on_curve(point):
+        raise ValueError("invalid point")
+    return point
+
+
+def _int(data):
+    return long(data.encode('hex'), 16)
+
+def _bytes(n):
+    return ('%064x'%n).decode('hex')
+
+
+def deterministic_k(secret, digest):
+    """ generator of the nonces of RFC 6979, with HMAC-SHA256 """
+    h1 = _bytes(_int(digest) % N)
+    v = '\x01'*32
+    k = '\x00'*32
+    k = hmac.new(k, v + '\x00' + _bytes(secret) + h1, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    k = hmac.new(k, v + '\x01' + _bytes(secret) + h1, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    while True:
+        v = hmac.new(k, v, hashlib.sha256).digest()
+        t = _int(v)
+        if 1 <= t < N:
+            yield t
+        k = hmac.new(k, v + '\x00', hashlib.sha256).digest()
+        v = hmac.new(k, v, hashlib.sha256).digest()
+
+
+def sign(secret, digest):
+    """ deterministic signature (r, s) of a 32-byte digest; the same as
+    ecdsa's sign_digest_deterministic with sha256 """
+    e = _int(digest)
+    for k in deterministic_k(secret, digest):
+        r = mul_G(k)[0] % N
+        if not r:
+            continue
+        s = inverse(k, N) * (e + secret*r % N) % N
+        if s:
+            return r, s
+
+
+def verify(point, digest, r, s):
+    if not (0 < r < N and 0 < s < N):
+        return False
+    w = inverse(s, N)
+    R = mul_add(_int(digest)*w, r*w, point)
+    return R is not None and R[0] % N == r
+
+
+def recover(digest, r, s, recid):
+    """ public key of a signature, from the parity and range of R given
+    by recid. See SEC 1 v2, 4.1.6 """
+    x = r + (recid/2) * N
+    R = (x, y_from_x(x, bool(recid & 1)))
+    inv_r = inverse(r, N)
+    return mul_add(-_int(digest)*inv_r, s*inv_r, R)
@@ -93,6 +93,7 @@ class Network(threading.Thread):
         self.pending_servers = set()
 
         self.banner = ''
+        self.reorg_height = None
         self.interface = None
         self.proxy = self.config.get('proxy')
         self.heights = {}
@@ -144,6 +145,8 @@ class Network(threading.Thread):
             value = self.get_servers()
         elif key == 'interfaces':
             value = self.get_interfaces()
+        elif key == 'reorg':
+            value = self.reorg_height
         return value
 
     def notify(self, key):
@@ -310,6 +313,11 @@ class Network(threading.Thread):
                     self.set_server(i.server)
         self.notify('updated')
 
+    def blockchain_reorg(self, height):
+        """ local headers from height on were replaced """
+        self.reorg_height = height
+        self.notify('reorg')
+
 
     def process_response(self, i, response):
         method = response['method']
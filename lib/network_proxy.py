@@ -69,6 +69,7 @@ class NetworkProxy(threading.Thread):
         self.blockchain_height = 0
         self.server_height = 0
         self.interfaces = []
+        self.reorg_height = None
 
     def is_running(self):
         return self.running
@@ -104,6 +105,8 @@ class NetworkProxy(threading.Thread):
                 self.servers = value
             elif key == 'interfaces':
                 self.interfaces = value
+            elif key == 'reorg':
+                self.reorg_height = value
             self.trigger_callback(key)
             return
 
@@ -1,12 +1,20 @@
+import base64
+import os
+import random
 import unittest
 import sys
+
+import aes
 from ecdsa.util import number_to_string
 
 from lib.bitcoin import (
     generator_secp256k1, point_to_ser, public_key_to_bc_address, EC_KEY,
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
-    is_valid, is_private_key, xpub_from_xprv)
+    is_valid, is_private_key, xpub_from_xprv, CKD_pub, deserialize_xkey,
+    PublicNode, b58encode, b58decode, DecodeBase58Check, hash_160_to_bc_address,
+    bc_address_to_hash_160, is_address, EncodeAES, DecodeAES)
+from lib import cipher
 
 try:
     import ecdsa
@@ -83,6 +91,19 @@ class Test_bitcoin(unittest.TestCase):
 
         return xpub, xprv
 
+    def test_public_node(self):
+        xprv, xpub = bip32_root("000102030405060708090a0b0c0d0e0f".decode('hex'))
+        _, _, _, c, cK = deserialize_xkey(xpub)
+        node = PublicNode.from_xpub(xpub).child(1)
+        cK, c = CKD_pub(cK, c, 1)
+        self.assertEqual((node.cK, node.c), (cK, c))
+        expected = [CKD_pub(cK, c, n)[0] for n in range(5, 12)]
+        self.assertEqual(node.derive_range(5, 7), expected)
+        self.assertEqual(node.derive_range(5, 0), [])
+        child = deserialize_xkey(bip32_public_derivation(xpub, "", "/1/7"))
+        self.assertEqual((node.child(7).c, node.child(7).cK), child[3:])
+        self.assertRaises(BaseException, node.tweak, 0x80000000)
+
     def test_aes_homomorphic(self):
         """Make sure AES is homomorphic."""
         payload = u'\u66f4\u7a33\u5b9a\u7684\u4ea4\u6613\u5e73\u53f0'
@@ -161,3 +182,105 @@ class Test_keyImport(unittest.TestCase):
         self.assertFalse(is_private_key(self.public_key_hex))
 
 
+
+
+B58_CHARS = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+def reference_b58encode(v):
+    # the implementation replaced by the chunked codec
+    long_value = 0L
+    for (i, c) in enumerate(v[::-1]):
+        long_value += (256**i) * ord(c)
+    result = ''
+    while long_value >= 58:
+        div, mod = divmod(long_value, 58)
+        result = B58_CHARS[mod] + result
+        long_value = div
+    result = B58_CHARS[long_value] + result
+    nPad = len(v) - len(v.lstrip('\0'))
+    return B58_CHARS[0]*nPad + result
+
+
+class Test_base58(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(3)
+
+    def random_bytes(self, n):
+        return ''.join(chr(random.randint(0, 255)) for i in range(n))
+
+    def test_round_trip(self):
+        for i in range(2000):
+            v = '\0'*random.choice([0, 0, 1, 2, 5]) + chr(random.randint(1, 255)) + self.random_bytes(random.randint(0, 90))
+            encoded = b58encode(v)
+            self.assertEqual(encoded, reference_b58encode(v))
+            self.assertEqual(b58decode(encoded, None), v)
+            self.assertEqual(b58decode(encoded, len(v)), v)
+            self.assertEqual(b58decode(encoded, len(v) + 1), None)
+
+    def test_edge_cases(self):
+        self.assertEqual(b58encode(''), '')
+        self.assertEqual(b58decode('', None), '')
+        self.assertEqual(b58encode('\0\0\1'), '112')
+        self.assertEqual(b58decode('112', None), '\0\0\1')
+        self.assertEqual(b58decode('1O0l', None), None)
+        self.assertEqual(DecodeBase58Check('1O0l'), None)
+
+    def test_leading_zeros_only(self):
+        # before the chunked codec, zero bytes made only of leading '1's
+        # were counted twice: '1' decoded to two zero bytes, and a zero
+        # byte encoded to '11'
+        for n in range(1, 4):
+            self.assertEqual(b58decode('1'*n, None), '\0'*n)
+            self.assertEqual(b58decode('1'*n, n), '\0'*n)
+            self.assertEqual(b58decode('1'*n, n + 1), None)
+            self.assertEqual(b58encode('\0'*n), '1'*n)
+
+    def test_address_cache(self):
+        for i in range(50):
+            h160 = self.random_bytes(20)
+            addrtype = random.choice([50, 9])
+            address = hash_160_to_bc_address(h160, addrtype)
+            self.assertEqual(address, reference_b58encode(chr(addrtype) + h160 + Hash(chr(addrtype) + h160)[0:4]))
+            self.assertEqual(hash_160_to_bc_address(h160, addrtype), address)
+            self.assertEqual(bc_address_to_hash_160(address), (addrtype, h160))
+            self.assertTrue(is_address(address))
+            # a corrupted address is not cached as valid
+            corrupted = address[:-1] + ('2' if address[-1] != '2' else '3')
+            self.assertFalse(is_address(corrupted))
+            self.assertFalse(is_address(corrupted))
+
+
+@unittest.skipIf('native' not in cipher.ciphers, "PyCrypto is not installed")
+class Test_cipher(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(4)
+        self.default = cipher.cipher.name
+
+    def tearDown(self):
+        cipher.set_cipher(self.default)
+
+    def test_same_ciphertext(self):
+        slow, native = cipher.get_cipher('slowaes'), cipher.get_cipher('native')
+        for keysize in [16, 32]:
+            for n in [0, 1, 3]:
+                key, iv = os.urandom(keysize), os.urandom(16)
+                data = os.urandom(16*n)
+                encrypted = slow.encrypt(key, iv, data)
+                self.assertEqual(native.encrypt(key, iv, data), encrypted)
+                self.assertEqual(native.decrypt(key, iv, encrypted), data)
+                self.assertEqual(slow.decrypt(key, iv, encrypted), data)
+
+    def test_wallet_format(self):
+        # strings encrypted with slowaes' encryptData are read by both
+        # implementations, and strings they encrypt are read by decryptData
+        secret = Hash('password')
+        for name in ['slowaes', 'native']:
+            cipher.set_cipher(name)
+            for s in ['', 'seed words', os.urandom(100)]:
+                self.assertEqual(DecodeAES(secret, base64.b64encode(aes.encryptData(secret, s))), s)
+                self.assertEqual(aes.decryptData(secret, base64.b64decode(EncodeAES(secret, s))), s)
+            payload = u'\u66f4\u7a33\u5b9a'
+            self.assertEqual(pw_decode(pw_encode(payload, 'secret'), 'secret'), payload)
+            self.assertRaises(Exception, pw_decode, 'AAAA' + pw_encode(payload, 'secret'), 'secret')
@@ -0,0 +1,601 @@
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from lib.blockchain import Blockchain, HeaderStore, DGW3Window, hash_raw_headers
+from lib.checkpoints import load_checkpoints
+
+
+class FakeConfig(object):
+    """A stub config file to be used in tests"""
+    def __init__(self, path):
+        self.path = path
+        self.store = {}
+
+    def set(self, key, value):
+        self.store[key] = value
+
+    def get(self, key, default=None):
+        return self.store.get(key, default)
+
+
+def make_raw_header(prev_hash, timestamp, bits, nonce=0):
+    """ build an 80 byte header; prev_hash is in display order """
+    return struct.pack('<I', 1) + prev_hash.decode('hex')[::-1] \
+        + os.urandom(32) + struct.pack('<III', timestamp, bits, nonce)
+
+
+class BlockchainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BlockchainTestCase, self).setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.config = FakeConfig(self.user_dir)
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+
+    def tearDown(self):
+        super(BlockchainTestCase, self).tearDown()
+        self.blockchain.store.close()
+        shutil.rmtree(self.user_dir)
+
+    def make_chain(self, n, start_time=1400000000, bits=0x1e0ffff0):
+        """ return n linked raw headers with random block intervals """
+        prev_hash = "0"*64
+        timestamp = start_time
+        data = []
+        for i in range(n):
+            timestamp += random.randint(30, 300)
+            raw = make_raw_header(prev_hash, timestamp, bits)
+            prev_hash = self.blockchain.hash_header(self.blockchain.header_from_string(raw))
+            data.append(raw)
+        return data
+
+
+class Test_HeaderStore(BlockchainTestCase):
+
+    def test_read_write(self):
+        headers = self.make_chain(10)
+        for i, raw in enumerate(headers):
+            self.blockchain.save_header(self.blockchain.header_from_string(raw), i)
+        self.assertEqual(9, self.blockchain.height())
+        for i, raw in enumerate(headers):
+            self.assertEqual(self.blockchain.header_from_string(raw), self.blockchain.read_header(i))
+        self.assertEqual(None, self.blockchain.read_header(10))
+        self.assertEqual(None, self.blockchain.read_header(-1))
+
+    def test_remap_on_external_growth(self):
+        headers = self.make_chain(4)
+        self.blockchain.store.write(0, ''.join(headers[:2]))
+        self.assertEqual(None, self.blockchain.read_header(3))
+        with open(self.blockchain.path(), 'ab') as f:
+            f.write(''.join(headers[2:]))
+        self.assertEqual(self.blockchain.header_from_string(headers[3]), self.blockchain.read_header(3))
+
+    def test_overwrite_invalidates_cache(self):
+        headers = self.make_chain(3)
+        other = self.make_chain(3)
+        self.blockchain.store.write(0, ''.join(headers))
+        self.assertEqual(self.blockchain.header_from_string(headers[1]), self.blockchain.read_header(1))
+        self.blockchain.store.write(1, other[1])
+        self.assertEqual(self.blockchain.header_from_string(other[1]), self.blockchain.read_header(1))
+
+    def test_truncate(self):
+        headers = self.make_chain(5)
+        self.blockchain.store.write(0, ''.join(headers))
+        self.assertTrue(self.blockchain.read_header(4))
+        self.blockchain.store.truncate(2)
+        self.assertEqual(None, self.blockchain.read_header(2))
+        self.assertEqual(None, self.blockchain.read_header(4))
+        self.assertEqual(2*80, os.path.getsize(self.blockchain.path()))
+
+    def test_cache_is_bounded(self):
+        store = HeaderStore(self.blockchain.path(), self.blockchain.header_from_string, cache_size=3)
+        store.write(0, ''.join(self.make_chain(6)))
+        for i in range(6):
+            store.read(i)
+        self.assertEqual([3, 4, 5], list(store.cache.keys()))
+        store.close()
+
+
+class Test_HashIndex(BlockchainTestCase):
+
+    def hashes(self, headers):
+        return [self.blockchain.hash_header(self.blockchain.header_from_string(raw)) for raw in headers]
+
+    def test_hashes_follow_writes(self):
+        headers = self.make_chain(10)
+        self.blockchain.store.commit(0, ''.join(headers[:6]))
+        for i, raw in enumerate(headers[6:]):
+            self.blockchain.save_header(self.blockchain.header_from_string(raw), 6 + i)
+        hashes = self.hashes(headers)
+        self.assertEqual(10*32, os.path.getsize(self.blockchain.store.hashes_path()))
+        for i, _hash in enumerate(hashes):
+            self.assertEqual(_hash, self.blockchain.get_block_hash(i))
+            self.assertEqual(i, self.blockchain.get_block_height(_hash))
+        self.assertEqual(None, self.blockchain.get_block_hash(10))
+        self.assertEqual(None, self.blockchain.get_block_height("ab"*32))
+
+    def test_truncate_and_overwrite(self):
+        headers = self.make_chain(8)
+        other = self.make_chain(3)
+        self.blockchain.store.commit(0, ''.join(headers))
+        self.blockchain.store.truncate(5)
+        self.assertEqual(None, self.blockchain.get_block_hash(5))
+        self.assertEqual(None, self.blockchain.get_block_height(self.hashes(headers)[6]))
+        self.blockchain.store.write(4, other[2])
+        self.assertEqual(self.hashes(other)[2], self.blockchain.get_block_hash(4))
+        self.assertEqual(None, self.blockchain.get_block_height(self.hashes(headers)[4]))
+
+    def test_unaligned_match_is_ignored(self):
+        headers = self.make_chain(2)
+        self.blockchain.store.commit(0, ''.join(headers))
+        digests = [self.blockchain.store.read_hash(i) for i in range(2)]
+        straddling = (digests[0][16:] + digests[1][:16])[::-1].encode('hex')
+        self.assertEqual(None, self.blockchain.get_block_height(straddling))
+
+    def test_recover_rebuilds_index(self):
+        headers = self.make_chain(30)
+        with open(self.blockchain.path(), 'wb') as f:
+            f.write(''.join(headers))
+        # headers written by a version without the index
+        self.assertEqual(self.hashes(headers)[29], self.blockchain.get_block_hash(29))
+        self.assertFalse(os.path.exists(self.blockchain.store.hashes_path()))
+        self.blockchain.init_headers_file()
+        self.assertEqual(30*32, os.path.getsize(self.blockchain.store.hashes_path()))
+        self.assertEqual(self.hashes(headers)[29], self.blockchain.get_block_hash(29))
+
+    def test_recover_repairs_last_entry(self):
+        headers = self.make_chain(5)
+        self.blockchain.store.commit(0, ''.join(headers[:4]))
+        with open(self.blockchain.store.hashes_path(), 'rb+') as f:
+            f.seek(3*32)
+            f.write('\0'*32)
+        with open(self.blockchain.path(), 'ab') as f:
+            f.write(headers[4])
+        self.blockchain.init_headers_file()
+        self.assertEqual(self.hashes(headers), [self.blockchain.get_block_hash(i) for i in range(5)])
+
+    def test_lookup_index_follows_writes(self):
+        headers = self.make_chain(8)
+        other = self.make_chain(3)
+        self.assertEqual(None, self.blockchain.get_block_height(self.hashes(headers)[0]))
+        self.blockchain.store.commit(0, ''.join(headers[:6]))
+        self.blockchain.store.write(6, ''.join(headers[6:]))
+        self.assertEqual(range(8), [self.blockchain.get_block_height(h) for h in self.hashes(headers)])
+        self.blockchain.store.truncate(5)
+        self.blockchain.store.write(4, other[2])
+        self.assertEqual([0, 1, 2, 3, None, None, None, None], [self.blockchain.get_block_height(h) for h in self.hashes(headers)])
+        self.assertEqual(4, self.blockchain.get_block_height(self.hashes(other)[2]))
+        self.assertEqual(5, len(self.blockchain.store.hash_index))
+
+    def test_shared_prefix(self):
+        headers = self.make_chain(4)
+        store = self.blockchain.store
+        store.commit(0, ''.join(headers))
+        digests = [store.read_hash(i) for i in range(4)]
+        self.assertEqual(3, store.find_hash(digests[3]))
+        # another hash with the prefix of height 1 takes its index entry
+        store.hash_index[digests[1][:8]] = 2
+        self.assertEqual(1, store.find_hash(digests[1]))
+        self.assertEqual(None, store.find_hash(digests[1][:8] + '\0'*24))
+
+
+class Test_ChunkCommit(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_ChunkCommit, self).setUp()
+        # proof of work is not what is tested here
+        self.blockchain.get_target = lambda height, chain=None, window=None: (0x1e0ffff0, 2**256)
+
+    def test_verify_chunk_commits_chunk(self):
+        headers = self.make_chain(20)
+        self.blockchain.verify_chunk(0, ''.join(headers).encode('hex'))
+        self.assertEqual(19, self.blockchain.height())
+        with open(self.blockchain.path(), 'rb') as f:
+            self.assertEqual(''.join(headers), f.read())
+        self.assertFalse(os.path.exists(self.blockchain.store.journal_path()))
+
+    def test_parallel_verification(self):
+        headers = self.make_chain(50)
+        self.config.set('parallel_verification', True)
+        # start the pool even if this machine has a single core
+        self.blockchain.pool = multiprocessing.Pool(2)
+        try:
+            self.blockchain.verify_chunk(0, ''.join(headers).encode('hex'))
+            self.assertEqual([], self.blockchain.hash_headers(''))
+            self.assertEqual(hash_raw_headers(headers[0]), self.blockchain.hash_headers(headers[0]))
+        finally:
+            self.blockchain.stop()
+        with open(self.blockchain.path(), 'rb') as f:
+            self.assertEqual(''.join(headers), f.read())
+
+    def test_bad_chunk_is_not_saved(self):
+        headers = self.make_chain(20)
+        headers[10] = make_raw_header("0"*64, 1400000000, 0x1e0ffff0)
+        self.assertRaises(AssertionError, self.blockchain.verify_chunk, 0, ''.join(headers).encode('hex'))
+        self.assertEqual(0, os.path.getsize(self.blockchain.path()))
+
+    def test_recover_interrupted_commit(self):
+        headers = self.make_chain(30)
+        self.blockchain.store.commit(0, ''.join(headers[:10]))
+        # simulate a crash in the middle of the next commit
+        with open(self.blockchain.store.journal_path(), 'wb') as f:
+            f.write("10 20")
+        with open(self.blockchain.path(), 'ab') as f:
+            f.write(''.join(headers[10:25]))
+        self.blockchain.init_headers_file()
+        self.assertEqual(10*80, os.path.getsize(self.blockchain.path()))
+        self.assertFalse(os.path.exists(self.blockchain.store.journal_path()))
+
+    def test_recover_partial_header(self):
+        headers = self.make_chain(3)
+        with open(self.blockchain.path(), 'wb') as f:
+            f.write(''.join(headers) + headers[0][:30])
+        self.blockchain.init_headers_file()
+        self.assertEqual(3*80, os.path.getsize(self.blockchain.path()))
+
+
+class Test_DGW3Window(BlockchainTestCase):
+
+    def make_headers(self, n):
+        headers = []
+        timestamp = 1400000000
+        for i in range(n):
+            # include out of order timestamps, they happen on mainnet
+            timestamp += random.randint(-100, 600)
+            target = random.randint(2**200, 2**228)
+            bits = self.blockchain.target_to_bits(target)
+            headers.append({'block_height':i, 'timestamp':timestamp, 'bits':bits})
+        return headers
+
+    def test_window_matches_reference(self):
+        headers = self.make_headers(120)
+        chain = dict((h['block_height'], h) for h in headers)
+        window = DGW3Window(self.blockchain)
+        for height in range(1, 120):
+            self.assertEqual(self.blockchain.get_target_dgw3(height, chain), window.get_target(height, chain))
+            window.push(height, headers[height])
+
+    def test_window_matches_reference_on_disk(self):
+        headers = self.make_headers(60)
+        for h in headers:
+            self.blockchain.save_header(dict(h, version=1, prev_block_hash="0"*64, merkle_root="0"*64, nonce=0))
+        window = DGW3Window(self.blockchain)
+        # not sequential: the window primes itself from the headers file
+        for height in [59, 30, 31, 45, 25]:
+            self.assertEqual(self.blockchain.get_target_dgw3(height), window.get_target(height))
+
+
+class Test_V1TargetCache(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_V1TargetCache, self).setUp()
+        timestamp = 1400000000
+        for i in range(300):
+            timestamp += random.randint(0, 300)
+            bits = self.blockchain.target_to_bits(random.randint(2**200, 2**226))
+            self.blockchain.save_header({'version':1, 'prev_block_hash':"0"*64, 'merkle_root':"0"*64,
+                                         'timestamp':timestamp, 'bits':bits, 'nonce':0}, i)
+
+    def uncached_target(self, height):
+        self.blockchain.v1_targets = {}
+        return self.blockchain.get_target_v1(height)
+
+    def test_cache_matches_uncached(self):
+        expected = [self.uncached_target(h) for h in range(300)]
+        self.blockchain.v1_targets = {}
+        self.assertEqual(expected, [self.blockchain.get_target_v1(h) for h in range(300)])
+        # one computation per retarget interval
+        self.assertEqual(range(80, 300, 4), sorted(self.blockchain.v1_targets.keys()))
+
+    def test_rollback_invalidates(self):
+        for h in range(300):
+            self.blockchain.get_target_v1(h)
+        self.blockchain.roll_back_to_last_chunk()
+        self.assertEqual(198, self.blockchain.height())
+        self.assertEqual(range(80, 199, 4), sorted(self.blockchain.v1_targets.keys()))
+
+
+class FakeInterface(object):
+    """ answers chunk requests from a list of raw headers """
+
+    def __init__(self, server, headers, chunk_size, corrupt=()):
+        self.server = server
+        self.headers = headers
+        self.chunk_size = chunk_size
+        self.corrupt = corrupt
+        self.is_connected = True
+        self.requests = []
+
+    def send_request(self, request, queue):
+        index = request['params'][0]
+        self.requests.append(index)
+        data = self.headers[index*self.chunk_size:(index+1)*self.chunk_size]
+        if index in self.corrupt:
+            data = data[:-1] + [make_raw_header("0"*64, 1400000000, 0x1e0ffff0)]
+        result = ''.join(data).encode('hex')
+        queue.put((self, {'method':request['method'], 'params':request['params'], 'result':result, 'id':None}))
+
+
+class FakeNetwork(object):
+
+    def __init__(self, interfaces, height):
+        self.interfaces = dict((i.server, i) for i in interfaces)
+        self.heights = dict((i.server, height) for i in interfaces)
+
+
+class Test_ChunkDownload(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_ChunkDownload, self).setUp()
+        self.blockchain.get_target = lambda height, chain=None, window=None: (0x1e0ffff0, 2**256)
+        self.blockchain.chunk_size = 10
+        self.blockchain.running = True
+        self.headers = self.make_chain(95)
+
+    def test_chunks_are_spread_and_verified_in_order(self):
+        interfaces = [FakeInterface('s%d'%k, self.headers, 10) for k in range(3)]
+        self.blockchain.network = FakeNetwork(interfaces, 94)
+        self.blockchain.set_local_height()
+        self.assertTrue(self.blockchain.get_and_verify_chunks(interfaces[0], None, 94))
+        self.assertEqual(94, self.blockchain.height())
+        with open(self.blockchain.path(), 'rb') as f:
+            self.assertEqual(''.join(self.headers), f.read())
+        for i in interfaces:
+            self.assertTrue(i.requests)
+
+    def test_bad_chunk_is_requested_from_another_server(self):
+        bad = FakeInterface('bad', self.headers, 10, corrupt=(range(10)))
+        good = FakeInterface('good', self.headers, 10)
+        self.blockchain.network = FakeNetwork([bad, good], 94)
+        self.blockchain.set_local_height()
+        self.assertTrue(self.blockchain.get_and_verify_chunks(bad, None, 94))
+        self.assertEqual(94, self.blockchain.height())
+        self.assertEqual(range(10), sorted(good.requests))
+
+
+class Test_Checkpoints(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_Checkpoints, self).setUp()
+        self.blockchain.chunk_size = 10
+        self.headers = self.make_chain(25)
+        for height in [9, 19]:
+            header = self.blockchain.header_from_string(self.headers[height])
+            self.blockchain.checkpoints[height] = self.blockchain.hash_header(header), header.get('bits')
+
+    def test_chunks_below_checkpoint(self):
+        # the synthetic headers have no valid proof of work
+        self.blockchain.verify_chunk(0, ''.join(self.headers[0:10]).encode('hex'))
+        self.blockchain.verify_chunk(1, ''.join(self.headers[10:20]).encode('hex'))
+        self.assertEqual(19, self.blockchain.height())
+        # above the last checkpoint, headers are fully verified
+        self.assertRaises(AssertionError, self.blockchain.verify_chunk, 2, ''.join(self.headers[20:25]).encode('hex'))
+
+    def test_checkpoint_mismatch(self):
+        other = self.make_chain(10)
+        self.assertRaises(AssertionError, self.blockchain.verify_chunk, 0, ''.join(other).encode('hex'))
+        self.assertEqual(0, os.path.getsize(self.blockchain.path()))
+
+    def test_broken_linkage(self):
+        headers = self.headers[0:10]
+        headers[4] = self.make_chain(1)[0]
+        self.assertRaises(AssertionError, self.blockchain.verify_chunk, 0, ''.join(headers).encode('hex'))
+
+    def test_full_verification(self):
+        self.blockchain.use_checkpoints = False
+        self.assertRaises(AssertionError, self.blockchain.verify_chunk, 0, ''.join(self.headers[0:10]).encode('hex'))
+
+
+class Test_CheckpointTable(BlockchainTestCase):
+
+    def write_table(self, entries):
+        path = os.path.join(self.user_dir, 'checkpoints.json')
+        with open(path, 'wb') as f:
+            f.write(json.dumps(entries))
+        return path
+
+    def test_shipped_table(self):
+        self.assertEqual(load_checkpoints(), Blockchain(self.config, None).checkpoints)
+
+    def test_table_from_file(self):
+        entries = [[2015, 'ab'*32, 0x1e0ffff0], [4031, 'cd'*32, 0x1d00ffff]]
+        self.config.set('checkpoints_file', self.write_table(entries))
+        blockchain = Blockchain(self.config, None)
+        self.assertEqual(('ab'*32, 0x1e0ffff0), blockchain.checkpoints[2015])
+        self.assertEqual(('cd'*32, 0x1d00ffff), blockchain.get_checkpoint(1, 2016))
+        self.assertEqual(None, blockchain.get_checkpoint(1, 2000))
+        self.config.set('full_verification', True)
+        self.assertEqual(None, Blockchain(self.config, None).get_checkpoint(1, 2016))
+
+    def test_invalid_entries(self):
+        for entry in [[2016, 'ab'*32, 1], [2015, 'ab'*31, 1], [2015, 'xy'*32, 1]]:
+            self.assertRaises(ValueError, load_checkpoints, self.write_table([entry]))
+        # a bad file is ignored: chunks are then fully verified
+        self.config.set('checkpoints_file', self.write_table([[2016, 'ab'*32, 1]]))
+        self.assertEqual(load_checkpoints(), Blockchain(self.config, None).checkpoints)
+        self.config.set('checkpoints_file', os.path.join(self.user_dir, 'missing'))
+        self.assertEqual(load_checkpoints(), Blockchain(self.config, None).checkpoints)
+
+
+class Test_Snapshot(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_Snapshot, self).setUp()
+        self.blockchain.chunk_size = 10
+        self.blockchain.get_target = lambda height, chain=None, window=None: (0x1e0ffff0, 2**256)
+        self.headers = self.make_chain(25)
+        self.blockchain.store.write(0, ''.join(self.headers))
+        self.blockchain.set_local_height()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.other_dir = tempfile.mkdtemp()
+        self.other = Blockchain(FakeConfig(self.other_dir), None)
+        self.other.chunk_size = 10
+        self.other.get_target = self.blockchain.get_target
+
+    def tearDown(self):
+        self.other.store.close()
+        shutil.rmtree(self.snapshot_dir)
+        shutil.rmtree(self.other_dir)
+        super(Test_Snapshot, self).tearDown()
+
+    def test_export_import(self):
+        manifest = self.blockchain.export_snapshot(self.snapshot_dir)
+        self.assertEqual(24, manifest['height'])
+        self.assertEqual([9, 19, 24], [h for h, _hash in manifest['hashes']])
+        self.assertEqual(24, self.other.import_snapshot(self.snapshot_dir))
+        with open(self.other.path(), 'rb') as f:
+            self.assertEqual(''.join(self.headers), f.read())
+
+    def test_export_is_read_only(self):
+        # a commit of the third chunk in progress, and a partial header
+        path = self.blockchain.path()
+        with open(self.blockchain.store.journal_path(), 'wb') as f:
+            f.write("20 10")
+        with open(path, 'ab') as f:
+            f.write('\0'*30)
+        files = [path, self.blockchain.store.journal_path(), self.blockchain.store.hashes_path()]
+        before = [open(name, 'rb').read() for name in files]
+        manifest = self.blockchain.export_snapshot(self.snapshot_dir)
+        self.assertEqual(before, [open(name, 'rb').read() for name in files])
+        self.assertEqual(19, manifest['height'])
+        self.assertEqual([9, 19], [h for h, _hash in manifest['hashes']])
+        os.remove(self.blockchain.store.journal_path())
+        self.assertEqual(24, self.blockchain.export_snapshot(self.snapshot_dir)['height'])
+        self.assertEqual(24, self.other.import_snapshot(self.snapshot_dir))
+
+    def test_tampered_snapshot(self):
+        self.blockchain.export_snapshot(self.snapshot_dir)
+        filename = os.path.join(self.snapshot_dir, 'blockchain_headers')
+        with open(filename, 'rb+') as f:
+            f.seek(12*80)
+            f.write(self.make_chain(1)[0])
+        self.assertRaises(BaseException, self.other.import_snapshot, self.snapshot_dir)
+        self.assertFalse(os.path.exists(self.other.path()))
+
+
+class HeaderInterface(object):
+    """ answers header requests from a list of raw headers """
+
+    def __init__(self, server, blockchain, headers):
+        self.server = server
+        self.blockchain = blockchain
+        self.headers = headers
+        self.requests = []
+
+    def get_header(self, height):
+        header = self.blockchain.header_from_string(self.headers[height])
+        header['block_height'] = height
+        return header
+
+    def send_request(self, request, queue):
+        height = request['params'][0]
+        self.requests.append(height)
+        result = self.get_header(height)
+        queue.put((self, {'method':request['method'], 'params':request['params'], 'result':result, 'id':None}))
+
+
+class ReorgNetwork(object):
+
+    def __init__(self):
+        self.reorgs = []
+        self.callbacks = {}
+        self.reorg_height = None
+
+    def blockchain_reorg(self, height):
+        self.reorgs.append(height)
+
+    def register_callback(self, event, callback):
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def trigger_callback(self, event):
+        for callback in self.callbacks.get(event, []):
+            callback()
+
+
+class FakeStorage(dict):
+
+    def put(self, key, value, save=True):
+        self[key] = value
+
+
+class Test_Reorg(BlockchainTestCase):
+
+    def setUp(self):
+        super(Test_Reorg, self).setUp()
+        self.blockchain.get_target = lambda height, chain=None, window=None: (0x1e0ffff0, 2**256)
+        self.blockchain.running = True
+        self.blockchain.network = ReorgNetwork()
+        self.headers = self.make_chain(40)
+        self.blockchain.store.commit(0, ''.join(self.headers))
+        self.blockchain.set_local_height()
+        # a longer branch that forks after height 29
+        self.branch = self.headers[:30] + self.extend(self.headers[29], 15)
+
+    def extend(self, raw, n):
+        prev_hash = self.blockchain.hash_header(self.blockchain.header_from_string(raw))
+        data = []
+        for i in range(n):
+            raw = make_raw_header(prev_hash, 1500000000 + 60*i, 0x1e0ffff0)
+            prev_hash = self.blockchain.hash_header(self.blockchain.header_from_string(raw))
+            data.append(raw)
+        return data
+
+    def test_missing_headers_are_batched(self):
+        headers = self.headers + self.extend(self.headers[-1], 6)
+        interface = HeaderInterface('s', self.blockchain, headers)
+        chain = self.blockchain.get_chain(interface, interface.get_header(45))
+        self.assertEqual(range(40, 46), [header.get('block_height') for header in chain])
+        self.assertEqual(range(40, 45), sorted(interface.requests))
+
+    def test_fork_point(self):
+        interface = HeaderInterface('s', self.blockchain, self.branch)
+        chain = self.blockchain.get_chain(interface, interface.get_header(44))
+        self.assertEqual(range(30, 45), [header.get('block_height') for header in chain])
+        # the walk back does not go further than one batch below the tip
+        self.assertTrue(min(interface.requests) >= 40 - self.blockchain.header_batch_size)
+        self.assertTrue(self.blockchain.verify_chain(chain))
+        self.blockchain.save_chain(chain)
+        self.assertEqual(44, self.blockchain.height())
+        self.assertEqual([30], self.blockchain.network.reorgs)
+        with open(self.blockchain.path(), 'rb') as f:
+            self.assertEqual(''.join(self.branch), f.read())
+        self.assertEqual(self.blockchain.hash_header(interface.get_header(44)), self.blockchain.get_block_hash(44))
+
+    def test_fork_too_deep(self):
+        self.blockchain.max_reorg_depth = 10
+        self.blockchain.chunk_size = 10
+        interface = HeaderInterface('s', self.blockchain, self.branch)
+        self.assertEqual(None, self.blockchain.get_chain(interface, interface.get_header(44)))
+        # the local chain goes back to the chunk below the search limit
+        self.assertEqual(30*80, os.path.getsize(self.blockchain.path()))
+        self.assertEqual(29, self.blockchain.height())
+        # and the server's branch is then synchronized by chunks
+        chunks = FakeInterface('s', self.branch, 10)
+        self.blockchain.network = FakeNetwork([chunks], 44)
+        self.assertTrue(self.blockchain.get_and_verify_chunks(chunks, None, 44))
+        with open(self.blockchain.path(), 'rb') as f:
+            self.assertEqual(''.join(self.branch), f.read())
+
+    def test_inconsistent_server(self):
+        branch = self.branch[:]
+        branch[42] = self.make_chain(1)[0]
+        interface = HeaderInterface('s', self.blockchain, branch)
+        self.assertEqual(None, self.blockchain.get_chain(interface, interface.get_header(44)))
+
+    def test_verifications_are_undone(self):
+        from lib.verifier import TxVerifier
+        storage = FakeStorage()
+        storage['verified_tx3'] = {'a': (29, 0, 0), 'b': (30, 0, 0), 'c': (35, 0, 0)}
+        verifier = TxVerifier(self.blockchain.network, storage)
+        verifier.requested_merkle.update(['a', 'b', 'c'])
+        self.blockchain.network.reorg_height = 30
+        self.blockchain.network.trigger_callback('reorg')
+        self.assertEqual(['a'], storage['verified_tx3'].keys())
+        self.assertEqual(set(['a']), verifier.requested_merkle)
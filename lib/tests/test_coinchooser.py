@@ -0,0 +1,161 @@
+import os
+import random
+import unittest
+
+from lib.coinchooser import UTXOPool, CoinChooser, get_chooser, coin_key, age_key
+from lib.transaction import SizeEstimator
+
+FEE_PER_KB = 10000
+DUST = 5430
+
+
+def make_coin(value, height, address='addr'):
+    return {'address': address, 'value': value, 'height': height, 'coinbase': False,
+            'prevout_hash': os.urandom(32).encode('hex'), 'prevout_n': random.randint(0, 3)}
+
+
+def fee_for_size(size):
+    return max(1000, FEE_PER_KB*size/1000)
+
+
+def old_sort(coins):
+    # the ordering of Wallet.get_unspent_coins before the pool existed
+    coins = sorted((coin['height'], age_key(coin), coin) for coin in coins)
+    if coins and coins[-1][0] != 0:
+        while coins[0][0] == 0:
+            coins = coins[1:] + [ coins[0] ]
+    return [x[2] for x in coins]
+
+
+class Test_UTXOPool(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.pool = UTXOPool()
+
+    def test_orders(self):
+        coins = [make_coin(random.randint(1, 10**8), random.choice([0, 0, 5, 10, 300])) for i in range(200)]
+        for coin in coins:
+            self.pool.add(coin)
+        self.assertEqual(len(self.pool), 200)
+        self.assertEqual(self.pool.get_coins(), old_sort(coins))
+        by_value = self.pool.get_coins(order='value')
+        self.assertEqual([c['value'] for c in by_value], sorted(c['value'] for c in coins))
+
+    def test_unconfirmed_only(self):
+        coins = [make_coin(1000, 0) for i in range(5)]
+        for coin in coins:
+            self.pool.add(coin)
+        self.assertEqual(self.pool.get_coins(), old_sort(coins))
+
+    def test_remove(self):
+        coins = [make_coin(1000*i, i) for i in range(1, 20)]
+        for coin in coins:
+            self.pool.add(coin)
+        for coin in coins[::2]:
+            self.pool.remove(coin_key(coin))
+        self.pool.remove('unknown:0')
+        self.assertEqual(self.pool.get_coins(), coins[1::2])
+        self.assertEqual(self.pool.get_coins(order='value'), coins[1::2])
+        self.assertFalse(coin_key(coins[0]) in self.pool)
+
+    def test_set_address(self):
+        a = [make_coin(1000, 10, 'a') for i in range(3)]
+        b = [make_coin(2000, 20, 'b') for i in range(3)]
+        self.pool.set_address('a', a)
+        self.pool.set_address('b', b)
+        # one coin spent, another confirmed at a new height
+        moved = dict(a[1], height=5)
+        self.pool.set_address('a', [a[0], moved], complete=False)
+        self.assertEqual(len(self.pool), 5)
+        self.assertEqual(self.pool.get_coins(['a']), [moved, a[0]])
+        self.assertEqual(self.pool.get_coins(['b']), old_sort(b))
+        self.assertFalse(self.pool.is_complete())
+        self.assertFalse(self.pool.is_complete(['a', 'b']))
+        self.assertTrue(self.pool.is_complete(['b']))
+        self.pool.set_address('a', [])
+        self.assertTrue(self.pool.is_complete())
+        self.assertEqual(self.pool.get_coins(), old_sort(b))
+
+
+class Test_CoinChooser(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(2)
+        self.outputs = [('address', '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2', 0)]
+        self.pool = UTXOPool()
+
+    def choose(self, name, amount, coins, fee=fee_for_size, dust=DUST):
+        for coin in coins:
+            self.pool.add(coin)
+        chooser = get_chooser(name)
+        size = SizeEstimator(self.outputs, lambda txin: 148)
+        selected = chooser.choose(self.pool.get_coins(order=chooser.order), amount, size, fee, dust)
+        if selected is not None:
+            # the estimator holds exactly the selected inputs
+            self.assertEqual(size.num_inputs, len(selected))
+            self.assertEqual(size.size(), SizeEstimator(self.outputs).size() + 148*len(selected) + (len(selected) >= 0xfd)*2)
+            self.assertEqual(len(set(map(coin_key, selected))), len(selected))
+        return selected, size
+
+    def check_covers(self, selected, size, amount, fee=fee_for_size):
+        self.assertTrue(sum(c['value'] for c in selected) >= amount + fee(size.size()))
+
+    def test_oldest(self):
+        coins = [make_coin(10**6*(i+1), i+1) for i in range(10)]
+        selected, size = self.choose('oldest', 25*10**6, coins)
+        self.assertEqual(selected, coins[:7])
+        self.check_covers(selected, size, 25*10**6)
+        # the base strategy is oldest first
+        size = SizeEstimator(self.outputs, lambda txin: 148)
+        self.assertEqual(CoinChooser().choose(coins, 25*10**6, size, fee_for_size, DUST), coins[:7])
+
+    def test_largest(self):
+        coins = [make_coin(10**6*(i+1), 100-i) for i in range(10)]
+        selected, size = self.choose('largest', 25*10**6, coins)
+        self.assertEqual(selected, coins[::-1][:3])
+        self.check_covers(selected, size, 25*10**6)
+
+    def test_not_enough(self):
+        coins = [make_coin(10**6, 10) for i in range(10)]
+        for name in ['oldest', 'largest', 'bnb', 'consolidate']:
+            self.pool = UTXOPool()
+            self.assertEqual(self.choose(name, 10**7, coins)[0], None)
+
+    def test_bnb_exact(self):
+        coins = [make_coin(random.randint(10**5, 10**8), 10) for i in range(40)]
+        target = random.sample(coins, 3)
+        # an amount that these three coins pay without change
+        size = SizeEstimator(self.outputs).size() + 3*148
+        amount = sum(c['value'] for c in target) - fee_for_size(size) - 100
+        selected, size = self.choose('bnb', amount, coins)
+        total = sum(c['value'] for c in selected)
+        excess = total - amount - fee_for_size(size.size())
+        self.assertTrue(0 <= excess <= DUST)
+
+    def test_bnb_fixed_fee(self):
+        coins = [make_coin(1000*i, 10) for i in range(1, 30)]
+        selected, size = self.choose('bnb', 50000, coins, lambda s: 1000, 0)
+        self.assertEqual(sum(c['value'] for c in selected), 51000)
+
+    def test_bnb_fallback(self):
+        # no subset avoids change: oldest first is used
+        coins = [make_coin(10**8, 100-i) for i in range(5)]
+        selected, size = self.choose('bnb', 10**8, coins)
+        self.assertEqual(selected, coins[::-1][:2])
+
+    def test_consolidate(self):
+        small = [make_coin(20000 + i, 10) for i in range(80)]
+        dust = [make_coin(100, 10) for i in range(5)]
+        large = [make_coin(10**8, 10)]
+        selected, size = self.choose('consolidate', 5*10**7, small + dust + large)
+        chooser = get_chooser('consolidate')
+        # uneconomic coins are left, small coins are merged up to the limit
+        self.assertFalse(set(map(coin_key, dust)) & set(map(coin_key, selected)))
+        self.assertEqual(len(selected), chooser.max_inputs + 1)
+        self.assertTrue(large[0] in selected)
+        self.check_covers(selected, size, 5*10**7)
+
+    def test_unknown(self):
+        self.assertRaises(BaseException, get_chooser, 'random')
+        self.assertEqual(get_chooser(None).name, 'oldest')
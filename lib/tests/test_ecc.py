@@ -0,0 +1,111 @@
+import hashlib
+import hmac
+import random
+import unittest
+
+import ecdsa
+from ecdsa.curves import SECP256k1
+from ecdsa.util import number_to_string, sigencode_strings, string_to_number
+
+from lib import ecc
+from lib.account import OldAccount
+from lib.bitcoin import EC_KEY, SecretToASecret, _CKD_pub, get_pubkeys_from_secret, point_to_ser, ser_to_point
+from lib.transaction import sign_digest
+
+G = SECP256k1.generator
+N = SECP256k1.order
+
+
+def affine(point):
+    return (point.x(), point.y())
+
+
+class Test_ecc(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(5)
+        self.scalars = [1, 2, 3, 15, 16, 17, 2**128, 2**255, N-2, N-1] + [random.randrange(1, N) for i in range(20)]
+
+    def test_mul_G(self):
+        for k in self.scalars:
+            self.assertEqual(ecc.mul_G(k), affine(k*G))
+        self.assertEqual(ecc.mul_G(0), None)
+        self.assertEqual(ecc.mul_G(N), None)
+        self.assertEqual(ecc.mul_G(N+1), ecc.G)
+
+    def test_mul(self):
+        point = random.randrange(1, N)*G
+        for k in self.scalars:
+            self.assertEqual(ecc.mul(affine(point), k), affine(k*point))
+        self.assertEqual(ecc.mul(affine(point), N), None)
+        self.assertEqual(ecc.mul(None, 5), None)
+
+    def test_add(self):
+        p = affine(7*G)
+        self.assertEqual(ecc.add(p, ecc.mul_G(9)), affine(16*G))
+        self.assertEqual(ecc.add(p, p), affine(14*G))
+        self.assertEqual(ecc.add(p, ecc.mul_G(N-7)), None)
+        self.assertEqual(ecc.add(None, p), p)
+        self.assertEqual(ecc.mul_add(3, 5, p), affine(38*G))
+
+    def test_encoding(self):
+        for k in self.scalars[:10]:
+            point = ecc.mul_G(k)
+            for compressed in [True, False]:
+                ser = ecc.encode_point(point, compressed)
+                self.assertEqual(ser, point_to_ser(k*G, compressed))
+                self.assertEqual(ecc.decode_point(ser), point)
+                self.assertEqual(affine(ser_to_point(ser)), point)
+        self.assertRaises(ValueError, ecc.decode_point, '\x04' + '\x01'*64)
+        self.assertRaises(ValueError, ecc.decode_point, '\x02' + '\xff'*32)
+        self.assertRaises(ValueError, ecc.decode_point, '\x05' + '\x01'*32)
+
+    def test_sign(self):
+        for k in self.scalars:
+            digest = hashlib.sha256(str(k)).digest()
+            key = ecdsa.SigningKey.from_secret_exponent(k, curve=SECP256k1)
+            expected = key.sign_digest_deterministic(digest, hashfunc=hashlib.sha256, sigencode=sigencode_strings)
+            r, s = ecc.sign(k, digest)
+            self.assertEqual((r, s), tuple(map(string_to_number, expected)))
+            point = ecc.mul_G(k)
+            self.assertTrue(ecc.verify(point, digest, r, s))
+            self.assertFalse(ecc.verify(point, digest, r, (s+1) % N))
+            self.assertFalse(ecc.verify(point, digest, 0, s))
+            recovered = [ecc.recover(digest, r, s, recid) for recid in range(2)]
+            self.assertTrue(point in recovered)
+
+    def test_sign_digest(self):
+        for k in self.scalars[:5]:
+            digest = hashlib.sha256(str(k)).digest()
+            key = ecdsa.SigningKey.from_secret_exponent(k, curve=SECP256k1)
+            expected = key.sign_digest_deterministic(digest, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_der)
+            sec = SecretToASecret(number_to_string(k, N), True)
+            self.assertEqual(sign_digest((sec, digest)), expected.encode('hex'))
+
+    def test_ec_key(self):
+        k = self.scalars[-1]
+        key = EC_KEY(number_to_string(k, N))
+        self.assertEqual(key.point, ecc.mul_G(k))
+        self.assertEqual(affine(key.pubkey.point), key.point)
+        self.assertEqual(key.privkey.secret_multiplier, k)
+        self.assertEqual(key.get_public_key(False), point_to_ser(k*G, False).encode('hex'))
+        self.assertTrue(key.pubkey is key.pubkey)
+        self.assertTrue(key.privkey is key.privkey)
+
+    def test_derivation(self):
+        for k in self.scalars[:5]:
+            secret = number_to_string(k, N)
+            vk = ecdsa.SigningKey.from_string(secret, curve=SECP256k1).get_verifying_key()
+            self.assertEqual(get_pubkeys_from_secret(secret), (vk.to_string(), point_to_ser(vk.pubkey.point, True)))
+            c = hashlib.sha256(secret).digest()
+            cK = point_to_ser(vk.pubkey.point, True)
+            I = string_to_number(hmac.new(c, cK + '\x00'*4, hashlib.sha512).digest()[:32])
+            expected = point_to_ser(I*G + vk.pubkey.point, True)
+            self.assertEqual(_CKD_pub(cK, c, '\x00'*4)[0], expected)
+
+    def test_old_account(self):
+        mpk = affine(self.scalars[-1]*G)
+        mpk = ('%064x%064x'%mpk).decode('hex')
+        z = OldAccount.get_sequence(mpk, 0, 3)
+        expected = point_to_ser(ser_to_point('\x04' + mpk) + z*G, False).encode('hex')
+        self.assertEqual(OldAccount.get_pubkey_from_mpk(mpk, 0, 3), expected)
@@ -0,0 +1,708 @@
+import multiprocessing
+import os
+import random
+import unittest
+
+import ecdsa
+
+from lib.bitcoin import int_to_hex, var_int, op_push, hash_160, hash_160_to_bc_address, Hash, bc_address_to_hash_160
+from lib.bitcoin import SecretToASecret, public_key_from_private_key, public_key_to_bc_address, ser_to_point
+from lib import bitcoin, transaction
+from lib.transaction import Transaction, BCDataStream, SerializationError, parse_scriptSig, decode_output_script
+from lib.transaction import SighashEngine, SizeEstimator, push_script, NO_SIGNATURE
+from lib.transaction import TxInput, TxOutput
+
+
+def push(data):
+    return op_push(len(data)/2) + data
+
+
+def random_pubkey(compressed=True):
+    if compressed:
+        return random.choice(['02', '03']) + os.urandom(32).encode('hex')
+    return '04' + os.urandom(64).encode('hex')
+
+
+def random_sig():
+    return '3045' + os.urandom(69).encode('hex') + '01'
+
+
+def p2pkh_input(pubkey=None):
+    script = push(random_sig()) + push(pubkey or random_pubkey())
+    return os.urandom(32).encode('hex') + int_to_hex(random.randint(0, 5), 4) \
+        + var_int(len(script)/2) + script + 'ffffffff'
+
+
+def p2sh_input(n=3):
+    pubkeys = [random_pubkey() for i in range(n)]
+    redeem_script = Transaction.multisig_script(pubkeys, 2)
+    script = '00' + push(random_sig()) + push(random_sig()) + push(redeem_script)
+    return os.urandom(32).encode('hex') + int_to_hex(1, 4) \
+        + var_int(len(script)/2) + script + 'ffffffff'
+
+
+def coinbase_input():
+    script = os.urandom(8).encode('hex')
+    return '00'*32 + 'ffffffff' + var_int(len(script)/2) + script + 'ffffffff'
+
+
+def random_output(kind=None):
+    kind = kind or random.choice(['p2pkh', 'p2sh', 'pubkey', 'op_return', 'other'])
+    if kind == 'p2pkh':
+        script = '76a9' + push(os.urandom(20).encode('hex')) + '88ac'
+    elif kind == 'p2sh':
+        script = 'a9' + push(os.urandom(20).encode('hex')) + '87'
+    elif kind == 'pubkey':
+        script = push(random_pubkey(random.choice([True, False]))) + 'ac'
+    elif kind == 'op_return':
+        script = '6a' + push('hello'.encode('hex'))
+    else:
+        script = '51'
+    return int_to_hex(random.randint(0, 10**10), 8) + var_int(len(script)/2) + script
+
+
+def make_raw_tx(inputs, outputs, locktime=0):
+    return int_to_hex(1, 4) + var_int(len(inputs)) + ''.join(inputs) \
+        + var_int(len(outputs)) + ''.join(outputs) + int_to_hex(locktime, 4)
+
+
+def random_raw_tx():
+    inputs = [random.choice([p2pkh_input, p2sh_input])() for i in range(random.randint(1, 5))]
+    outputs = [random_output() for i in range(random.randint(1, 5))]
+    return make_raw_tx(inputs, outputs, random.randint(0, 2**32-1))
+
+
+def make_keypair(compressed=True):
+    sec = SecretToASecret(os.urandom(32), compressed)
+    return public_key_from_private_key(sec), sec
+
+
+def random_address(addrtype=50):
+    return hash_160_to_bc_address(os.urandom(20), addrtype)
+
+
+def p2pkh_txin(pubkey=None):
+    pubkey = pubkey or random_pubkey()
+    return {'prevout_hash': os.urandom(32).encode('hex'), 'prevout_n': random.randint(0, 5),
+            'address': public_key_to_bc_address(pubkey.decode('hex')), 'value': random.randint(1, 10**8),
+            'pubkeys': [pubkey], 'x_pubkeys': [pubkey], 'signatures': [None], 'num_sig': 1}
+
+
+def p2sh_txin(pubkeys=None):
+    pubkeys = pubkeys or [random_pubkey() for i in range(3)]
+    redeem_script = Transaction.multisig_script(pubkeys, 2)
+    return {'prevout_hash': os.urandom(32).encode('hex'), 'prevout_n': random.randint(0, 5),
+            'address': hash_160_to_bc_address(hash_160(redeem_script.decode('hex')), 9),
+            'value': random.randint(1, 10**8), 'redeemScript': redeem_script,
+            'pubkeys': pubkeys, 'x_pubkeys': pubkeys[:], 'signatures': [None]*len(pubkeys), 'num_sig': 2}
+
+
+def make_unsigned_tx(n):
+    inputs = [random.choice([p2pkh_txin, p2sh_txin])() for i in range(n)]
+    outputs = [('address', random_address(), 10**6), ('address', random_address(9), 2*10**6),
+               ('op_return', 'hello', 0)]
+    return Transaction(inputs, outputs)
+
+
+def verify_signature(pubkey, sig, digest):
+    public_key = ecdsa.VerifyingKey.from_public_point(ser_to_point(pubkey.decode('hex')), curve=ecdsa.curves.SECP256k1)
+    return public_key.verify_digest(sig.decode('hex'), digest, sigdecode=ecdsa.util.sigdecode_der)
+
+
+def stream_parse_input(vds):
+    d = {}
+    prevout_hash = vds.read_bytes(32)[::-1].encode('hex')
+    prevout_n = vds.read_uint32()
+    d['scriptSig'] = scriptSig = vds.read_bytes(vds.read_compact_size())
+    sequence = vds.read_uint32()
+    if prevout_hash == '00'*32:
+        d['is_coinbase'] = True
+    else:
+        d['is_coinbase'] = False
+        d['prevout_hash'] = prevout_hash
+        d['prevout_n'] = prevout_n
+        d['sequence'] = sequence
+        d['pubkeys'] = []
+        d['signatures'] = {}
+        d['address'] = None
+        if scriptSig:
+            parse_scriptSig(d, scriptSig)
+    return d
+
+
+def stream_parse_output(vds, i):
+    d = {}
+    d['value'] = vds.read_int64()
+    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    d['type'], d['address'] = decode_output_script(scriptPubKey)
+    d['scriptPubKey'] = scriptPubKey.encode('hex')
+    d['prevout_n'] = i
+    return d
+
+
+def stream_deserialize(raw):
+    """ reference parser: the stream based deserializer that the offset
+    parser replaced, with none of its helpers """
+    vds = BCDataStream()
+    vds.write(raw.decode('hex'))
+    d = {}
+    d['version'] = vds.read_int32()
+    d['inputs'] = [stream_parse_input(vds) for i in xrange(vds.read_compact_size())]
+    n_vout = vds.read_compact_size()
+    d['outputs'] = [stream_parse_output(vds, i) for i in xrange(n_vout)]
+    d['lockTime'] = vds.read_uint32()
+    return d
+
+
+# fixed transactions, and their fields as decoded by the stream parser
+STANDARD_TX = (
+    '0100000002cbf23a4798bf04e2f3c8fbda3f8fbc6bea48f3480e98a0146119322811f6479b020000006b483045f3f15a23'
+    'e43f1388ece45c2f00ba41bfd2920b2279d403707655f6153c114205f3f15a23e43f1388ece45c2f00ba41bfd2920b22'
+    '79d403707655f6153c114205f3f15a23e40121026c5d5e73124f3c821c0985df787e11b3d018a86add577fa8661613a0'
+    'd49dde59feffffff9c21b02981cdc19c0dacf77de6e6d6c8d6f6b3d9356f59139ade76a6f6a101ce00000000fdfe0000'
+    '483045645761ef0cb669e4c9879bb2dbb64c5fdd8de10211f307fd0d0366b6b96ceee5645761ef0cb669e4c9879bb2db'
+    'b64c5fdd8de10211f307fd0d0366b6b96ceee5645761ef0c01483045c7ef45afd6494bc8bb44b5274ce2e46d91eba5ad'
+    '8b7136a693829bea4bbd5a59c7ef45afd6494bc8bb44b5274ce2e46d91eba5ad8b7136a693829bea4bbd5a59c7ef45af'
+    'd6014c69522103f771877964fa2ce401d87bc2558a0df1e6921acef99389f059712b32cfda35fd2103f039fdcdb728ef'
+    'bbddf4ee452419a988497debb7bd1b42644c5fa66e9af8c8b621026da0e4d65a933e828c9de388005281dfa7e4948895'
+    'd10c7c3ef617b5e40d97fd53aeffffffff0380d1f008000000001976a914ca978112ca1bbdcafac231b39a23dc4da786'
+    'eff888acc40900000000000017a9143e23e8160039594a33894f6564e1b1348bbd7a00870000000000000000076a0568'
+    '656c6c6f40e20100')
+
+PUBKEYS = [
+    '026c5d5e73124f3c821c0985df787e11b3d018a86add577fa8661613a0d49dde59',
+    '03f771877964fa2ce401d87bc2558a0df1e6921acef99389f059712b32cfda35fd',
+    '03f039fdcdb728efbbddf4ee452419a988497debb7bd1b42644c5fa66e9af8c8b6',
+    '026da0e4d65a933e828c9de388005281dfa7e4948895d10c7c3ef617b5e40d97fd']
+
+SIGNATURES = [
+    '3045f3f15a23e43f1388ece45c2f00ba41bfd2920b2279d403707655f6153c114205f3f15a23e43f1388ece45c2f00'
+    'ba41bfd2920b2279d403707655f6153c114205f3f15a23e4',
+    '3045645761ef0cb669e4c9879bb2dbb64c5fdd8de10211f307fd0d0366b6b96ceee5645761ef0cb669e4c9879bb2db'
+    'b64c5fdd8de10211f307fd0d0366b6b96ceee5645761ef0c',
+    '3045c7ef45afd6494bc8bb44b5274ce2e46d91eba5ad8b7136a693829bea4bbd5a59c7ef45afd6494bc8bb44b5274c'
+    'e2e46d91eba5ad8b7136a693829bea4bbd5a59c7ef45afd6']
+
+REDEEM_SCRIPT = '5221' + PUBKEYS[1] + '21' + PUBKEYS[2] + '21' + PUBKEYS[3] + '53ae'
+
+STANDARD_TX_FIELDS = {
+    'version': 1,
+    'lockTime': 123456,
+    'inputs': [
+        {'is_coinbase': False,
+         'prevout_hash': '9b47f6112832196114a0980e48f348ea6bbc8f3fdafbc8f3e204bf98473af2cb',
+         'prevout_n': 2,
+         'sequence': 4294967294,
+         'scriptSig': ('48' + SIGNATURES[0] + '0121' + PUBKEYS[0]).decode('hex'),
+         'address': 'MPNJSDMrkrWMUFdgMYiAkfya74X76rY36T',
+         'num_sig': 1,
+         'pubkeys': PUBKEYS[:1],
+         'x_pubkeys': PUBKEYS[:1],
+         'signatures': SIGNATURES[:1]},
+        {'is_coinbase': False,
+         'prevout_hash': 'ce01a1f6a676de9a13596f35d9b3f6d6c8d6e6e67df7ac0d9cc1cd8129b0219c',
+         'prevout_n': 0,
+         'sequence': 4294967295,
+         'scriptSig': ('0048' + SIGNATURES[1] + '0148' + SIGNATURES[2] + '014c69' + REDEEM_SCRIPT).decode('hex'),
+         'address': '51KttqWXi3BvVCqQewUouvdqu1F517o3zu',
+         'num_sig': 2,
+         'redeemScript': REDEEM_SCRIPT,
+         'pubkeys': PUBKEYS[1:],
+         'x_pubkeys': PUBKEYS[1:],
+         'signatures': SIGNATURES[1:]}],
+    'outputs': [
+        {'type': 'address', 'address': 'MSNNDskTexZKWRSZ2sxHDrvEtmmfLAQrUq', 'value': 150000000,
+         'scriptPubKey': '76a914ca978112ca1bbdcafac231b39a23dc4da786eff888ac', 'prevout_n': 0},
+        {'type': 'address', 'address': '4ihzmhqYTWyshXLyPB734anhoxs1ggX9xe', 'value': 2500,
+         'scriptPubKey': 'a9143e23e8160039594a33894f6564e1b1348bbd7a0087', 'prevout_n': 1},
+        {'type': 'op_return', 'address': 'hello', 'value': 0,
+         'scriptPubKey': '6a0568656c6c6f', 'prevout_n': 2}],
+}
+
+COINBASE_TX = (
+    '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff08103d6254a6d9'
+    '4bacffffffff0100f2052a010000002321026c5d5e73124f3c821c0985df787e11b3d018a86add577fa8661613a0d49d'
+    'de59ac00000000')
+
+COINBASE_TX_FIELDS = {
+    'version': 1,
+    'lockTime': 0,
+    'inputs': [{'is_coinbase': True, 'scriptSig': '103d6254a6d94bac'.decode('hex')}],
+    'outputs': [
+        {'type': 'pubkey', 'address': PUBKEYS[0], 'value': 5000000000,
+         'scriptPubKey': '21' + PUBKEYS[0] + 'ac', 'prevout_n': 0}],
+}
+
+
+def hex_pay_script(type, addr):
+    if type == 'op_return':
+        h = addr.encode('hex')
+        return '6a' + push_script(h)
+    else:
+        assert type == 'address'
+    addrtype, hash_160 = bc_address_to_hash_160(addr)
+    if addrtype == 50:
+        script = '76a9'                                      # op_dup, op_hash_160
+        script += push_script(hash_160.encode('hex'))
+        script += '88ac'                                     # op_equalverify, op_checksig
+    elif addrtype == 9:
+        script = 'a9'                                        # op_hash_160
+        script += push_script(hash_160.encode('hex'))
+        script += '87'                                       # op_equal
+    else:
+        raise
+    return script
+
+
+def hex_serialize(tx, for_sig=None):
+    """ reference serializer, building hex strings """
+    # for_sig:
+    #   -1   : do not sign, estimate length
+    #   i>=0 : sign input i
+    #   None : add all signatures
+
+    inputs = tx.inputs
+    outputs = tx.outputs
+
+    s  = int_to_hex(1,4)                                         # version
+    s += var_int( len(inputs) )                                  # number of inputs
+    for i in range(len(inputs)):
+        txin = inputs[i]
+
+        s += txin['prevout_hash'].decode('hex')[::-1].encode('hex')   # prev hash
+        s += int_to_hex(txin['prevout_n'],4)                          # prev index
+
+        p2sh = txin.get('redeemScript') is not None
+        num_sig = txin['num_sig']
+        address = txin['address']
+
+        x_signatures = txin['signatures']
+        signatures = filter(lambda x: x is not None, x_signatures)
+        is_complete = len(signatures) == num_sig
+
+        if for_sig in [-1, None]:
+            # if we have enough signatures, we use the actual pubkeys
+            # use extended pubkeys (with bip32 derivation)
+            sig_list = []
+            if for_sig == -1:
+                # we assume that signature will be 0x48 bytes long
+                pubkeys = txin['pubkeys']
+                sig_list = [ "00"* 0x48 ] * num_sig
+            elif is_complete:
+                pubkeys = txin['pubkeys']
+                for signature in signatures:
+                    sig_list.append(signature + '01')
+            else:
+                pubkeys = txin['x_pubkeys']
+                for signature in x_signatures:
+                    sig_list.append((signature + '01') if signature is not None else NO_SIGNATURE)
+
+            sig_list = ''.join( map( lambda x: push_script(x), sig_list))
+            if not p2sh:
+                script = sig_list
+                script += push_script(pubkeys[0])
+            else:
+                script = '00'                                    # op_0
+                script += sig_list
+                redeem_script = Transaction.multisig_script(pubkeys,2)
+                script += push_script(redeem_script)
+
+        elif for_sig==i:
+            script = txin['redeemScript'] if p2sh else hex_pay_script('address', address)
+        else:
+            script = ''
+
+        s += var_int( len(script)/2 )                            # script length
+        s += script
+        s += "ffffffff"                                          # sequence
+
+    s += var_int( len(outputs) )                                 # number of outputs
+    for output in outputs:
+        type, addr, amount = output
+        s += int_to_hex( amount, 8)                              # amount
+        script = hex_pay_script(type, addr)
+        s += var_int( len(script)/2 )                           #  script length
+        s += script                                             #  script
+    s += int_to_hex(0,4)                                        #  lock time
+    if for_sig is not None and for_sig != -1:
+        s += int_to_hex(1, 4)                                   #  hash type
+    return s
+
+
+class Test_Deserialize(unittest.TestCase):
+
+    def test_known_fields(self):
+        for raw, fields in [(STANDARD_TX, STANDARD_TX_FIELDS), (COINBASE_TX, COINBASE_TX_FIELDS)]:
+            self.assertEqual(fields, stream_deserialize(raw))
+            self.assertEqual(fields, transaction.deserialize(raw))
+
+    def test_matches_stream_parser(self):
+        for i in range(50):
+            raw = random_raw_tx()
+            self.assertEqual(stream_deserialize(raw), transaction.deserialize(raw))
+
+    def test_coinbase(self):
+        raw = make_raw_tx([coinbase_input()], [random_output('p2pkh')])
+        d = transaction.deserialize(raw)
+        self.assertTrue(d['inputs'][0]['is_coinbase'])
+        self.assertEqual(stream_deserialize(raw), d)
+
+    def test_large_counts(self):
+        # var_int sizes above 252 use a longer encoding
+        raw = make_raw_tx([p2pkh_input()], [random_output('p2pkh') for i in range(300)])
+        d = transaction.deserialize(raw)
+        self.assertEqual(300, len(d['outputs']))
+        self.assertEqual(299, d['outputs'][-1]['prevout_n'])
+        self.assertEqual(stream_deserialize(raw), d)
+
+    def test_address_types(self):
+        pubkey = random_pubkey()
+        raw = make_raw_tx([p2pkh_input(pubkey), p2sh_input(2)], [random_output('p2sh')])
+        d = transaction.deserialize(raw)
+        self.assertEqual(hash_160_to_bc_address(hash_160(pubkey.decode('hex'))), d['inputs'][0]['address'])
+        self.assertEqual(2, len(d['inputs'][1]['pubkeys']))
+        self.assertEqual('address', d['outputs'][0]['type'])
+
+    def test_truncated(self):
+        raw = random_raw_tx()
+        self.assertRaises(SerializationError, transaction.deserialize, raw[:-10])
+
+
+class Test_LazyTransaction(unittest.TestCase):
+
+    def test_parsed_on_access(self):
+        raw = random_raw_tx()
+        d = transaction.deserialize(raw)
+        tx = Transaction.deserialize(raw)
+        self.assertEqual(None, tx._inputs)
+        self.assertEqual(None, tx._outputs)
+        self.assertEqual(d['lockTime'], tx.locktime)
+        self.assertEqual([(o['type'], o['address'], o['value']) for o in d['outputs']], tx.outputs)
+        self.assertEqual(None, tx._inputs)
+        self.assertEqual(d['inputs'], tx.inputs)
+
+    def test_parsed_before_raw_is_dropped(self):
+        txin, output = p2pkh_input(), random_output('p2pkh')
+        raw = make_raw_tx([txin], [output])
+        outputs = Transaction.deserialize(raw).outputs
+        tx = Transaction.deserialize(raw)
+        tx.add_input(dict(transaction.deserialize(raw)['inputs'][0]))
+        self.assertEqual(outputs, tx.outputs)
+        self.assertEqual(make_raw_tx([txin, txin], [output]), tx.serialize())
+        tx = Transaction.deserialize(raw)
+        tx.raw = None
+        self.assertEqual(outputs, tx.outputs)
+        self.assertEqual(raw, tx.serialize())
+
+    def test_prevouts_do_not_parse_inputs(self):
+        raw = make_raw_tx([p2pkh_input(), coinbase_input(), p2sh_input()], [random_output()])
+        tx = Transaction.deserialize(raw)
+        prevouts = tx.get_prevouts()
+        self.assertEqual(None, tx._inputs)
+        self.assertEqual(2, len(prevouts))
+        self.assertEqual(prevouts, tx.get_prevouts())
+        tx.inputs
+        self.assertEqual(prevouts, tx.get_prevouts())
+
+    def test_is_coinbase(self):
+        for inputs, expected in [([coinbase_input()], True), ([p2pkh_input(), coinbase_input()], False)]:
+            tx = Transaction.deserialize(make_raw_tx(inputs, [random_output()]))
+            self.assertEqual(expected, tx.is_coinbase())
+            self.assertEqual(None, tx._inputs)
+            tx.inputs
+            self.assertEqual(expected, tx.is_coinbase())
+        self.assertFalse(Transaction([p2pkh_txin()], []).is_coinbase())
+
+    def test_has_address_checks_outputs_first(self):
+        tx = Transaction.deserialize(make_raw_tx([p2pkh_input()], [random_output('p2pkh')]))
+        self.assertTrue(tx.has_address(tx.get_outputs()[0][0]))
+        self.assertEqual(None, tx._inputs)
+        self.assertTrue(tx.has_address(tx.inputs[0]['address']))
+        self.assertFalse(tx.has_address('nothing'))
+
+    def test_pubkey_addresses_are_deferred(self):
+        pubkey = random_pubkey()
+        script = push(pubkey) + 'ac'
+        output = int_to_hex(1000, 8) + var_int(len(script)/2) + script
+        prev_tx = Transaction.deserialize(make_raw_tx([p2pkh_input()], [random_output('p2pkh'), output]))
+        script = push(random_sig())
+        txin = prev_tx.hash().decode('hex')[::-1].encode('hex') + int_to_hex(1, 4) \
+            + var_int(len(script)/2) + script + 'ffffffff'
+        tx = Transaction.deserialize(make_raw_tx([txin], [random_output('p2pkh')]))
+        tx.add_pubkey_addresses({prev_tx.hash(): prev_tx})
+        self.assertEqual(None, tx._inputs)
+        self.assertEqual(hash_160_to_bc_address(hash_160(pubkey.decode('hex'))), tx.inputs[0]['address'])
+
+    def test_malformed_raises_on_load(self):
+        self.assertRaises(SerializationError, Transaction.deserialize, random_raw_tx()[:-10])
+
+
+class Test_Records(unittest.TestCase):
+
+    def test_input_dict_interface(self):
+        txin = TxInput(prevout_hash='00'*32, prevout_n=1)
+        self.assertEqual({'prevout_hash': '00'*32, 'prevout_n': 1}, txin)
+        self.assertEqual(None, txin.get('address'))
+        self.assertFalse('address' in txin)
+        self.assertRaises(KeyError, lambda: txin['address'])
+        txin['address'] = 'addr'
+        txin['value'] = 1000
+        self.assertTrue('value' in txin)
+        self.assertEqual(set(['prevout_hash', 'prevout_n', 'address', 'value']), set(txin.keys()))
+        self.assertEqual(dict(txin, value=1000), dict(txin.items()))
+        self.assertEqual(1000, txin.pop('value'))
+        self.assertEqual(None, txin.pop('value', None))
+        del txin['address']
+        self.assertEqual({'prevout_hash': '00'*32, 'prevout_n': 1}, dict(txin))
+        self.assertEqual(txin, txin.copy())
+        self.assertFalse(hasattr(txin, '__dict__'))
+
+    def test_output_tuple_interface(self):
+        o = TxOutput('address', 'addr', 1000)
+        type, addr, value = o
+        self.assertEqual(('address', 'addr', 1000), (type, addr, value))
+        self.assertEqual(('address', 'addr', 1000), o)
+        self.assertEqual(1000, o[2])
+        self.assertEqual(1000, o['value'])
+        self.assertEqual(('address', 'addr'), o[:2])
+        self.assertRaises(KeyError, lambda: o['scriptPubKey'])
+        self.assertFalse(hasattr(o, '__dict__'))
+
+    def test_parsed_records(self):
+        raw = random_raw_tx()
+        d = transaction.deserialize(raw)
+        tx = Transaction.deserialize(raw)
+        for txin, x in zip(tx.inputs, d['inputs']):
+            self.assertTrue(isinstance(txin, TxInput))
+            self.assertEqual(dict(x), dict(txin))
+        for o, x in zip(tx.outputs, d['outputs']):
+            self.assertTrue(isinstance(o, TxOutput))
+            self.assertEqual((x['type'], x['address'], x['value']), tuple(o))
+        # signing updates the records in place
+        tx.inputs[0]['signatures'] = [None]
+        self.assertEqual([None], tx.inputs[0].signatures)
+
+
+class Test_OutputScripts(unittest.TestCase):
+
+    def scripts(self):
+        h = os.urandom(20)
+        yield '\x76\xa9\x14' + h + '\x88\xac'
+        yield '\xa9\x14' + h + '\x87'
+        yield '\x21' + random_pubkey().decode('hex') + '\xac'
+        yield '\x41' + random_pubkey(False).decode('hex') + '\xac'
+        yield '\x6a\x05hello'
+        # standard templates with non-canonical pushes, or other lengths
+        yield '\x76\xa9\x4c\x14' + h + '\x88\xac'
+        yield '\x76\xa9\x15' + h + '\x00\x88\xac'
+        yield '\xa9\x13' + h[:19] + '\x87'
+        yield '\x76\xa9\x14' + h + '\x88\xad'
+        yield '\x21' + os.urandom(33) + '\xad'
+        yield ''
+        for i in range(20):
+            yield os.urandom(random.choice([23, 25, 35, 67, random.randint(1, 80)]))
+
+    def outcome(self, f, script):
+        # random bytes may not decode at all
+        try:
+            return f(script)
+        except Exception as e:
+            return type(e)
+
+    def test_matches_decoder(self):
+        for i in range(20):
+            for script in self.scripts():
+                self.assertEqual(self.outcome(transaction.decode_output_script, script),
+                                 self.outcome(transaction.get_address_from_output_script, script))
+
+    def test_addresses_are_cached(self):
+        for script, addrtype in [('\xa9\x14%s\x87', 9), ('\x76\xa9\x14%s\x88\xac', 50)]:
+            h = os.urandom(20)
+            address = transaction.get_address_from_output_script(script%h)[1]
+            self.assertEqual(address, bitcoin._address_cache[(addrtype, h)])
+
+
+class Test_Memoized(unittest.TestCase):
+
+    def setUp(self):
+        super(Test_Memoized, self).setUp()
+        self.raw = make_raw_tx([p2pkh_input(), p2pkh_input()], [random_output('p2pkh'), random_output('pubkey')])
+        self.tx = Transaction.deserialize(self.raw)
+
+    def test_views_are_memoized(self):
+        txid = self.tx.hash()
+        self.assertTrue(self.tx.hash() is txid)
+        self.assertTrue(self.tx.get_outputs() is self.tx.get_outputs())
+        self.assertTrue(self.tx.get_addresses() is self.tx.get_addresses())
+        addresses = self.tx.get_output_addresses() + [txin['address'] for txin in self.tx.inputs]
+        self.assertEqual(frozenset(addresses), self.tx.get_addresses())
+
+    def test_reset_when_raw_changes(self):
+        txid = self.tx.hash()
+        outputs = self.tx.get_outputs()
+        addresses = self.tx.get_addresses()
+        other = Transaction.deserialize(random_raw_tx())
+        self.tx.update(str(other))
+        self.assertEqual(other.hash(), self.tx.hash())
+        self.assertNotEqual(txid, self.tx.hash())
+        self.assertEqual(other.get_outputs(), self.tx.get_outputs())
+        self.assertNotEqual(outputs, self.tx.get_outputs())
+        self.assertEqual(other.get_addresses(), self.tx.get_addresses())
+        self.assertNotEqual(addresses, self.tx.get_addresses())
+
+    def test_reset_on_add_input(self):
+        self.tx.get_addresses()
+        txin = dict(self.tx.inputs[0])
+        txin['address'] = 'new address'
+        self.tx.add_input(txin)
+        self.assertEqual(None, self.tx.raw)
+        self.assertTrue('new address' in self.tx.get_addresses())
+
+    def test_unserialized_outputs_are_not_memoized(self):
+        tx = Transaction([], [('address', 'a', 1)])
+        self.assertEqual(frozenset(['a']), tx.get_output_address_set())
+        tx.outputs.append(('address', 'b', 2))
+        self.assertEqual([('a', 1), ('b', 2)], tx.get_outputs())
+        self.assertTrue(tx.has_address('b'))
+
+
+class Test_Sighash(unittest.TestCase):
+
+    def test_digests_match_tx_for_sig(self):
+        tx = make_unsigned_tx(7)
+        expected = [Hash(tx.tx_for_sig(i).decode('hex')) for i in range(7)]
+        engine = SighashEngine(tx)
+        self.assertEqual(expected, [engine.digest(i) for i in range(7)])
+        # out of order requests restart the running state
+        self.assertEqual([expected[i] for i in [5, 2, 6, 0]], [engine.digest(i) for i in [5, 2, 6, 0]])
+
+    def test_single_input(self):
+        tx = make_unsigned_tx(1)
+        self.assertEqual(Hash(tx.tx_for_sig(0).decode('hex')), SighashEngine(tx).digest(0))
+
+    def test_sign(self):
+        keys = [make_keypair(), make_keypair(False)]
+        tx = make_unsigned_tx(0)
+        tx.add_input(p2sh_txin())
+        for pubkey, sec in keys:
+            tx.add_input(p2pkh_txin(pubkey))
+        tx.sign(dict(keys))
+        self.assertEqual((2, 4), tx.signature_count())
+        for i, (pubkey, sec) in enumerate(keys):
+            sig = tx.inputs[i+1]['signatures'][0]
+            self.assertTrue(verify_signature(pubkey, sig, Hash(tx.tx_for_sig(i+1).decode('hex'))))
+
+
+class Test_Serialize(unittest.TestCase):
+
+    def check(self, tx):
+        for for_sig in [-1, None] + range(len(tx.inputs)):
+            self.assertEqual(hex_serialize(tx, for_sig), tx.serialize(for_sig))
+        self.assertEqual(len(hex_serialize(tx, -1))/2, tx.estimated_size())
+
+    def test_p2pkh(self):
+        tx = Transaction([p2pkh_txin(), p2pkh_txin(random_pubkey(False))], [('address', random_address(), 10**5)])
+        self.check(tx)
+        for txin in tx.inputs:
+            txin['signatures'] = [random_sig()[:-2]]
+        self.check(tx)
+
+    def test_p2sh_multisig(self):
+        tx = Transaction([p2sh_txin(), p2sh_txin([random_pubkey(), random_pubkey()])], [('address', random_address(9), 10**5)])
+        self.check(tx)
+        for txin in tx.inputs:
+            txin['signatures'][:2] = [random_sig()[:-2], random_sig()[:-2]]
+        self.check(tx)
+
+    def test_x_pubkey_partial(self):
+        txin = p2sh_txin()
+        # extended pubkeys of the cosigners that have not signed yet
+        txin['x_pubkeys'][1:] = ['ff' + os.urandom(80).encode('hex'), 'fe' + os.urandom(66).encode('hex')]
+        txin['signatures'][0] = random_sig()[:-2]
+        tx = Transaction([txin, p2pkh_txin()], [('address', random_address(), 1), ('op_return', 'x'*100, 0)])
+        self.check(tx)
+        self.assertTrue(NO_SIGNATURE in tx.serialize())
+
+    def test_many_outputs(self):
+        outputs = [('address', random_address(), i) for i in range(300)]
+        self.check(Transaction([p2pkh_txin()], outputs))
+
+    def test_roundtrip(self):
+        tx = make_unsigned_tx(3)
+        for txin in tx.inputs:
+            txin['signatures'][:txin['num_sig']] = [random_sig()[:-2]]*txin['num_sig']
+        self.assertEqual(str(Transaction.deserialize(tx.serialize())), tx.serialize())
+        self.assertEqual(len(tx.serialize())/2, len(tx.serialize_bytes()))
+
+
+class Test_ParallelSign(unittest.TestCase):
+
+    def test_parallel_sign(self):
+        keys = [make_keypair() for i in range(4)]
+        inputs = [p2pkh_txin(pubkey) for pubkey, sec in keys]
+        outputs = [('address', random_address(), 10**5)]
+        tx1 = Transaction([dict(txin, signatures=[None]) for txin in inputs], outputs)
+        tx2 = Transaction([dict(txin, signatures=[None]) for txin in inputs], outputs)
+        tx1.sign(dict(keys))
+        pool = multiprocessing.Pool(2)
+        try:
+            tx2.sign(dict(keys), pool)
+        finally:
+            pool.terminate()
+        # signatures are deterministic
+        self.assertTrue(tx2.is_complete())
+        self.assertEqual(str(tx1), str(tx2))
+
+
+class Test_SizeEstimator(unittest.TestCase):
+
+    def random_txin(self):
+        kind = random.choice(['p2pkh', 'p2pkh_uncompressed', '2of2', '2of3'])
+        if kind == 'p2pkh':
+            return p2pkh_txin(random_pubkey())
+        elif kind == 'p2pkh_uncompressed':
+            return p2pkh_txin(random_pubkey(False))
+        elif kind == '2of2':
+            return p2sh_txin([random_pubkey(), random_pubkey(False)])
+        else:
+            return p2sh_txin([random_pubkey() for i in range(3)])
+
+    def random_output(self):
+        kind = random.choice(['p2pkh', 'p2sh', 'op_return'])
+        if kind == 'op_return':
+            return ('op_return', 'x'*random.randint(0, 100), 0)
+        return ('address', random_address(50 if kind == 'p2pkh' else 9), random.randint(0, 10**8))
+
+    def test_matches_serialize(self):
+        for k in range(20):
+            outputs = [self.random_output() for i in range(random.randint(1, 4))]
+            tx = Transaction([], outputs)
+            size = SizeEstimator(outputs)
+            for i in range(random.randint(1, 6)):
+                txin = self.random_txin()
+                tx.add_input(txin)
+                size.add_input(txin)
+                self.assertEqual(len(tx.serialize(-1))/2, size.size())
+
+    def test_large_counts(self):
+        outputs = [('address', random_address(), 1) for i in range(260)]
+        size = SizeEstimator(outputs)
+        tx = Transaction([], outputs)
+        txin = p2pkh_txin()
+        for i in range(260):
+            tx.add_input(txin)
+            size.add_input(txin)
+        self.assertEqual(len(tx.serialize(-1))/2, size.size())
+
+    def test_add_and_remove_output(self):
+        outputs = [('address', random_address(), 1)]
+        tx = Transaction([p2sh_txin()], outputs)
+        size = SizeEstimator(outputs)
+        size.add_input(tx.inputs[0])
+        before = size.size()
+        change = ('address', random_address(9), 2)
+        size.add_output(change)
+        tx.outputs.append(change)
+        self.assertEqual(len(tx.serialize(-1))/2, size.size())
+        size.remove_output(change)
+        self.assertEqual(before, size.size())
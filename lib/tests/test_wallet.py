@@ -6,7 +6,12 @@ import os
 import json
 
 from StringIO import StringIO
-from lib.wallet import WalletStorage, NewWallet
+from lib.wallet import WalletStorage, NewWallet, OldWallet
+from lib import account
+from lib.account import BIP32_Account, BIP32_Account_2of2
+from lib.bitcoin import int_to_hex, var_int, bc_address_to_hash_160, bip32_root, public_key_to_bc_address, address_from_private_key
+from lib.transaction import Transaction
+from lib.tests.test_transaction import push, random_sig, random_address, make_raw_tx, p2pkh_input, coinbase_input
 
 
 class FakeConfig(object):
@@ -31,6 +36,15 @@ class FakeSynchronizer(object):
         self.store.append(address)
 
 
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.pending_transactions_for_notifications = []
+
+    def get_local_height(self):
+        return 1000
+
+
 class WalletTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -43,6 +57,15 @@ class WalletTestCase(unittest.TestCase):
         self._stdout_buffer = StringIO()
         sys.stdout = self._stdout_buffer
 
+    def assertNoKeys(self, wallet, address, password):
+        # a wrong password usually fails to decrypt; rarely, it decrypts
+        # to an empty string and no key is derived
+        try:
+            keys = wallet.get_private_key(address, password)
+        except Exception:
+            return
+        self.assertEqual(keys, [])
+
     def tearDown(self):
         super(WalletTestCase, self).tearDown()
         shutil.rmtree(self.user_dir)
@@ -162,3 +185,148 @@ class TestNewWallet(WalletTestCase):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+    def test_synchronize(self):
+        self.wallet.network = FakeNetwork()
+        self.wallet.synchronize()
+        account = self.wallet.accounts['0']
+        for for_change, limit in [(0, account.gap_limit), (1, account.gap_limit_for_change)]:
+            addresses = account.get_addresses(for_change)
+            self.assertEqual(len(addresses), limit)
+            for n, address in enumerate(addresses):
+                pubkey = BIP32_Account.derive_pubkey_from_xpub(account.xpub, for_change, n)
+                self.assertEqual(address, public_key_to_bc_address(pubkey.decode('hex')))
+        # a multisig account derives one key per cosigner
+        xpub2 = bip32_root('\x01'*32)[1]
+        multisig = BIP32_Account_2of2({'xpub': account.xpub, 'xpub2': xpub2})
+        pubkeys = multisig.derive_range(1, 2, 3)
+        self.assertEqual(pubkeys[1], [account.derive_pubkeys(1, 3), BIP32_Account.derive_pubkey_from_xpub(xpub2, 1, 3)])
+        self.assertEqual(pubkeys, [multisig.derive_pubkeys(1, n) for n in range(2, 5)])
+
+    def test_branch_nodes_are_bounded(self):
+        size = account.branch_nodes_size
+        try:
+            account.branch_nodes_size = 4
+            xpubs = [bip32_root(chr(i)*32)[1] for i in range(5)]
+            for xpub in xpubs:
+                pubkey = BIP32_Account.derive_pubkey_from_xpub(xpub, 0, 1)
+                self.assertTrue(len(account.branch_nodes) <= 4)
+            self.assertEqual(pubkey, BIP32_Account.derive_pubkey_from_xpub(xpubs[-1], 0, 1))
+        finally:
+            account.branch_nodes_size = size
+
+    def test_unlock_session(self):
+        self.wallet.network = FakeNetwork()
+        self.wallet.synchronize()
+        self.wallet.import_key(self.import_private_key, self.password)
+        account = self.wallet.accounts['0']
+        addresses = account.get_addresses(0)[:3] + account.get_addresses(1)[:2] + [self.import_key_address]
+        expected = [self.wallet.get_private_key(a, self.password) for a in addresses]
+
+        self.assertRaises(Exception, self.wallet.unlock, "wrong")
+        self.assertEqual(self.wallet.session, None)
+        session = self.wallet.unlock(self.password)
+        self.assertEqual(self.wallet.get_private_keys(addresses, self.password), expected)
+        # one node per branch, and the imported key
+        self.assertEqual(len(session.secrets), 3)
+        # the session does not answer for another password
+        self.assertNoKeys(self.wallet, addresses[0], "wrong")
+        self.assertTrue(self.wallet.session is session)
+        self.wallet.lock_keys()
+        self.assertEqual(self.wallet.session, None)
+        self.assertFalse(session.is_open(self.password))
+
+        # a batch opens and closes its own session
+        self.assertEqual(self.wallet.get_private_keys(addresses, self.password), expected)
+        self.assertEqual(self.wallet.session, None)
+
+        session = self.wallet.unlock(self.password, timeout=0)
+        self.assertEqual(self.wallet.get_session(self.password), None)
+        self.assertEqual(self.wallet.get_private_keys(addresses, self.password), expected)
+
+        self.wallet.unlock(self.password)
+        self.wallet.update_password(self.password, "secret2")
+        self.assertEqual(self.wallet.session, None)
+        self.assertNoKeys(self.wallet, addresses[0], self.password)
+
+    def test_unspent_coins(self):
+        self.wallet.network = FakeNetwork()
+        self.wallet.synchronize()
+        addr = self.wallet.accounts['0'].get_addresses(0)[0]
+        script = '76a914' + bc_address_to_hash_160(addr)[1].encode('hex') + '88ac'
+        txs = []
+        for value, height in [(10**6, 50), (3*10**6, 100), (2*10**6, 0)]:
+            output = int_to_hex(value, 8) + var_int(len(script)/2) + script
+            tx = Transaction.deserialize(make_raw_tx([p2pkh_input()], [output]))
+            txs.append((tx.hash(), height, tx))
+        self.wallet.receive_history_callback(addr, [(h, height) for h, height, tx in txs])
+        self.assertRaises(Exception, self.wallet.get_unspent_coins)
+        for h, height, tx in txs:
+            self.wallet.receive_tx_callback(h, tx, height)
+        coins = self.wallet.get_unspent_coins()
+        self.assertEqual([c['value'] for c in coins], [10**6, 3*10**6, 2*10**6])
+
+        # spend the unconfirmed coin
+        script = push(random_sig()) + push(self.wallet.get_public_keys(addr)[0])
+        txin = txs[2][0].decode('hex')[::-1].encode('hex') + int_to_hex(0, 4) + var_int(len(script)/2) + script + 'ffffffff'
+        output = int_to_hex(10**6, 8) + '1976a914' + '00'*20 + '88ac'
+        spend = Transaction.deserialize(make_raw_tx([txin], [output]))
+        self.wallet.receive_history_callback(addr, [(h, height) for h, height, tx in txs] + [(spend.hash(), 0)])
+        self.wallet.receive_tx_callback(spend.hash(), spend, 0)
+        coins = self.wallet.get_unspent_coins()
+        self.assertEqual([c['value'] for c in coins], [10**6, 3*10**6])
+        self.assertEqual([c['value'] for c in self.wallet.get_unspent_coins(order='value')], [10**6, 3*10**6])
+
+        outputs = [('address', random_address(), 5*10**5)]
+        for chooser, value in [('oldest', 10**6), ('largest', 3*10**6)]:
+            tx = self.wallet.make_unsigned_transaction(outputs, None, addr, chooser=chooser)
+            self.assertEqual([txin['value'] for txin in tx.inputs], [value])
+            self.assertEqual(tx.get_fee(), self.wallet.estimated_fee(tx))
+        # the pool hands out copies
+        self.assertFalse('pubkeys' in self.wallet.get_unspent_coins()[0])
+
+    def test_coinbase_coins(self):
+        self.wallet.network = FakeNetwork()
+        self.wallet.synchronize()
+        addr = self.wallet.accounts['0'].get_addresses(0)[0]
+        script = '76a914' + bc_address_to_hash_160(addr)[1].encode('hex') + '88ac'
+        output = int_to_hex(10**6, 8) + var_int(len(script)/2) + script
+        txs = [Transaction.deserialize(make_raw_tx([txin], [output])) for txin in [coinbase_input(), p2pkh_input()]]
+        self.wallet.receive_history_callback(addr, [(tx.hash(), 950) for tx in txs])
+        for tx in txs:
+            self.wallet.receive_tx_callback(tx.hash(), tx, 950)
+        coinbase = dict((c['prevout_hash'], c['coinbase']) for c in self.wallet.get_unspent_coins())
+        self.assertEqual({txs[0].hash(): True, txs[1].hash(): False}, coinbase)
+        # coinbase outputs are found without parsing the inputs
+        self.assertEqual(None, txs[0]._inputs)
+        # and are not spent before they mature
+        tx = self.wallet.make_unsigned_transaction([('address', random_address(), 5*10**5)], None, addr)
+        self.assertEqual([txs[1].hash()], [txin['prevout_hash'] for txin in tx.inputs])
+
+
+class TestOldWallet(WalletTestCase):
+
+    seed_text = "hardly point goal hallway patience key stone difference ready caught listen fact"
+    password = "secret"
+
+    def setUp(self):
+        super(TestOldWallet, self).setUp()
+        self.storage = WalletStorage(self.fake_config)
+        self.wallet = OldWallet(self.storage)
+        self.wallet.add_seed(self.seed_text, self.password)
+        self.wallet.create_master_keys(self.password)
+        self.wallet.create_main_account(self.password)
+
+    def test_unlock_session(self):
+        account = self.wallet.accounts['0']
+        for i in range(3):
+            account.create_new_address(0)
+        addresses = account.get_addresses(0)
+        expected = [self.wallet.get_private_key(a, self.password) for a in addresses]
+        for address, keys in zip(addresses, expected):
+            self.assertEqual(address_from_private_key(keys[0]), address)
+        session = self.wallet.unlock(self.password)
+        self.assertEqual(self.wallet.get_private_keys(addresses, self.password), expected)
+        # the seed is stretched once for all the keys
+        self.assertEqual(session.secrets.keys(), [('stretched', account.mpk)])
+        self.assertNoKeys(self.wallet, addresses[0], "wrong")
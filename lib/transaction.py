@@ -21,6 +21,7 @@
 
 
 import bitcoin
+import ecc
 from bitcoin import *
 from util import print_error
 import time
@@ -29,10 +30,8 @@ import struct
 #
 # Workalike python implementation of Bitcoin's CDataStream class.
 #
-import struct
 import StringIO
 import mmap
-import random
 
 NO_SIGNATURE = 'ff'
 
@@ -411,6 +410,20 @@ def parse_scriptSig(d, bytes):
 
 
 def get_address_from_output_script(bytes):
+    # standard scripts are recognised by their length and fixed bytes,
+    # without decoding opcodes; the others go through decode_output_script.
+    # hash_160_to_bc_address caches the addresses it encodes
+    n = len(bytes)
+    if n == 25 and bytes[0:3] == '\x76\xa9\x14' and bytes[23:25] == '\x88\xac':
+        return 'address', hash_160_to_bc_address(bytes[3:23], 50)
+    if n == 23 and bytes[0:2] == '\xa9\x14' and bytes[22] == '\x87':
+        return 'address', hash_160_to_bc_address(bytes[2:22], 9)
+    if ((n == 35 and bytes[0] == '\x21') or (n == 67 and bytes[0] == '\x41')) and bytes[-1] == '\xac':
+        return 'pubkey', bytes[1:-1].encode('hex')
+    return decode_output_script(bytes)
+
+
+def decode_output_script(bytes):
     decoded = [ x for x in script_GetOp(bytes) ]
 
     # The Genesis Block, self-payments, and pay-by-IP-address payments look like:
@@ -441,12 +454,170 @@ def get_address_from_output_script(bytes):
 
     
 
-def parse_input(vds):
-    d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
-    prevout_n = vds.read_uint32()
-    d['scriptSig'] = scriptSig = vds.read_bytes(vds.read_compact_size())
-    sequence = vds.read_uint32()
+class TxInput(object):
+    """ a parsed transaction input. Fields are stored in slots rather
+    than in a dict, which matters for wallets with many transactions.
+    The dict interface used on input dicts is supported: unset fields
+    are missing keys, and keys that are not fields are kept aside """
+
+    __slots__ = ('is_coinbase', 'prevout_hash', 'prevout_n', 'sequence', 'scriptSig', 'address',
+                 'pubkeys', 'x_pubkeys', 'signatures', 'num_sig', 'redeemScript', '_extra')
+    fields = __slots__[:-1]
+
+    def __init__(self, d=(), **kwargs):
+        self.update(d, **kwargs)
+
+    def __getitem__(self, key):
+        try:
+            if key in self.fields:
+                return getattr(self, key)
+            return self._extra[key]
+        except (AttributeError, KeyError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+            return
+        try:
+            self._extra[key] = value
+        except AttributeError:
+            self._extra = {key: value}
+
+    def __delitem__(self, key):
+        try:
+            if key in self.fields:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except (AttributeError, KeyError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [k for k in self.fields if hasattr(self, k)]
+        return keys + getattr(self, '_extra', {}).keys()
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def update(self, d=(), **kwargs):
+        for k, v in (d.items() if hasattr(d, 'keys') else d):
+            self[k] = v
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def copy(self):
+        return TxInput(self)
+
+    def __eq__(self, other):
+        if not hasattr(other, 'keys'):
+            return NotImplemented
+        return dict(self) == dict(other)
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        return r if r is NotImplemented else not r
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class TxOutput(object):
+    """ a parsed transaction output. It is the (type, address, value)
+    tuple of Transaction.outputs, in slots; the fields can also be read
+    by name, as in output dicts """
+
+    __slots__ = ('type', 'address', 'value')
+
+    def __init__(self, type, address, value):
+        self.type = type
+        self.address = address
+        self.value = value
+
+    @classmethod
+    def parse(klass, value, scriptPubKey, i):
+        type, address = get_address_from_output_script(scriptPubKey)
+        return klass(type, address, value)
+
+    def __iter__(self):
+        yield self.type
+        yield self.address
+        yield self.value
+
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self.__slots__:
+                raise KeyError(key)
+            return getattr(self, key)
+        return (self.type, self.address, self.value)[key]
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        return r if r is NotImplemented else not r
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+def build_input(prevout_hash, prevout_n, scriptSig, sequence):
+    d = TxInput()
+    d['scriptSig'] = scriptSig
     if prevout_hash == '00'*32:
         d['is_coinbase'] = True
     else:
@@ -462,10 +633,9 @@ def parse_input(vds):
     return d
 
 
-def parse_output(vds, i):
+def build_output(value, scriptPubKey, i):
     d = {}
-    d['value'] = vds.read_int64()
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    d['value'] = value
     type, address = get_address_from_output_script(scriptPubKey)
     d['type'] = type
     d['address'] = address
@@ -474,27 +644,266 @@ def parse_output(vds, i):
     return d
 
 
-def deserialize(raw):
-    vds = BCDataStream()
-    vds.write(raw.decode('hex'))
-    d = {}
-    start = vds.read_cursor
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    d['inputs'] = []
+def parse_input(vds):
+    prevout_hash = hash_encode(vds.read_bytes(32))
+    prevout_n = vds.read_uint32()
+    scriptSig = vds.read_bytes(vds.read_compact_size())
+    sequence = vds.read_uint32()
+    return build_input(prevout_hash, prevout_n, scriptSig, sequence)
+
+
+def parse_output(vds, i):
+    value = vds.read_int64()
+    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    return build_output(value, scriptPubKey, i)
+
+
+_int32 = struct.Struct('<i')
+_uint16 = struct.Struct('<H')
+_uint32 = struct.Struct('<I')
+_int64 = struct.Struct('<q')
+_uint64 = struct.Struct('<Q')
+
+def compact_size(size):
+    if size < 0xfd:
+        return chr(size)
+    elif size <= 0xffff:
+        return '\xfd' + _uint16.pack(size)
+    elif size <= 0xffffffff:
+        return '\xfe' + _uint32.pack(size)
+    else:
+        return '\xff' + _uint64.pack(size)
+
+
+def push_bytes(data):
+    """ push data onto the stack; same encoding as op_push """
+    n = len(data)
+    if n < 0x4c:
+        return chr(n) + data
+    elif n < 0xff:
+        return '\x4c' + chr(n) + data
+    elif n < 0xffff:
+        return '\x4d' + _uint16.pack(n) + data
+    else:
+        return '\x4e' + _uint32.pack(n) + data
+
+
+def read_compact_size(data, offset):
+    """ return (size, new offset) """
+    size = ord(data[offset])
+    if size < 253:
+        return size, offset + 1
+    elif size == 253:
+        return _uint16.unpack_from(data, offset + 1)[0], offset + 3
+    elif size == 254:
+        return _uint32.unpack_from(data, offset + 1)[0], offset + 5
+    else:
+        return _uint64.unpack_from(data, offset + 1)[0], offset + 9
+
+
+def read_inputs(data, offset, parse=True):
+    """ read the inputs that start at offset. Returns the list of TxInput
+    and the offset of what follows. If parse is not set, scripts
+    are skipped and only the (prevout_hash, prevout_n) of non-coinbase
+    inputs are returned """
+    n_vin, offset = read_compact_size(data, offset)
+    inputs = []
     for i in xrange(n_vin):
-        d['inputs'].append(parse_input(vds))
-    n_vout = vds.read_compact_size()
-    d['outputs'] = []
+        prevout_hash = hash_encode(data[offset:offset+32])
+        prevout_n = _uint32.unpack_from(data, offset + 32)[0]
+        n, offset = read_compact_size(data, offset + 36)
+        if parse:
+            scriptSig = data[offset:offset+n]
+            sequence = _uint32.unpack_from(data, offset + n)[0]
+            inputs.append(build_input(prevout_hash, prevout_n, scriptSig, sequence))
+        elif prevout_hash != '00'*32:
+            inputs.append((prevout_hash, prevout_n))
+        offset += n + 4
+    return inputs, offset
+
+
+def read_outputs(data, offset, parse=True, build=build_output):
+    """ read the outputs that start at offset. Returns the list of outputs
+    made by build(value, scriptPubKey, index), output dicts by default
+    (None if parse is not set), and the offset of what follows """
+    n_vout, offset = read_compact_size(data, offset)
+    outputs = [] if parse else None
     for i in xrange(n_vout):
-        d['outputs'].append(parse_output(vds, i))
-    d['lockTime'] = vds.read_uint32()
+        value = _int64.unpack_from(data, offset)[0]
+        n, offset = read_compact_size(data, offset + 8)
+        if parse:
+            outputs.append(build(value, data[offset:offset+n], i))
+        offset += n
+    return outputs, offset
+
+
+def frame(data):
+    """ check the layout of a decoded transaction without parsing its
+    scripts. Returns the offset of the outputs and the lock time """
+    try:
+        prevouts, outputs_offset = read_inputs(data, 4, False)
+        outputs, offset = read_outputs(data, outputs_offset, False)
+        locktime = _uint32.unpack_from(data, offset)[0]
+    except (struct.error, IndexError):
+        raise SerializationError("attempt to read past end of buffer")
+    return outputs_offset, locktime
+
+
+def deserialize(raw):
+    """ parse a serialized transaction. The raw bytes are decoded once
+    and read in place with struct offsets; only the fields that end up
+    in the result are copied out """
+    data = raw.decode('hex')
+    try:
+        d = {}
+        d['version'] = _int32.unpack_from(data, 0)[0]
+        d['inputs'], offset = read_inputs(data, 4)
+        d['outputs'], offset = read_outputs(data, offset)
+        d['lockTime'] = _uint32.unpack_from(data, offset)[0]
+    except (struct.error, IndexError):
+        raise SerializationError("attempt to read past end of buffer")
     return d
 
 
 push_script = lambda x: op_push(len(x)/2) + x
 
-class Transaction:
+
+def push_size(n):
+    """ size of push_bytes for n bytes of data """
+    if n < 0x4c:
+        return 1 + n
+    elif n < 0xff:
+        return 2 + n
+    elif n < 0xffff:
+        return 3 + n
+    else:
+        return 5 + n
+
+
+class SizeEstimator(object):
+    """ size of a transaction being built, as serialize(-1) would give it,
+    maintained as inputs and outputs are added. Each update costs the
+    same whatever the size of the transaction """
+
+    def __init__(self, outputs=(), input_size=None):
+        # input_size may replace the default estimate, e.g. for inputs
+        # whose pubkeys are not known yet
+        if input_size is not None:
+            self.input_size = input_size
+        self.num_inputs = 0
+        self.num_outputs = 0
+        self.inputs_size = 0
+        self.outputs_size = 0
+        for output in outputs:
+            self.add_output(output)
+
+    @classmethod
+    def input_size(klass, txin):
+        # signatures are assumed to be 0x48 bytes long
+        script_size = txin['num_sig'] * push_size(0x48)
+        pubkey_sizes = [ len(pubkey)/2 for pubkey in txin['pubkeys'] ]
+        if txin.get('redeemScript') is None:
+            script_size += push_size(pubkey_sizes[0])
+        else:
+            # op_0, signatures, then op_2 <pubkeys> op_n op_checkmultisig
+            redeem_script_size = 3 + sum(push_size(n) for n in pubkey_sizes)
+            script_size += 1 + push_size(redeem_script_size)
+        return 32 + 4 + len(compact_size(script_size)) + script_size + 4
+
+    @classmethod
+    def output_size(klass, output):
+        type, addr, amount = output
+        if type == 'op_return':
+            script_size = 1 + push_size(len(addr))
+        else:
+            assert type == 'address'
+            script_size = 25 if bc_address_to_hash_160(addr)[0] == 50 else 23
+        return 8 + len(compact_size(script_size)) + script_size
+
+    def add_input(self, txin):
+        self.num_inputs += 1
+        self.inputs_size += self.input_size(txin)
+
+    def remove_input(self, txin):
+        self.num_inputs -= 1
+        self.inputs_size -= self.input_size(txin)
+
+    def add_output(self, output):
+        self.num_outputs += 1
+        self.outputs_size += self.output_size(output)
+
+    def remove_output(self, output):
+        self.num_outputs -= 1
+        self.outputs_size -= self.output_size(output)
+
+    def size(self):
+        return 4 + len(compact_size(self.num_inputs)) + self.inputs_size \
+            + len(compact_size(self.num_outputs)) + self.outputs_size + 4
+
+
+def sign_digest(job):
+    """ deterministic DER signature of a digest, in hex. This runs in
+    worker processes when inputs are signed in parallel """
+    sec, for_sig = job
+    pkey = regenerate_key(sec)
+    r, s = ecc.sign(pkey.secret, for_sig)
+    assert ecc.verify(pkey.point, for_sig, r, s)
+    sig = ecdsa.util.sigencode_der(r, s, ecc.N)
+    return sig.encode('hex')
+
+
+class SighashEngine(object):
+    """ digests signed by each input of a transaction (SIGHASH_ALL).
+
+    The preimage of input i is the unsigned transaction with empty
+    scripts, except for the script of input i. Everything but that script
+    is serialized once: the empty inputs all have the same size, so the
+    inputs that come before and after input i are slices of one buffer.
+    Inputs are processed in order, and a running SHA-256 state over the
+    preceding inputs is copied instead of rehashing them.
+    """
+
+    EMPTY_INPUT_SIZE = 32 + 4 + 1 + 4
+
+    def __init__(self, tx):
+        self.tx = tx
+        inputs = tx.inputs
+        self.outpoints = [ txin['prevout_hash'].decode('hex')[::-1] + _uint32.pack(txin['prevout_n']) for txin in inputs ]
+        self.empty_inputs = ''.join( outpoint + '\x00' + '\xff'*4 for outpoint in self.outpoints )
+        tail = bytearray(compact_size( len(tx.outputs) ))
+        for type, addr, amount in tx.outputs:
+            script = tx.output_script(type, addr)
+            tail += _int64.pack(amount) + compact_size( len(script) ) + script
+        tail += _uint32.pack(0)                                      # lock time
+        tail += _uint32.pack(1)                                      # hash type
+        self.tail = str(tail)
+        self.head = _uint32.pack(1) + compact_size( len(inputs) )
+        self.state = hashlib.sha256(self.head)
+        self.position = 0
+
+    def script_code(self, i):
+        txin = self.tx.inputs[i]
+        if txin.get('redeemScript') is not None:
+            return txin['redeemScript'].decode('hex')
+        return self.tx.output_script('address', txin['address'])
+
+    def digest(self, i):
+        """ Hash(tx_for_sig(i)). Inputs should be requested in order """
+        size = self.EMPTY_INPUT_SIZE
+        if i < self.position:
+            # restart the running state
+            self.state = hashlib.sha256(self.head)
+            self.position = 0
+        self.state.update(buffer(self.empty_inputs, self.position*size, (i - self.position)*size))
+        self.position = i
+        script = self.script_code(i)
+        h = self.state.copy()
+        h.update(self.outpoints[i] + compact_size( len(script) ) + script + '\xff'*4)
+        h.update(buffer(self.empty_inputs, (i + 1)*size))
+        h.update(self.tail)
+        return sha256(h.digest())
+
+class Transaction(object):
 
     def __str__(self):
         if self.raw is None:
@@ -502,11 +911,14 @@ class Transaction:
         return self.raw
 
     def __init__(self, inputs, outputs, locktime=0):
-        self.inputs = inputs
-        self.outputs = outputs
+        self._inputs = inputs
+        self._outputs = outputs
         self.locktime = locktime
         self.raw = None
-        
+        self.outputs_offset = None
+        # pay-to-pubkey lookups requested before the inputs were parsed
+        self.pubkey_txlists = []
+
     @classmethod
     def deserialize(klass, raw):
         self = klass([],[])
@@ -514,11 +926,77 @@ class Transaction:
         return self
 
     def update(self, raw):
-        d = deserialize(raw)
+        """ inputs and outputs are parsed from raw on first access """
+        outputs_offset, locktime = frame(raw.decode('hex'))
         self.raw = raw
-        self.inputs = d['inputs']
-        self.outputs = map(lambda x: (x['type'], x['address'], x['value']), d['outputs'])
-        self.locktime = d['lockTime']
+        self._inputs = None
+        self._outputs = None
+        self.locktime = locktime
+        self.outputs_offset = outputs_offset
+        self.pubkey_txlists = []
+
+    @property
+    def inputs(self):
+        if self._inputs is None:
+            self._inputs, offset = read_inputs(self.raw.decode('hex'), 4)
+            txlists, self.pubkey_txlists = self.pubkey_txlists, []
+            for txlist in txlists:
+                self.add_pubkey_addresses(txlist)
+        return self._inputs
+
+    @inputs.setter
+    def inputs(self, inputs):
+        self._inputs = inputs
+        self.forget()
+
+    @property
+    def outputs(self):
+        if self._outputs is None:
+            self._outputs, offset = read_outputs(self.raw.decode('hex'), self.outputs_offset, build=TxOutput.parse)
+        return self._outputs
+
+    @outputs.setter
+    def outputs(self, outputs):
+        self._outputs = outputs
+        self.forget()
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw):
+        if raw is None and getattr(self, '_raw', None) is not None:
+            # inputs and outputs not read yet only exist in raw
+            self.inputs
+            self.outputs
+        self._raw = raw
+        self.forget()
+
+    def forget(self):
+        """ reset the values memoized for a serialized transaction """
+        self._hash = None
+        self._output_list = None
+        self._output_addresses = None
+        self._addresses = None
+
+    def get_prevouts(self):
+        """ (prevout_hash, prevout_n) of the non-coinbase inputs. Unlike
+        inputs, this does not parse the input scripts """
+        if self._inputs is not None:
+            return [(x['prevout_hash'], x['prevout_n']) for x in self._inputs if not x.get('is_coinbase')]
+        prevouts, offset = read_inputs(self.raw.decode('hex'), 4, False)
+        return prevouts
+
+    def is_coinbase(self):
+        """ whether the first input is a coinbase. Only the first prevout
+        hash is read from raw """
+        if self._inputs is not None:
+            return bool(self._inputs) and bool(self._inputs[0].get('is_coinbase'))
+        # version, input count of up to 9 bytes, prevout hash
+        data = self.raw[:2*(4+9+32)].decode('hex')
+        n_vin, offset = read_compact_size(data, 4)
+        return n_vin > 0 and data[offset:offset+32] == '\x00'*32
 
     @classmethod 
     def sweep(klass, privkeys, network, to_address, fee):
@@ -579,105 +1057,107 @@ class Transaction:
 
     @classmethod
     def pay_script(self, type, addr):
+        return self.output_script(type, addr).encode('hex')
+
+    @classmethod
+    def output_script(self, type, addr):
+        """ scriptPubKey, as bytes """
         if type == 'op_return':
-            h = addr.encode('hex')
-            return '6a' + push_script(h)
+            return '\x6a' + push_bytes(addr)
         else:
             assert type == 'address'
         addrtype, hash_160 = bc_address_to_hash_160(addr)
         if addrtype == 50:
-            script = '76a9'                                      # op_dup, op_hash_160
-            script += push_script(hash_160.encode('hex'))
-            script += '88ac'                                     # op_equalverify, op_checksig
+            return '\x76\xa9\x14' + hash_160 + '\x88\xac'           # op_dup, op_hash_160, push, op_equalverify, op_checksig
         elif addrtype == 9:
-            script = 'a9'                                        # op_hash_160
-            script += push_script(hash_160.encode('hex'))
-            script += '87'                                       # op_equal
+            return '\xa9\x14' + hash_160 + '\x87'                     # op_hash_160, push, op_equal
         else:
             raise
-        return script
 
+    def input_script(self, txin, for_sig):
+        """ scriptSig of txin, as bytes. See serialize for for_sig """
+        p2sh = txin.get('redeemScript') is not None
+        num_sig = txin['num_sig']
+        x_signatures = txin['signatures']
+        signatures = filter(lambda x: x is not None, x_signatures)
+        is_complete = len(signatures) == num_sig
+
+        # if we have enough signatures, we use the actual pubkeys
+        # use extended pubkeys (with bip32 derivation)
+        if for_sig == -1:
+            # we assume that signature will be 0x48 bytes long
+            pubkeys = txin['pubkeys']
+            sig_list = [ '\x00'* 0x48 ] * num_sig
+        elif is_complete:
+            pubkeys = txin['pubkeys']
+            sig_list = [ signature.decode('hex') + '\x01' for signature in signatures ]
+        else:
+            pubkeys = txin['x_pubkeys']
+            sig_list = [ (signature + '01' if signature is not None else NO_SIGNATURE).decode('hex') for signature in x_signatures ]
 
-    def serialize(self, for_sig=None):
-        # for_sig:
-        #   -1   : do not sign, estimate length
-        #   i>=0 : sign input i
-        #   None : add all signatures
+        script = ''.join( map(push_bytes, sig_list) )
+        if not p2sh:
+            return script + push_bytes(pubkeys[0].decode('hex'))
+        else:
+            redeem_script = self.multisig_script(pubkeys,2)
+            return '\x00' + script + push_bytes(redeem_script.decode('hex'))   # op_0
 
+    def serialize_bytes(self, for_sig=None):
+        """ the serialized transaction, as a bytearray. See serialize """
         inputs = self.inputs
         outputs = self.outputs
 
-        s  = int_to_hex(1,4)                                         # version
-        s += var_int( len(inputs) )                                  # number of inputs
-        for i in range(len(inputs)):
-            txin = inputs[i]
-
-            s += txin['prevout_hash'].decode('hex')[::-1].encode('hex')   # prev hash
-            s += int_to_hex(txin['prevout_n'],4)                          # prev index
-
-            p2sh = txin.get('redeemScript') is not None
-            num_sig = txin['num_sig']
-            address = txin['address']
-
-            x_signatures = txin['signatures']
-            signatures = filter(lambda x: x is not None, x_signatures)
-            is_complete = len(signatures) == num_sig
-
+        b = bytearray(_uint32.pack(1))                               # version
+        b += compact_size( len(inputs) )                             # number of inputs
+        for i, txin in enumerate(inputs):
+            b += txin['prevout_hash'].decode('hex')[::-1]            # prev hash
+            b += _uint32.pack(txin['prevout_n'])                     # prev index
             if for_sig in [-1, None]:
-                # if we have enough signatures, we use the actual pubkeys
-                # use extended pubkeys (with bip32 derivation)
-                sig_list = []
-                if for_sig == -1:
-                    # we assume that signature will be 0x48 bytes long
-                    pubkeys = txin['pubkeys']
-                    sig_list = [ "00"* 0x48 ] * num_sig
-                elif is_complete:
-                    pubkeys = txin['pubkeys']
-                    for signature in signatures:
-                        sig_list.append(signature + '01')
-                else:
-                    pubkeys = txin['x_pubkeys']
-                    for signature in x_signatures:
-                        sig_list.append((signature + '01') if signature is not None else NO_SIGNATURE)
-
-                sig_list = ''.join( map( lambda x: push_script(x), sig_list))
-                if not p2sh:
-                    script = sig_list
-                    script += push_script(pubkeys[0])
-                else:
-                    script = '00'                                    # op_0
-                    script += sig_list
-                    redeem_script = self.multisig_script(pubkeys,2)
-                    script += push_script(redeem_script)
-
-            elif for_sig==i:
-                script = txin['redeemScript'] if p2sh else self.pay_script('address', address)
+                script = self.input_script(txin, for_sig)
+            elif for_sig == i:
+                p2sh = txin.get('redeemScript') is not None
+                script = txin['redeemScript'].decode('hex') if p2sh else self.output_script('address', txin['address'])
             else:
                 script = ''
+            b += compact_size( len(script) )                         # script length
+            b += script
+            b += '\xff\xff\xff\xff'                                  # sequence
+
+        b += compact_size( len(outputs) )                            # number of outputs
+        for type, addr, amount in outputs:
+            script = self.output_script(type, addr)
+            b += _int64.pack(amount)                                 # amount
+            b += compact_size( len(script) )                         # script length
+            b += script                                              # script
+        b += _uint32.pack(0)                                         # lock time
+        if for_sig is not None and for_sig != -1:
+            b += _uint32.pack(1)                                     # hash type
+        return b
 
-            s += var_int( len(script)/2 )                            # script length
-            s += script
-            s += "ffffffff"                                          # sequence
+    def serialize(self, for_sig=None):
+        # for_sig:
+        #   -1   : do not sign, estimate length
+        #   i>=0 : sign input i
+        #   None : add all signatures
+        return str(self.serialize_bytes(for_sig)).encode('hex')
 
-        s += var_int( len(outputs) )                                 # number of outputs
-        for output in outputs:
-            type, addr, amount = output
-            s += int_to_hex( amount, 8)                              # amount
-            script = self.pay_script(type, addr)
-            s += var_int( len(script)/2 )                           #  script length
-            s += script                                             #  script
-        s += int_to_hex(0,4)                                        #  lock time
-        if for_sig is not None and for_sig != -1:
-            s += int_to_hex(1, 4)                                   #  hash type
-        return s
+    def estimated_size(self):
+        """ size in bytes once signed """
+        return len(self.serialize_bytes(-1))
 
     def tx_for_sig(self,i):
         return self.serialize(for_sig = i)
 
     def hash(self):
-        return Hash(self.raw.decode('hex') )[::-1].encode('hex')
+        if self._hash is None:
+            self._hash = Hash(self.raw.decode('hex') )[::-1].encode('hex')
+        return self._hash
 
     def add_signature(self, i, pubkey, sig):
+        self.set_signature(i, pubkey, sig)
+        self.raw = self.serialize()
+
+    def set_signature(self, i, pubkey, sig):
         print_error("adding signature for", pubkey)
         txin = self.inputs[i]
         pubkeys = txin['pubkeys']
@@ -685,7 +1165,6 @@ class Transaction:
         txin['signatures'][ii] = sig
         txin['x_pubkeys'][ii] = pubkey
         self.inputs[i] = txin
-        self.raw = self.serialize()
 
     def add_input(self, input):
         self.inputs.append(input)
@@ -747,9 +1226,14 @@ class Transaction:
         return addr_list, xpub_list
 
 
-    def sign(self, keypairs):
+    def sign(self, keypairs, pool=None):
+        """ sign the inputs we have keys for. Digests are computed here;
+        if a multiprocessing pool is given, signatures are computed by its
+        workers. They are added in input order either way """
         print_error("tx.sign(), keypairs:", keypairs)
 
+        sighashes = SighashEngine(self)
+        jobs = []
         for i, txin in enumerate(self.inputs):
 
             # continue if this txin is complete
@@ -759,24 +1243,30 @@ class Transaction:
                 continue
 
             redeem_pubkeys = txin['pubkeys']
-            for_sig = Hash(self.tx_for_sig(i).decode('hex'))
+            for_sig = None
             for pubkey in redeem_pubkeys:
-                if pubkey in keypairs.keys():
-                    # add signature
-                    sec = keypairs[pubkey]
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
-                    self.add_signature(i, pubkey, sig.encode('hex'))
+                if pubkey in keypairs:
+                    if for_sig is None:
+                        for_sig = sighashes.digest(i)
+                    jobs.append((i, pubkey, (keypairs[pubkey], for_sig)))
+
+        args = [job for i, pubkey, job in jobs]
+        if pool is not None and len(jobs) > 1:
+            sigs = pool.map(sign_digest, args)
+        else:
+            sigs = map(sign_digest, args)
+        for (i, pubkey, job), sig in zip(jobs, sigs):
+            self.set_signature(i, pubkey, sig)
 
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
 
     def add_pubkey_addresses(self, txlist):
+        if self._inputs is None:
+            # done when the inputs are parsed
+            self.pubkey_txlists.append(txlist)
+            return
         for i in self.inputs:
             if i.get("address") == "(pubkey)":
                 prev_tx = txlist.get(i.get('prevout_hash'))
@@ -784,10 +1274,14 @@ class Transaction:
                     address, value = prev_tx.get_outputs()[i.get('prevout_n')]
                     print_error("found pay-to-pubkey address:", address)
                     i["address"] = address
+                    self._addresses = None
 
 
     def get_outputs(self):
-        """convert pubkeys to addresses"""
+        """convert pubkeys to addresses. The list is memoized once the
+        transaction is serialized, and must not be modified"""
+        if self._output_list is not None:
+            return self._output_list
         o = []
         for type, x, v in self.outputs:
             if type == 'address':
@@ -802,22 +1296,36 @@ class Transaction:
             else:
                 addr = "(None)"
             o.append((addr,v))
+        if self.raw is not None:
+            self._output_list = o
         return o
 
     def get_output_addresses(self):
         return map(lambda x:x[0], self.get_outputs())
 
+    def get_output_address_set(self):
+        if self._output_addresses is not None:
+            return self._output_addresses
+        addresses = frozenset(self.get_output_addresses())
+        if self.raw is not None:
+            self._output_addresses = addresses
+        return addresses
+
+    def get_addresses(self):
+        """ frozenset of the input and output addresses """
+        if self._addresses is not None:
+            return self._addresses
+        addresses = self.get_output_address_set().union(txin.get('address') for txin in self.inputs)
+        if self.raw is not None:
+            self._addresses = addresses
+        return addresses
 
-    def has_address(self, addr):
-        found = False
-        for txin in self.inputs:
-            if addr == txin.get('address'): 
-                found = True
-                break
-        if addr in self.get_output_addresses():
-            found = True
 
-        return found
+    def has_address(self, addr):
+        # outputs first: they are cheaper to parse than input scripts
+        if addr in self.get_output_address_set():
+            return True
+        return addr in self.get_addresses()
 
 
     def get_value(self, addresses, prevout_values):
@@ -885,7 +1393,7 @@ class Transaction:
     def requires_fee(self, verifier):
         # see https://en.bitcoin.it/wiki/Transaction_fees
         threshold = 57600000
-        size = len(self.serialize(-1))/2
+        size = self.estimated_size()
         if size >= 10000:
             return True
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Tate - lightweight Mazacoin client
+# Copyright (C) 2014 thomasv@gitorious
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import threading
+import time
+
+UNLOCK_TIMEOUT = 300
+
+
+def password_digest(password):
+    if password is None:
+        return None
+    if type(password) is unicode:
+        password = password.encode('utf8')
+    return hashlib.sha256(password).digest()
+
+
+class UnlockSession(object):
+    """ secrets decrypted or derived with the wallet password, kept in
+    memory so that they are computed once for a batch of keys.
+
+    Accounts store what is expensive to obtain from the password: the
+    stretched seed of old wallets, the private node of a BIP32 branch,
+    decrypted imported keys. The session only answers for the password
+    it was opened with, and forgets everything when it is closed or when
+    timeout seconds have passed. """
+
+    def __init__(self, password, timeout=UNLOCK_TIMEOUT):
+        self.digest = password_digest(password)
+        self.expires = time.time() + timeout
+        self.lock = threading.Lock()
+        self.secrets = {}
+
+    def is_open(self, password):
+        with self.lock:
+            if self.secrets is None:
+                return False
+            if time.time() >= self.expires:
+                self.secrets = None
+                return False
+        return password_digest(password) == self.digest
+
+    def close(self):
+        with self.lock:
+            self.secrets = None
+
+    def get(self, key, compute):
+        """ the secret stored under key, computed on first use """
+        with self.lock:
+            secrets = self.secrets
+            if secrets is not None and key in secrets:
+                return secrets[key]
+        # computed outside the lock: stretching a seed takes seconds
+        value = compute()
+        with self.lock:
+            if secrets is not None and secrets is self.secrets:
+                secrets[key] = value
+        return value
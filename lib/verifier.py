@@ -38,6 +38,8 @@ class TxVerifier(threading.Thread):
         self.lock = threading.Lock()
         self.running = False
         self.queue = Queue.Queue()
+        self.requested_merkle = set()
+        self.network.register_callback('reorg', self.on_reorg)
 
 
     def get_confirmations(self, tx):
@@ -96,7 +98,6 @@ class TxVerifier(threading.Thread):
     def run(self):
         with self.lock:
             self.running = True
-        requested_merkle = []
 
         while self.is_running():
             # request missing tx
@@ -105,10 +106,10 @@ class TxVerifier(threading.Thread):
                     # do not request merkle branch before headers are available
                     if tx_height > self.network.get_local_height():
                         continue
-                    if self.merkle_roots.get(tx_hash) is None and tx_hash not in requested_merkle:
+                    if self.merkle_roots.get(tx_hash) is None and tx_hash not in self.requested_merkle:
                         if self.network.send([ ('blockchain.transaction.get_merkle',[tx_hash, tx_height]) ], self.queue.put):
                             print_error('requesting merkle', tx_hash)
-                            requested_merkle.append(tx_hash)
+                            self.requested_merkle.add(tx_hash)
 
             try:
                 r = self.queue.get(timeout=0.1)
@@ -160,7 +161,13 @@ class TxVerifier(threading.Thread):
 
 
 
+    def on_reorg(self):
+        height = self.network.reorg_height
+        if height is not None:
+            self.undo_verifications(height)
+
     def undo_verifications(self, height):
+        undone = False
         with self.lock:
             items = self.verified_tx.items()[:]
         for tx_hash, item in items:
@@ -171,3 +178,9 @@ class TxVerifier(threading.Thread):
                     self.verified_tx.pop(tx_hash)
                     if tx_hash in self.merkle_roots:
                         self.merkle_roots.pop(tx_hash)
+                    # the merkle branch is requested again by run()
+                    self.requested_merkle.discard(tx_hash)
+                undone = True
+        if undone:
+            self.storage.put('verified_tx3', self.verified_tx, True)
+            self.network.trigger_callback('updated')
@@ -26,6 +26,8 @@ import time
 import math
 import json
 import copy
+import contextlib
+import multiprocessing
 
 from util import print_msg, print_error
 
@@ -33,7 +35,9 @@ from bitcoin import *
 from account import *
 from version import *
 
-from transaction import Transaction
+from transaction import Transaction, SizeEstimator
+from coinchooser import UTXOPool, get_chooser
+from unlock import UnlockSession, UNLOCK_TIMEOUT
 from plugins import run_hook
 import bitcoin
 from synchronizer import WalletSynchronizer
@@ -175,7 +179,10 @@ class Abstract_Wallet(object):
 
         # not saved
         self.prevout_values = {}     # my own transaction outputs
-        self.spent_outputs = []
+        self.spent_outputs = set()
+        self.utxo_pool = None
+        self.session = None          # unlock session, see unlock()
+        self.input_sizes = {}        # address -> size of a spending input
         # spv
         self.verifier = None
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
@@ -187,6 +194,9 @@ class Abstract_Wallet(object):
         self.tx_event = threading.Event()
         for tx_hash, tx in self.transactions.items():
             self.update_tx_outputs(tx_hash)
+        self.utxo_pool = UTXOPool()
+        for addr in self.history.keys():
+            self.update_utxo_pool(addr)
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -358,6 +368,50 @@ class Abstract_Wallet(object):
         account_id, sequence = self.get_address_index(address)
         return self.accounts[account_id].get_private_key(sequence, self, password)
 
+    def unlock(self, password, timeout=UNLOCK_TIMEOUT):
+        """ check password, then keep the secrets it decrypts in memory
+        until lock() is called or timeout seconds have passed """
+        self.check_password(password)
+        self.lock_keys()
+        self.session = UnlockSession(password, timeout)
+        return self.session
+
+    def lock_keys(self):
+        session, self.session = self.session, None
+        if session is not None:
+            session.close()
+
+    def get_session(self, password):
+        session = self.session
+        if session is not None and session.is_open(password):
+            return session
+
+    def get_unlocked(self, password, key, compute):
+        """ compute(), or its value kept in the unlock session """
+        session = self.get_session(password)
+        if session is None:
+            return compute()
+        return session.get(key, compute)
+
+    @contextlib.contextmanager
+    def unlocked(self, password):
+        """ unlock for the duration of a batch of operations. A session
+        that is already open for password is used and left open """
+        session = self.get_session(password)
+        if session is not None:
+            yield session
+            return
+        session = self.unlock(password)
+        try:
+            yield session
+        finally:
+            if self.session is session:
+                self.lock_keys()
+
+    def check_unlocked_password(self, password):
+        if self.get_session(password) is None:
+            self.check_password(password)
+
     def get_public_keys(self, address):
         account_id, sequence = self.get_address_index(address)
         return self.accounts[account_id].get_pubkeys(*sequence)
@@ -366,31 +420,35 @@ class Abstract_Wallet(object):
 
         if self.is_watching_only():
             return
-        self.check_password(password)
 
-        addr_list, xpub_list = tx.inputs_to_sign()
-        for addr in addr_list:
-            if self.is_mine(addr):
-                private_keys = self.get_private_key(addr, password)
-                for sec in private_keys:
+        with self.unlocked(password):
+            addr_list, xpub_list = tx.inputs_to_sign()
+            for addr in addr_list:
+                if self.is_mine(addr):
+                    private_keys = self.get_private_key(addr, password)
+                    for sec in private_keys:
+                        pubkey = public_key_from_private_key(sec)
+                        keypairs[ pubkey ] = sec
+
+            for xpub, sequence in xpub_list:
+                # look for account that can sign
+                for k, account in self.accounts.items():
+                    if xpub in account.get_master_pubkeys():
+                        break
+                else:
+                    continue
+                pk = account.get_private_key(sequence, self, password)
+                for sec in pk:
                     pubkey = public_key_from_private_key(sec)
-                    keypairs[ pubkey ] = sec
+                    keypairs[pubkey] = sec
 
-        for xpub, sequence in xpub_list:
-            # look for account that can sign
-            for k, account in self.accounts.items():
-                if xpub in account.get_master_pubkeys():
-                    break
-            else:
-                continue
-            pk = account.get_private_key(sequence, self, password)
-            for sec in pk:
-                pubkey = public_key_from_private_key(sec)
-                keypairs[pubkey] = sec
+    def get_private_keys(self, addresses, password):
+        with self.unlocked(password):
+            return [self.get_private_key(address, password) for address in addresses]
 
     def signrawtransaction(self, tx, private_keys, password):
         # check that the password is correct. This will raise if it's not.
-        self.check_password(password)
+        self.check_unlocked_password(password)
         # build a list of public/private keys
         keypairs = {}
         # add private keys from parameter
@@ -445,7 +503,7 @@ class Abstract_Wallet(object):
     def get_num_tx(self, address):
         n = 0
         for tx in self.transactions.values():
-            if address in tx.get_output_addresses(): n += 1
+            if address in tx.get_output_address_set(): n += 1
         return n
 
     def get_tx_value(self, tx, account=None):
@@ -459,10 +517,42 @@ class Abstract_Wallet(object):
             key = tx_hash+ ':%d'%i
             self.prevout_values[key] = value
 
-        for item in tx.inputs:
-            if self.is_mine(item.get('address')):
-                key = item['prevout_hash'] + ':%d'%item['prevout_n']
-                self.spent_outputs.append(key)
+        # the input scripts are not needed to know what tx spends; keys
+        # that are not my outputs are never looked up
+        for prevout_hash, prevout_n in tx.get_prevouts():
+            key = prevout_hash + ':%d'%prevout_n
+            self.spent_outputs.add(key)
+            if self.utxo_pool is not None:
+                self.utxo_pool.remove(key)
+
+        # addresses waiting for this tx include those it spends from
+        if self.utxo_pool is not None:
+            for addr in tx.get_output_address_set() | set(self.utxo_pool.incomplete):
+                if addr in self.history:
+                    self.update_utxo_pool(addr)
+
+    def update_utxo_pool(self, addr):
+        # recompute the unspent outputs of addr, from its history
+        coins = []
+        complete = True
+        h = self.history.get(addr, [])
+        if h != ['*']:
+            for tx_hash, tx_height in h:
+                tx = self.transactions.get(tx_hash)
+                if tx is None:
+                    complete = False
+                    continue
+                is_coinbase = tx.is_coinbase()
+                for i, (address, value) in enumerate(tx.get_outputs()):
+                    if address != addr: continue
+                    key = tx_hash + ":%d"%i
+                    if key in self.spent_outputs: continue
+                    output = {'address':address, 'value':value, 'prevout_n':i}
+                    output['prevout_hash'] = tx_hash
+                    output['height'] = tx_height
+                    output['coinbase'] = is_coinbase
+                    coins.append(output)
+        self.utxo_pool.set_address(addr, coins, complete)
 
     def get_addr_balance(self, address):
         #assert self.is_mine(address)
@@ -537,33 +627,12 @@ class Abstract_Wallet(object):
             uu += u
         return cc, uu
 
-    def get_unspent_coins(self, domain=None):
-        coins = []
+    def get_unspent_coins(self, domain=None, order='age'):
+        # coins are sorted by age, unconfirmed ones last, or by value
         if domain is None: domain = self.addresses(True)
-        for addr in domain:
-            h = self.history.get(addr, [])
-            if h == ['*']: continue
-            for tx_hash, tx_height in h:
-                tx = self.transactions.get(tx_hash)
-                if tx is None: raise Exception("Wallet not synchronized")
-                is_coinbase = tx.inputs[0].get('prevout_hash') == '0'*64
-                for i, (address, value) in enumerate(tx.get_outputs()):
-                    output = {'address':address, 'value':value, 'prevout_n':i}
-                    if address != addr: continue
-                    key = tx_hash + ":%d"%i
-                    if key in self.spent_outputs: continue
-                    output['prevout_hash'] = tx_hash
-                    output['height'] = tx_height
-                    output['coinbase'] = is_coinbase
-                    coins.append((tx_height, output))
-
-        # sort by age
-        if coins:
-            coins = sorted(coins)
-            if coins[-1][0] != 0:
-                while coins[0][0] == 0:
-                    coins = coins[1:] + [ coins[0] ]
-        return [x[1] for x in coins]
+        if not self.utxo_pool.is_complete(domain):
+            raise Exception("Wallet not synchronized")
+        return [dict(coin) for coin in self.utxo_pool.get_coins(domain, order)]
 
 
 
@@ -614,6 +683,7 @@ class Abstract_Wallet(object):
         with self.lock:
             self.history[addr] = hist
             self.storage.put('addr_history', self.history, True)
+        self.update_utxo_pool(addr)
 
         if hist != ['*']:
             for tx_hash, tx_height in hist:
@@ -698,13 +768,30 @@ class Abstract_Wallet(object):
         return tx.get_fee()
 
     def estimated_fee(self, tx):
-        estimated_size = len(tx.serialize(-1))/2
+        return self.fee_for_size(tx.estimated_size())
+
+    def fee_for_size(self, estimated_size):
         fee = int(self.fee_per_kb*estimated_size/1000.)
         if fee < MIN_RELAY_TX_FEE: # and tx.requires_fee(self.verifier):
             fee = MIN_RELAY_TX_FEE
         return fee
 
-    def make_unsigned_transaction(self, outputs, fixed_fee=None, change_addr=None, domain=None, coins=None ):
+    def get_input_size(self, txin):
+        # the size of an input only depends on its address
+        address = txin['address']
+        size = self.input_sizes.get(address)
+        if size is None:
+            txin = {'address':address}
+            self.add_input_info(txin)
+            size = self.input_sizes[address] = SizeEstimator.input_size(txin)
+        return size
+
+    def get_coin_chooser(self, name=None):
+        if name is None:
+            name = self.storage.config.get('coin_chooser', 'oldest')
+        return get_chooser(name)
+
+    def make_unsigned_transaction(self, outputs, fixed_fee=None, change_addr=None, domain=None, coins=None, chooser=None):
         # check outputs
         for type, data, value in outputs:
             if type == 'op_return':
@@ -713,30 +800,38 @@ class Abstract_Wallet(object):
             if type == 'address':
                 assert is_address(data), "Address " + data + " is invalid!"
 
-        # get coins
+        # get coins, in the order the chooser wants them
+        chooser = self.get_coin_chooser(chooser)
         if not coins:
             if domain is None:
                 domain = self.addresses(True)
             for i in self.frozen_addresses:
                 if i in domain: domain.remove(i)
-            coins = self.get_unspent_coins(domain)
+            coins = self.get_unspent_coins(domain, chooser.order)
+        else:
+            coins = chooser.sort(coins)
+        coins = filter(lambda x: not x.get('coinbase') or x.get('height') + COINBASE_MATURITY <= self.network.get_local_height(), coins)
 
         amount = sum( map(lambda x:x[2], outputs) )
-        total = fee = 0
         inputs = []
         tx = Transaction(inputs, outputs)
-        for item in coins:
-            if item.get('coinbase') and item.get('height') + COINBASE_MATURITY > self.network.get_local_height():
-                continue
-            v = item.get('value')
-            total += v
-            self.add_input_info(item)
-            tx.add_input(item)
-            fee = fixed_fee if fixed_fee is not None else self.estimated_fee(tx)
-            if total >= amount + fee: break
+        # the fee is estimated without serializing tx for each coin
+        size = SizeEstimator(outputs, self.get_input_size)
+        if fixed_fee is not None:
+            fee_for_size = lambda s: fixed_fee
         else:
-            print_error("Not enough funds", total, amount, fee)
+            fee_for_size = self.fee_for_size
+        dust = 0 if fixed_fee is not None else DUST_THRESHOLD
+        selected = chooser.choose(coins, amount, size, fee_for_size, dust)
+        if selected is None:
+            print_error("Not enough funds", sum(x.get('value') for x in coins), amount)
             return None
+        total = 0
+        for item in selected:
+            total += item.get('value')
+            self.add_input_info(item)
+            tx.add_input(item)
+        fee = fee_for_size(size.size())
 
         # change address
         if not change_addr:
@@ -757,11 +852,11 @@ class Abstract_Wallet(object):
         elif change_amount > DUST_THRESHOLD:
             # Insert the change output at a random position in the outputs
             posn = random.randint(0, len(tx.outputs))
-            tx.outputs[posn:posn] = [( 'address', change_addr,  change_amount)]
             # recompute fee including change output
-            fee = self.estimated_fee(tx)
-            # remove change output
-            tx.outputs.pop(posn)
+            change = ( 'address', change_addr,  change_amount)
+            size.add_output(change)
+            fee = self.fee_for_size(size.size())
+            size.remove_output(change)
             # if change is still above dust threshold, re-add change output.
             change_amount = total - ( amount + fee )
             if change_amount > DUST_THRESHOLD:
@@ -775,8 +870,8 @@ class Abstract_Wallet(object):
         run_hook('make_unsigned_transaction', tx)
         return tx
 
-    def mktx(self, outputs, password, fee=None, change_addr=None, domain= None, coins = None ):
-        tx = self.make_unsigned_transaction(outputs, fee, change_addr, domain, coins)
+    def mktx(self, outputs, password, fee=None, change_addr=None, domain= None, coins = None, chooser = None ):
+        tx = self.make_unsigned_transaction(outputs, fee, change_addr, domain, coins, chooser)
         keypairs = {}
         self.add_keypairs(tx, keypairs, password)
         if keypairs:
@@ -804,9 +899,25 @@ class Abstract_Wallet(object):
             txin['num_sig'] = 1
 
     def sign_transaction(self, tx, keypairs, password):
-        tx.sign(keypairs)
+        pool = self.get_signing_pool(tx)
+        try:
+            tx.sign(keypairs, pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
         run_hook('sign_transaction', tx, password)
 
+    def get_signing_pool(self, tx):
+        """ process pool used to sign large transactions, if parallel
+        signing is enabled and there is more than one core """
+        if not self.storage.config.get('parallel_signing', False):
+            return
+        # below that, starting the workers costs more than it saves
+        if len(tx.inputs) < 4:
+            return
+        if multiprocessing.cpu_count() > 1:
+            return multiprocessing.Pool()
+
     def sendtx(self, tx):
         # synchronous
         h = self.send_tx(tx)
@@ -833,6 +944,7 @@ class Abstract_Wallet(object):
     def update_password(self, old_password, new_password):
         if new_password == '':
             new_password = None
+        self.lock_keys()
 
         if self.has_seed():
             decoded = self.get_seed(old_password)
@@ -885,7 +997,10 @@ class Abstract_Wallet(object):
         vr = self.verifier.transactions.keys() + self.verifier.verified_tx.keys()
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
-                self.transactions.pop(tx_hash)
+                tx = self.transactions.pop(tx_hash)
+                for addr in tx.get_output_address_set():
+                    if addr in self.history:
+                        self.update_utxo_pool(addr)
 
     def check_new_history(self, addr, hist):
         # check that all tx in hist are relevant